@@ -1,5 +1,7 @@
 from .mazeworld_dataset import MazeDataSet, MazeTaskDataSet, MazeDataSetShort, ProcthorDataSet, MazeDataSetRandomActionTest
 from .metalm_dataset import LMDataSet
 from .anymdp_dataset import AnyMDPDataSet, AnyMDPv2DataSet, AnyMDPDataSetContinuousState, AnyMDPDataSetContinuousStateAction
+from .anymdp_shard import AnyMDPShardDataSet, AnyMDPv2ShardDataSet, AnyMDPShardDataSetContinuousState, AnyMDPShardDataSetContinuousStateAction, convert_anymdp_records
 from .multiagent_dataset import MultiAgentDataSetVetorized
-from .prefetch_dataloader import PrefetchDataLoader, segment_iterator
\ No newline at end of file
+from .prefetch_dataloader import PrefetchDataLoader, DataLoaderError, segment_iterator, mark_last
+from .manifest import load_manifest, valid_records
\ No newline at end of file
@@ -4,6 +4,7 @@ import random
 import torch
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
+from .manifest import valid_records
 
 class AnyMDPDataSetBase(Dataset):
     def __init__(self, directory, time_step, verbose=False):
@@ -16,8 +17,7 @@ class AnyMDPDataSetBase(Dataset):
         else:
             directories.append(directory)
         for d in directories:
-            file_list = os.listdir(d)
-            self.file_list.extend([os.path.join(d, file) for file in file_list])
+            self.file_list.extend([record["path"] for record in valid_records(d, "anymdp", verbose=verbose)])
             
         self.time_step = time_step
 
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from .anymdp_dataset import AnyMDPDataSetBase, AnyMDPDataSet, AnyMDPv2DataSet
+from .anymdp_dataset import AnyMDPDataSetContinuousState, AnyMDPDataSetContinuousStateAction
+
+"""
+Packed trajectory shards for AnyMDP records
+
+A shard is a pair of files:
+    shard-xxxxx.bin: raw array bytes of many records, every array aligned to SHARD_ALIGNMENT
+    shard-xxxxx.json: offset index, {"version", "fields", "records": [{"name", "length", "arrays"}]}
+        where arrays[field] = [offset, dtype, shape]
+
+The binary file is memory-mapped once per process, every field of a record is a view into it.
+"""
+
+SHARD_VERSION = 1
+SHARD_ALIGNMENT = 64
+# Same order as AnyMDPDataSetBase._load_and_process_data returns
+ANYMDP_FIELDS = ("observations", "prompts", "tags", "actions_behavior", "rewards", "actions_label")
+
+def _align(offset, alignment=SHARD_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _list_records(directory):
+    directories = []
+    if(isinstance(directory, list) or isinstance(directory, tuple)):
+        directories.extend(directory)
+    else:
+        directories.append(directory)
+    records = []
+    for d in directories:
+        records.extend([os.path.join(d, file) for file in sorted(os.listdir(d))])
+    return records
+
+def _write_shard(shard_path, records):
+    index = {"version": SHARD_VERSION, "fields": list(ANYMDP_FIELDS), "records": []}
+    offset = 0
+    with open(shard_path + ".bin.tmp", "wb") as f:
+        for name, arrays in records:
+            max_t = min(arr.shape[0] for arr in arrays.values())
+            entry = {"name": name, "length": int(max_t), "arrays": dict()}
+            for field in ANYMDP_FIELDS:
+                arr = np.ascontiguousarray(arrays[field][:max_t])
+                pad = _align(offset) - offset
+                if(pad > 0):
+                    f.write(b"\0" * pad)
+                    offset += pad
+                f.write(arr.tobytes())
+                entry["arrays"][field] = [offset, arr.dtype.str, list(arr.shape)]
+                offset += arr.nbytes
+            index["records"].append(entry)
+    with open(shard_path + ".json.tmp", "w") as f:
+        json.dump(index, f)
+    # The index is renamed last, an interrupted conversion never exposes a partial shard
+    os.replace(shard_path + ".bin.tmp", shard_path + ".bin")
+    os.replace(shard_path + ".json.tmp", shard_path + ".json")
+
+def convert_anymdp_records(directory, output_path, records_per_shard=1024, verbose=False):
+    """
+    Pack per-record npy directories (observations.npy, actions_behavior.npy, ...) into shards
+    directory: a directory or a list of directories containing the records
+    Records that can not be loaded are skipped
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    record_paths = _list_records(directory)
+    shard_id = 0
+    n_records = 0
+    buffer = []
+
+    def flush():
+        nonlocal shard_id, buffer
+        if(len(buffer) < 1):
+            return
+        _write_shard(os.path.join(output_path, "shard-%05d" % shard_id), buffer)
+        if(verbose):
+            print("...packed %d records into shard-%05d" % (len(buffer), shard_id))
+        shard_id += 1
+        buffer = []
+
+    for path in record_paths:
+        try:
+            arrays = {field: np.load(os.path.join(path, field + ".npy")) for field in ANYMDP_FIELDS}
+        except Exception as e:
+            print(f"[Warning] Skip record {path} that can not be loaded: {e}")
+            continue
+        buffer.append((os.path.basename(os.path.normpath(path)), arrays))
+        n_records += 1
+        if(len(buffer) >= records_per_shard):
+            flush()
+    flush()
+
+    if(verbose):
+        print("Finished packing %d records into %d shards at %s" % (n_records, shard_id, output_path))
+    return n_records
+
+class AnyMDPShardDataSetBase(AnyMDPDataSetBase):
+    """
+    Drop-in replacement of AnyMDPDataSetBase reading from packed shards
+    file_list keeps (shard_id, record_id) pairs instead of record paths
+    """
+    def __init__(self, directory, time_step, verbose=False):
+        if(verbose):
+            print("\nInitializing shard data set from file: %s..." % directory)
+        directories = []
+        if(isinstance(directory, list)):
+            directories.extend(directory)
+        else:
+            directories.append(directory)
+
+        self.shard_list = []
+        self.record_index = []
+        self.file_list = []
+        for d in directories:
+            for file in sorted(os.listdir(d)):
+                if(not file.endswith(".json")):
+                    continue
+                with open(os.path.join(d, file), "r") as f:
+                    index = json.load(f)
+                if(index.get("version", -1) != SHARD_VERSION):
+                    print(f"[Warning] Skip shard {file} with unsupported version {index.get('version')}")
+                    continue
+                shard_id = len(self.shard_list)
+                self.shard_list.append(os.path.join(d, file[:-len(".json")] + ".bin"))
+                self.record_index.append(index["records"])
+                self.file_list.extend([(shard_id, i) for i in range(len(index["records"]))])
+
+        self.time_step = time_step
+        # Opened lazily so that the memory maps are created in each worker process
+        self._buffers = dict()
+
+        if(verbose):
+            print("...finished initializing data set, number of samples: %s\n" % len(self.file_list))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffers"] = dict()
+        return state
+
+    def _buffer(self, shard_id):
+        if(shard_id not in self._buffers):
+            # copy-on-write mapping: pages are shared with the page cache, the arrays stay writable for torch
+            self._buffers[shard_id] = np.memmap(self.shard_list[shard_id], dtype=np.uint8, mode='c')
+        return self._buffers[shard_id]
+
+    def _load_and_process_data(self, path):
+        shard_id, record_id = path
+        try:
+            record = self.record_index[shard_id][record_id]
+            buf = self._buffer(shard_id)
+            max_t = record["length"]
+
+            if(self.time_step > max_t):
+                print(f'[Warning] Load samples from {record["name"]} that is shorter ({max_t}) than specified time step ({self.time_step})')
+                n_e = max_t
+            else:
+                n_e = self.time_step
+
+            data = []
+            for field in ANYMDP_FIELDS:
+                offset, dtype, shape = record["arrays"][field]
+                dtype = np.dtype(dtype)
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                arr = buf[offset:offset + nbytes].view(dtype).reshape(shape)
+                data.append(arr[:n_e])
+            return tuple(data)
+        except Exception as e:
+            print(f"Unexpected reading error founded when loading {path} from {self.shard_list[shard_id]}: {e}")
+            return (None,) * 6
+
+class AnyMDPShardDataSet(AnyMDPShardDataSetBase, AnyMDPDataSet):
+    pass
+
+class AnyMDPv2ShardDataSet(AnyMDPShardDataSetBase, AnyMDPv2DataSet):
+    pass
+
+class AnyMDPShardDataSetContinuousState(AnyMDPShardDataSetBase, AnyMDPDataSetContinuousState):
+    pass
+
+class AnyMDPShardDataSetContinuousStateAction(AnyMDPShardDataSetBase, AnyMDPDataSetContinuousStateAction):
+    pass
+
+# Convert per-record directories into shards
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, nargs='+', help="directories containing AnyMDP records (record-xxxx/*.npy)")
+    parser.add_argument("--output_path", type=str, required=True, help="output directory, shards are stored as output_path/shard-xxxxx.{bin,json}")
+    parser.add_argument("--records_per_shard", type=int, default=1024, help="number of records packed in each shard, default:1024")
+    args = parser.parse_args()
+
+    convert_anymdp_records(args.input_path, args.output_path,
+                           records_per_shard=args.records_per_shard, verbose=True)
+    dataset = AnyMDPShardDataSet(args.output_path, 1280, verbose=True)
+    if(len(dataset) > 0):
+        obs, pro, tag, bact, rwd, lact = dataset[0]
+        print(obs.shape, bact.shape, lact.shape, rwd.shape)
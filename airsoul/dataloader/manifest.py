@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import glob
+import time
+import fcntl
+import socket
+import hashlib
+import argparse
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Persisted manifest of the records under a data root
+
+A manifest lists every record of a root with {"path", "length", "modality", "valid", "checksum"(, "error")}:
+    path: relative to the root
+    length: number of time steps (number of sequences for "lm")
+    checksum: hash of the names, sizes and modification times of the files of the record
+Only the array headers are read to build it, the records are probed in parallel.
+It is rebuilt incrementally: records whose checksum did not change are not probed again.
+Manifests are kept in AIRSOUL_MANIFEST_DIR (default: ~/.cache/airsoul/manifest), not in the data roots,
+the first process builds it under a file lock while the other ranks wait and read the result.
+Within a run (see mark_run) the manifest is refreshed once, the other ranks reuse it without listing the records again.
+"""
+
+MANIFEST_VERSION = 1
+# Identifier of the current run, inherited by all its ranks
+RUN_ID_ENV = "AIRSOUL_RUN_ID"
+MANIFEST_DIR = os.environ.get("AIRSOUL_MANIFEST_DIR", os.path.join(os.path.expanduser("~"), ".cache", "airsoul", "manifest"))
+
+def npy_shape(file_path):
+    """
+    Shape of a .npy array from its header, raise if the file is truncated
+    """
+    with open(file_path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if(version == (1, 0)):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+        if(not dtype.hasobject):
+            expected = f.tell() + int(np.prod(shape)) * dtype.itemsize
+            if(os.path.getsize(file_path) < expected):
+                raise ValueError(f"truncated array file {file_path}")
+    return shape
+
+def _list_subdirs(root):
+    return [os.path.join(root, name) for name in sorted(os.listdir(root)) if os.path.isdir(os.path.join(root, name))]
+
+def _list_mazeworld(root):
+    # A folder is either a record (contains observations.npy) or a group of records
+    records = []
+    for folder_path in _list_subdirs(root):
+        if(os.path.exists(os.path.join(folder_path, "observations.npy"))):
+            records.append(folder_path)
+        else:
+            records.extend(_list_subdirs(folder_path))
+    return records
+
+def _list_files(root):
+    return [os.path.join(root, name) for name in sorted(os.listdir(root)) if os.path.isfile(os.path.join(root, name))]
+
+def _probe_mazeworld(path):
+    modality = "maze" if "maze" in path else "procthor"
+    length = npy_shape(path + "/actions_behavior_id.npy")[0]
+    n_obs = npy_shape(path + "/observations.npy")[0]
+    for name in ["actions_label_id", "actions_behavior_val", "actions_label_val", "rewards"]:
+        n = npy_shape(path + f"/{name}.npy")[0]
+        if(modality == "maze" and n != length):
+            raise ValueError(f"shape mismatch: {name}, expected {length}, got {n}")
+    npy_shape(path + "/commands.npy")
+    if(modality == "maze" and n_obs != length + 1):
+        raise ValueError(f"shape mismatch: observations, expected {length + 1}, got {n_obs}")
+    return modality, length
+
+def _probe_anymdp(path):
+    length = min(npy_shape(path + f"/{name}.npy")[0] for name in
+                ["observations", "prompts", "tags", "actions_behavior", "rewards", "actions_label"])
+    return "anymdp", length
+
+def _probe_multiagent(path):
+    length = npy_shape(path + "/rewards.npy")[0]
+    for name in ["observations", "actions_behavior", "actions_label", "tags"]:
+        files = glob.glob(os.path.join(path, f"{name}_*.npy"))
+        if(len(files) < 1):
+            raise ValueError(f"missing {name}_*.npy")
+        for file in files:
+            length = min(length, npy_shape(file)[0])
+    for name in ["resets", "obs_graph", "agent_graph"]:
+        npy_shape(path + f"/{name}.npy")
+    return "multiagent", length
+
+def _probe_lm(path):
+    return "lm", npy_shape(path)[0]
+
+MANIFEST_KINDS = {
+    "mazeworld": (_list_mazeworld, _probe_mazeworld),
+    "anymdp": (_list_subdirs, _probe_anymdp),
+    "multiagent": (_list_subdirs, _probe_multiagent),
+    "lm": (_list_files, _probe_lm),
+}
+
+def _checksum(path):
+    sha = hashlib.sha1()
+    if(os.path.isdir(path)):
+        files = sorted((entry.name, entry.stat()) for entry in os.scandir(path) if entry.is_file())
+    else:
+        files = [(os.path.basename(path), os.stat(path))]
+    for name, st in files:
+        sha.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return sha.hexdigest()[:16]
+
+def _probe(root, path, checksum, probe):
+    entry = {"path": os.path.relpath(path, root), "checksum": checksum}
+    try:
+        entry["modality"], entry["length"] = probe(path)
+        entry["length"] = int(entry["length"])
+        entry["valid"] = True
+    except Exception as e:
+        entry["modality"], entry["length"], entry["valid"] = None, 0, False
+        entry["error"] = str(e)
+    return entry
+
+@contextmanager
+def _file_lock(lock_path):
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def mark_run(run_id=None):
+    """
+    Set the run identifier for the processes spawned afterwards (call it before spawning the ranks),
+    an identifier set by the launcher is kept
+    """
+    if(RUN_ID_ENV not in os.environ):
+        os.environ[RUN_ID_ENV] = run_id if run_id is not None else f"{socket.gethostname()}-{os.getpid()}-{time.time()}"
+    return os.environ[RUN_ID_ENV]
+
+def manifest_path(root, kind):
+    root = os.path.abspath(root)
+    return os.path.join(MANIFEST_DIR, "%s-%s.json" % (kind, hashlib.sha1(root.encode()).hexdigest()[:16]))
+
+def _update_manifest(root, kind, output, num_workers, verbose):
+    list_records, probe = MANIFEST_KINDS[kind]
+    run_id = os.environ.get(RUN_ID_ENV)
+    old_records = dict()
+    old_run_id = None
+    if(output is not None and os.path.exists(output)):
+        try:
+            with open(output, "r") as f:
+                manifest = json.load(f)
+            if(manifest.get("version") == MANIFEST_VERSION):
+                old_run_id = manifest.get("run_id")
+                # Already refreshed by another rank of this run
+                if(run_id is not None and old_run_id == run_id):
+                    return manifest["records"]
+                old_records = {entry["path"]: entry for entry in manifest["records"]}
+        except Exception as e:
+            print(f"[Warning] Rebuild manifest {output} that can not be read: {e}")
+
+    paths = list_records(root)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        checksums = list(pool.map(_checksum, paths))
+        records = [old_records.get(os.path.relpath(path, root)) for path in paths]
+        stale = [i for i, (entry, checksum) in enumerate(zip(records, checksums))
+                 if entry is None or entry["checksum"] != checksum]
+        for i, entry in zip(stale, pool.map(lambda i: _probe(root, paths[i], checksums[i], probe), stale)):
+            records[i] = entry
+
+    if(verbose and len(stale) > 0):
+        print(f"...probed {len(stale)} new or modified records of {len(paths)} in {root}")
+    if(output is not None and (len(stale) > 0 or len(old_records) != len(records) or old_run_id != run_id)):
+        # Write and rename, readers never see a partial manifest
+        with open(output + ".tmp", "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "root": root, "kind": kind, "run_id": run_id, "records": records}, f)
+        os.replace(output + ".tmp", output)
+    return records
+
+def load_manifest(directory, kind, num_workers=None, verbose=False):
+    """
+    Records of a directory or a list of directories, building or updating the persisted manifests if necessary
+    kind: "mazeworld", "anymdp", "multiagent" or "lm"
+    Returns a list of entries with absolute "path", invalid records are kept with valid=False
+    """
+    if(kind not in MANIFEST_KINDS):
+        raise ValueError(f"Unknown manifest kind {kind}, expect one of {list(MANIFEST_KINDS.keys())}")
+    directories = []
+    if(isinstance(directory, list) or isinstance(directory, tuple)):
+        directories.extend(directory)
+    else:
+        directories.append(directory)
+    if(num_workers is None):
+        num_workers = min(32, 4 * (os.cpu_count() or 1))
+
+    records = []
+    for d in directories:
+        root = os.path.abspath(d)
+        output = manifest_path(root, kind)
+        try:
+            os.makedirs(MANIFEST_DIR, exist_ok=True)
+            with _file_lock(output + ".lock"):
+                root_records = _update_manifest(root, kind, output, num_workers, verbose)
+        except OSError as e:
+            print(f"[Warning] Manifest of {root} can not be persisted in {MANIFEST_DIR}: {e}")
+            root_records = _update_manifest(root, kind, None, num_workers, verbose)
+
+        invalid = [entry for entry in root_records if not entry["valid"]]
+        if(len(invalid) > 0):
+            print(f"[Warning] Exclude {len(invalid)} corrupt records in {root}, e.g. {invalid[0]['path']}: {invalid[0]['error']}")
+        records.extend([dict(entry, path=os.path.join(root, entry["path"])) for entry in root_records])
+    return records
+
+def valid_records(directory, kind, verbose=False):
+    return [entry for entry in load_manifest(directory, kind, verbose=verbose) if entry["valid"]]
+
+# Build or update the manifests ahead of training
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", type=str, choices=list(MANIFEST_KINDS.keys()))
+    parser.add_argument("input_path", type=str, nargs='+', help="data roots")
+    parser.add_argument("--num_workers", type=int, default=None, help="number of probing threads")
+    args = parser.parse_args()
+
+    records = load_manifest(args.input_path, args.kind, num_workers=args.num_workers, verbose=True)
+    n_valid = sum(entry["valid"] for entry in records)
+    print(f"{n_valid} valid records, {len(records) - n_valid} corrupt records")
@@ -1,12 +1,44 @@
 import os
 import sys
+import hashlib
 import torch
 import numpy as np
 from numpy import random
 from torch.utils.data import DataLoader, Dataset
+from .manifest import valid_records
+from airsoul.utils.tools import log_warn, log_fatal
 # cut the observation, action, position, reward, BEV, agent, target
 import math
-
+from collections import deque
+
+
+def end_markers(actions_behavior_id, length):
+    """
+    Steps of the 1st, 3rd, 5th... end actions (16) within the first length steps,
+    the end action following each of them closes the black frames and is skipped
+    """
+    ids = np.asarray(actions_behavior_id)[:length]
+    ends = np.flatnonzero(ids.reshape(ids.shape[0], -1)[:, 0] == 16)
+    return ends[0::2]
+
+def gather_splits(arrays, starts, ends):
+    """
+    Concatenate arr[n_b:n_e + 1] over the splits (n_b, n_e) for each array, clipped at the end as slicing does
+    """
+    outputs = []
+    for arr in arrays:
+        if arr is None:
+            outputs.append(np.array([]))
+            continue
+        e = np.minimum(np.asarray(ends, dtype=np.int64) + 1, len(arr))
+        b = np.minimum(np.asarray(starts, dtype=np.int64), e)
+        counts = e - b
+        if counts.sum() < 1:
+            outputs.append(np.array([]))
+            continue
+        index = np.arange(counts.sum()) + np.repeat(b - (np.cumsum(counts) - counts), counts)
+        outputs.append(np.asarray(arr)[index])
+    return tuple(outputs)
 
 def expend_data(
     observations,
@@ -19,75 +51,26 @@ def expend_data(
     actions_behavior_prior,
     percentage=2,
 ):
-
-    def expend_delta(n_start, n_end, percentage):
-        fractional_part, integer_part = math.modf(percentage)
-        _split = []
-        for i in range(int(integer_part)):
-            _split.append([n_start, n_end])
-        delta = int((n_end - n_start) * fractional_part)
-        _split.append([n_end - delta, n_end])
-        return _split
-
-    split_id = []  # select the start and end of the data
-    n_start = 0
-    n_end = 0
-
-    flag = False  # flag为True: 下一个end没用
-    for i in range(len(observations)):
-        if actions_behavior_id[i] == 16:
-            if flag:
-                flag = False
-                continue
-            flag = True
-
-            n_end = i+1
-            split_id.extend(expend_delta(n_start, n_end, percentage))
-            n_start = n_end
-
-    # print("split_id",split_id)
-    (
-        _obs_arr,
-        _bact_id_arr,
-        _lact_id_arr,
-        _bact_val_arr,
-        _lact_val_arr,
-        _reward_arr,
-        _command_arr,
-        _bact_prior_arr
-    ) = ([], [], [], [], [], [], [], [])
-
-    for split in split_id:
-        n_b = split[0]
-        n_e = split[1]
-
-        _obs_arr.extend(observations[n_b : (n_e + 1)])
-        _bact_id_arr.extend(
-            actions_behavior_id[n_b : n_e + 1]
-        ) 
-        _bact_val_arr.extend(
-            actions_behavior_val[n_b : n_e + 1]
-        ) 
-        _lact_id_arr.extend(actions_label_id[n_b : n_e + 1]) 
-        _lact_val_arr.extend(
-            actions_label_val[n_b : n_e + 1]
-        ) 
-        _reward_arr.extend(rewards[n_b : n_e + 1]) 
-        _command_arr.extend(command[n_b : n_e + 1])
-        if actions_behavior_prior is not None:
-            _bact_prior_arr.extend(actions_behavior_prior[n_b : n_e + 1])
-        
-
-    return (
-        np.array(_obs_arr),
-        np.array(_bact_id_arr),
-        np.array(_bact_val_arr),
-        np.array(_lact_id_arr),
-        np.array(_lact_val_arr),
-        np.array(_reward_arr),
-        np.array(_command_arr),
-        np.array(_bact_prior_arr)
-    )
+    # Each episode is repeated int(percentage) times, followed by its last fractional part
+    ends = end_markers(actions_behavior_id, len(observations)) + 1
+    starts = np.concatenate(([0], ends))[:len(ends)].astype(np.int64)
+    fractional_part, integer_part = math.modf(percentage)
+    repeat = max(int(integer_part), 0)
+    delta = ((ends - starts) * fractional_part).astype(np.int64)
+
+    split_b = np.concatenate((np.repeat(starts[:, None], repeat, axis=1), (ends - delta)[:, None]), axis=1)
+    split_e = np.repeat(ends[:, None], repeat + 1, axis=1)
+
+    return gather_splits(
+        (observations,
+        actions_behavior_id,
+        actions_behavior_val,
+        actions_label_id,
+        actions_label_val,
+        rewards,
+        command,
+        actions_behavior_prior),
+        split_b.reshape(-1), split_e.reshape(-1))
 
 def cut_data(
     observations,
@@ -101,87 +84,30 @@ def cut_data(
     percentage=1,
     time_step=2_000,
 ):
-
-    split_id = []  # select the start and end of the data
-    n_start = 0
-    n_end = 0
-    n_episode = 0
-
-    flag = False  # flag为True: 下一个end没用
-    for i in range(len(observations)):
-        if actions_behavior_id[i] == 16:  # end
-
-            if flag:
-                flag = False
-                continue
-
-            flag = True
-
-            n_episode += 1
-            n_end = i + 1 # 跳过全黑
-
-            delta = n_end - n_start
-            # delta = int((n_end - n_start) * percentage)
-            if delta == 0:
-                delta = 1
-            n_start = n_end - delta
-            split_id.append((n_start, n_end))
-            n_start = n_end+1
-        if n_episode*2 >= time_step:
-            break
-    # print("sum_data(split_id)", sum_data(split_id))
-    split_id = cut_data_(split_id, aim_len=time_step+1)
-    # print("sum_data(split_id)", sum_data(split_id))
-    # print("split_id",split_id)
-    (
-        _obs_arr,
-        _bact_id_arr,
-        _lact_id_arr,
-        _bact_val_arr,
-        _lact_val_arr,
-        _reward_arr,
-        _command_arr,
-        _bact_prior_arr,
-    ) = ([], [], [], [], [], [], [], [])
-
-    for split in split_id:
-        n_b = split[0]
-        n_e = split[1]
-
-        _obs_arr.extend(observations[n_b : (n_e + 1)])
-        _bact_id_arr.extend(
-            actions_behavior_id[n_b : n_e + 1]
-        ) 
-        _bact_val_arr.extend(
-            actions_behavior_val[n_b : n_e + 1]
-        ) 
-        _lact_id_arr.extend(actions_label_id[n_b : n_e + 1]) 
-        _lact_val_arr.extend(
-            actions_label_val[n_b : n_e + 1]
-        ) 
-        _reward_arr.extend(rewards[n_b : n_e + 1]) 
-
-        _command_arr.extend(command[n_b : n_e + 1])
-        if actions_behavior_prior is not None:
-            _bact_prior_arr.extend(actions_behavior_prior[n_b : n_e + 1])
-
-        
-
-    return (
-        np.array(_obs_arr),
-        np.array(_bact_id_arr),
-        np.array(_bact_val_arr),
-        np.array(_lact_id_arr),
-        np.array(_lact_val_arr),
-        np.array(_reward_arr),
-        np.array(_command_arr),
-        np.array(_bact_prior_arr),
-    )
-
-
-
-
-
+    ends = end_markers(actions_behavior_id, len(observations)) + 1
+    # Stop after the episode that reaches time_step / 2 episodes
+    if time_step > 0:
+        ends = ends[:math.ceil(time_step / 2)]
+    elif len(ends) > 0 and ends[0] == 1:
+        ends = ends[:1]
+    else:
+        ends = ends[:0]
+    starts = np.concatenate(([0], ends + 1))[:len(ends)].astype(np.int64)
+    starts = np.where(ends == starts, ends - 1, starts)
+
+    split_id = cut_data_(list(zip(starts.tolist(), ends.tolist())), aim_len=time_step+1)
+    split_id = np.array(split_id, dtype=np.int64).reshape(-1, 2)
+
+    return gather_splits(
+        (observations,
+        actions_behavior_id,
+        actions_behavior_val,
+        actions_label_id,
+        actions_label_val,
+        rewards,
+        command,
+        actions_behavior_prior),
+        split_id[:, 0], split_id[:, 1])
 
 def sum_data(split_id):
     _sum = 0
@@ -192,23 +118,159 @@ def sum_data(split_id):
     return _sum
 
 def cut_data_(split_id,aim_len=2_000):
-    while(sum_data(split_id) != aim_len):
-        for split in split_id:
-            n_b = split[0]
-            n_e = split[1]
-            if n_e - n_b >= 2:
-                split_id.remove(split)
-                split_id.append([n_b+1,n_e])
-            if sum_data(split_id) == aim_len:
-                break
-    return split_id
-
-
+    """
+    Shrink the splits from their beginning, one step at a time, until they cover aim_len steps
+    A split being shrunk is moved to the end of the list and the split after it is skipped for that round,
+    the queue below keeps exactly that order in linear time
+    """
+    n_b = [split[0] for split in split_id]
+    n_e = [split[1] for split in split_id]
+    excess = sum_data(split_id) - aim_len
+    if excess == 0:
+        return split_id
+    reducible = sum(max(e - b - 1, 0) for b, e in zip(n_b, n_e))
+    if excess < 0 or excess > reducible:
+        raise ValueError(f"Can not cut splits of {sum_data(split_id)} steps to {aim_len} steps")
+
+    done = []
+    queue = deque(range(len(split_id)))
+    while True:
+        while queue:
+            k = queue.popleft()
+            if n_e[k] - n_b[k] < 2:
+                done.append(k)
+                continue
+            n_b[k] += 1
+            excess -= 1
+            queue.append(k)
+            if excess == 0:
+                return [(n_b[k], n_e[k]) for k in done + list(queue)]
+            done.append(queue.popleft())
+        queue = deque(done)
+        done = []
+
+def latent_file(path, latent_key):
+    """
+    Precomputed VAE latents of a trajectory, stored next to observations.npy
+    """
+    return os.path.join(path, "latents_%s.npy" % latent_key)
+
+def load_raw_observations(path):
+    """
+    Observations of a trajectory as served by MazeDataSet [T + 1, W, H, C], in the stored (uint8) dtype
+    Convert them to float after slicing, the whole trajectory in float is 4 times larger
+    """
+    if "maze" in path:
+        return torch.from_numpy(np.load(path + '/observations.npy'))
+    obs_arr = torch.from_numpy(np.load(path + "/observations.npy").astype(np.uint8))
+    obs_arr = obs_arr.permute(0, 2, 1, 3)
+    # rotate the image by 90 degrees 
+    return torch.rot90(obs_arr, 2, [1, 2])
+
+PROCTHOR_ARRAYS = ("observations", "actions_behavior_id", "actions_behavior_val", "actions_label_id",
+                   "actions_label_val", "rewards", "command", "actions_behavior_prior")
+
+def preprocess_procthor(path, time_step, fix_end_label=False, length=None, target_fallback=False):
+    """
+    Load a Procthor trajectory and cut (cut_data) or repeat (expend_data) its episodes to the ratio length / len(observations)
+    length: defaults to time_step
+    fix_end_label: relabel the end action (16) of actions_label_id to 17
+    target_fallback: use target.npy as the command when commands.npy is missing
+    """
+    observations = np.load(path + "/observations.npy").astype(np.uint8)
+    actions_behavior_id = np.load(path + "/actions_behavior_id.npy").astype(np.int32)
+    actions_behavior_val = np.load(path + "/actions_behavior_val.npy").astype(np.float32)
+    actions_label_id = np.load(path + "/actions_label_id.npy").astype(np.int32)
+    actions_label_val = np.load(path + "/actions_label_val.npy").astype(np.float32)
+    actions_behavior_prior = None
+    if os.path.exists(path + "/actions_behavior_prior.npy"):
+        actions_behavior_prior = np.load(path + "/actions_behavior_prior.npy").astype(np.int32)
+
+    rewards = np.load(path + "/rewards.npy").astype(np.float32)
+    if os.path.exists(path + "/commands.npy"):
+        command = np.load(path + "/commands.npy").astype(np.uint8)
+    elif target_fallback and os.path.exists(path + "/target.npy"):
+        command = np.load(path + "/target.npy").astype(np.uint8)
+    else:
+        assert False, "WE MUST HAVE COMMAND!, No command found in %s" % path
+
+    if fix_end_label:
+        actions_label_id[actions_label_id[:, 1] == 16, 1] = 17
+
+    arrays = (observations, actions_behavior_id, actions_behavior_val, actions_label_id,
+              actions_label_val, rewards, command, actions_behavior_prior)
+    percent = (time_step if length is None else length) / len(observations)
+    if percent < 1:
+        return cut_data(*arrays, percentage=percent, time_step=time_step)
+    return expend_data(*arrays, percentage=percent)
+
+def procthor_source_checksum(path):
+    """
+    Hash of the names, sizes and modification times of the source arrays of a trajectory (as manifest checksums),
+    the caches and the latents stored next to them are left out
+    """
+    sha = hashlib.sha1()
+    files = sorted((entry.name, entry.stat()) for entry in os.scandir(path)
+                   if entry.is_file() and entry.name.endswith(".npy") and not entry.name.startswith("latents_"))
+    for name, st in files:
+        sha.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return sha.hexdigest()[:16]
+
+def procthor_cache_file(path, tag, time_step):
+    return os.path.join(path, "preprocessed_%s_%d.npz" % (tag, time_step))
+
+def cached_procthor_arrays(path, tag, time_step, preprocess):
+    """
+    Arrays of a Procthor trajectory after cut_data / expend_data
+    Read from the cache written by dump_procthor_cache if it exists and the source arrays did not change since,
+    otherwise preprocess(path) runs on the fly
+    """
+    cache_file = procthor_cache_file(path, tag, time_step)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            if "checksum" in data and str(data["checksum"]) == procthor_source_checksum(path):
+                return tuple(data[key] for key in PROCTHOR_ARRAYS)
+    return preprocess(path)
+
+def dump_procthor_cache(dataset, overwrite=False, verbose=True):
+    """
+    Run the Procthor preprocessing of a ProcthorDataSet / MazeDataSetShort once and store the result,
+    loader workers then only slice and rotate. The cache is keyed by the data set class and its time_step,
+    and records the checksum of the source arrays: a cache of modified arrays is ignored and dumped again
+    """
+    tag = type(dataset).__name__
+    n_dumped = 0
+    for path in dataset.file_list:
+        if "maze" in path:
+            continue
+        cache_file = procthor_cache_file(path, tag, dataset.time_step)
+        checksum = procthor_source_checksum(path)
+        if os.path.exists(cache_file) and not overwrite:
+            with np.load(cache_file) as data:
+                if "checksum" in data and str(data["checksum"]) == checksum:
+                    continue
+        try:
+            arrays = dataset.__preprocess_procthor__(path)
+        except Exception as e:
+            print(f"Unexpected reading error founded when loading {path}: {e}")
+            continue
+        # Write and rename, an interrupted dump never leaves a partial cache
+        with open(cache_file + ".tmp", "wb") as f:
+            np.savez(f, checksum=np.array(checksum), **dict(zip(PROCTHOR_ARRAYS, arrays)))
+        os.replace(cache_file + ".tmp", cache_file)
+        n_dumped += 1
+    if verbose:
+        print(f"Finished preprocessing {n_dumped} trajectories for {tag} with time step {dataset.time_step}")
+    return n_dumped
 
 
 class MazeDataSet(Dataset):
-    def __init__(self, directory, time_step, verbose=False, max_maze=None, folder_verbose=False):
+    """
+    latent_key: if not None, serve the VAE latents in latents_{latent_key}.npy ([T + 1, Z]) instead of the raw observations
+    """
+    def __init__(self, directory, time_step, verbose=False, max_maze=None, folder_verbose=False, latent_key=None):
         self.folder_verbose = folder_verbose
+        self.latent_key = latent_key
         if(verbose):
             print("\nInitializing data set from file: %s..." % directory)
         if folder_verbose:
@@ -220,44 +282,28 @@ class MazeDataSet(Dataset):
         else:
             directories.append(directory)
         self.directories = directories
+        # Records and their lengths come from the manifest (see manifest.py), corrupt records are excluded
+        records = []
         for d in directories:
             print(f"Loading data from {d}")
-            count = 0
-            for folder in os.listdir(d):
-                folder_path = os.path.join(d, folder)
-                if os.path.isdir(folder_path):
-                    single_layer_flag = False
-                    for file in os.listdir(folder_path):
-                        if file == "observations.npy": # while...there must be a observation file right?
-                            single_layer_flag = True
-                            break
-                        if os.path.isdir(os.path.join(folder_path, file)): # if there is a subfolder, then it is not a single layer folder
-                            single_layer_flag = False
-                            break
-                    if max_maze != None and count >= max_maze:
-                        break
-                    if single_layer_flag:
-                        self.file_list.append(folder_path)
-                        count += 1
-                    else:
-                        for subfolder in os.listdir(folder_path):
-                            subfolder_path = os.path.join(folder_path, subfolder)
-                            if os.path.isdir(subfolder_path):
-                                self.file_list.append(subfolder_path)
-                                count += 1
-                                if max_maze != None and count >= max_maze:
-                                    break
-            print(f"Before filtered Loading data from {d} finished, the number of data is {len(self.file_list)}")
-
-        filter_file_list = []
-        for file_path in self.file_list:
-            if "maze" in file_path:
-                filter_file_list.append(file_path)
-                continue
-            actions_behavior_id = np.load(file_path + '/actions_behavior_id.npy')
-            if actions_behavior_id.shape[0] > time_step:
-                filter_file_list.append(file_path)
-        self.file_list = filter_file_list
+            d_records = valid_records(d, "mazeworld", verbose=verbose)
+            if max_maze != None:
+                d_records = d_records[:max_maze]
+            records.extend(d_records)
+            print(f"Before filtered Loading data from {d} finished, the number of data is {len(records)}")
+
+        for record in records:
+            if record["modality"] == "maze" or record["length"] > time_step:
+                self.file_list.append(record["path"])
+
+        if(latent_key is not None):
+            # Records without the latents of this key would be skipped at every fetch
+            n_records = len(self.file_list)
+            self.file_list = [path for path in self.file_list if os.path.exists(latent_file(path, latent_key))]
+            if(len(self.file_list) < 1):
+                log_fatal(f"No record has latents_{latent_key}.npy, run dump_latents.py with the current VAE")
+            if(len(self.file_list) < n_records):
+                log_warn(f"{n_records - len(self.file_list)} of {n_records} records have no latents_{latent_key}.npy, they are excluded")
         
         assert len(self.file_list) > 0, "No data in the data set"
         if len(self.file_list) % 8 != 0:
@@ -292,12 +338,20 @@ class MazeDataSet(Dataset):
     
     def __len__(self):
         return len(self.file_list)
+
+    def __get_observations__(self, path):
+        """
+        Latents in float, or raw observations in their stored dtype
+        """
+        if(self.latent_key is not None):
+            return torch.from_numpy(np.load(latent_file(path, self.latent_key))).float()
+        return load_raw_observations(path)
     
     def __get_maze__(self, index):
         path = self.file_list[index]
         try:
             cmds = np.load(path + '/commands.npy')
-            observations = np.load(path + '/observations.npy')
+            observations = self.__get_observations__(path)
             actions_behavior_id = np.load(path + '/actions_behavior_id.npy')
             actions_label_id = np.load(path + '/actions_label_id.npy')
             actions_behavior_val = np.load(path + '/actions_behavior_val.npy')
@@ -332,7 +386,7 @@ class MazeDataSet(Dataset):
                 cmd_arr = cmd_arr.reshape(cmd_arr.shape[0], -1)
             
             cmd_arr = cmd_arr[n_b:(n_e)]
-            obs_arr = torch.from_numpy(observations[n_b:(n_e + 1)]).float() 
+            obs_arr = observations[n_b:(n_e + 1)].float()
             bact_id_arr = torch.from_numpy(actions_behavior_id[n_b:n_e]).long() 
             lact_id_arr = torch.from_numpy(actions_label_id[n_b:n_e]).long() 
             bact_val_arr = torch.from_numpy(actions_behavior_val[n_b:n_e]).float() 
@@ -349,7 +403,8 @@ class MazeDataSet(Dataset):
 
         path = self.file_list[index]
         try:
-            observations = np.load(path + "/observations.npy").astype(np.uint8)
+            # already permuted and rotated for raw images
+            observations = self.__get_observations__(path)
             actions_behavior_id = np.load(path + "/actions_behavior_id.npy").astype(np.int32)
             actions_behavior_val = np.load(path + "/actions_behavior_val.npy").astype(np.float32)
             actions_label_id = np.load(path + "/actions_label_id.npy").astype(np.int32)
@@ -376,7 +431,7 @@ class MazeDataSet(Dataset):
             n_e = self.time_step
 
             # Ensure that all arrays are of correct dtype
-            obs_arr = torch.from_numpy(observations).float()
+            obs_arr = observations
             bact_id_arr = torch.from_numpy(
                 actions_behavior_id
             ).long() 
@@ -395,10 +450,6 @@ class MazeDataSet(Dataset):
             if actions_behavior_prior is not None and len(actions_behavior_prior) > 0:
                 bact_prior_arr = torch.from_numpy(actions_behavior_prior).float() 
 
-            obs_arr = obs_arr.permute(0, 2, 1, 3)
-            # rotate the image by 90 degrees 
-            obs_arr = torch.rot90(obs_arr, 2, [1, 2])
-
             # obs_arr = torch.rot90(obs_arr, 1, [1, 2])
 
             assert obs_arr[n_b:].shape[0] == self.time_step + 1, f"shape mismatch: obs_arr, expected {self.time_step + 1}, got {obs_arr[n_b:].shape[0]}"
@@ -425,7 +476,7 @@ class MazeDataSet(Dataset):
             return (
                 # cmd_arr, obs_arr, bact_id_arr, lact_id_arr, bact_val_arr, lact_val_arr, reward_arr
                 command_arr[n_b:-1].view(command_arr[n_b:-1].shape[0], -1),
-                obs_arr[n_b:],
+                obs_arr[n_b:].float(),
                 bact_id_arr[n_b:-1], # cut the last 'end'
                 lact_id_arr[n_b:-1, 0], # lact_id_arr[0:self.time_step],
                 bact_val_arr[n_b:-1],
@@ -449,80 +500,24 @@ class MazeDataSet(Dataset):
             print(f"Unexpected reading error founded when loading {path}: {e}")
             return None
 
+    def __preprocess_procthor__(self, path):
+        return preprocess_procthor(path, self.time_step, fix_end_label=True, length=10000)
+
     def __get_procthor__(self, index):
 
         path = self.file_list[index]
         try:
-            observations = np.load(path + "/observations.npy").astype(np.uint8)
-            actions_behavior_id = np.load(path + "/actions_behavior_id.npy").astype(np.int32)
-            actions_behavior_val = np.load(path + "/actions_behavior_val.npy").astype(np.float32)
-            actions_label_id = np.load(path + "/actions_label_id.npy").astype(np.int32)
-            actions_label_val = np.load(path + "/actions_label_val.npy").astype(np.float32)
-            if os.path.exists(path + "/actions_behavior_prior.npy"):
-                actions_behavior_prior = np.load(path + "/actions_behavior_prior.npy").astype(np.int32)
-
-            rewards = np.load(path + "/rewards.npy").astype(np.float32)
-            if os.path.exists(path + "/commands.npy"):
-                command = np.load(path + "/commands.npy").astype(np.uint8)
-            # elif os.path.exists(path + "/target.npy"):
-            #     command = np.load(path + "/target.npy").astype(np.uint8)
-            else:
-                assert False, "WE MUST HAVE COMMAND!, No command found in %s" % path
-                command = np.zeros((len(observations), 16, 16, 3)).astype(np.uint8)
-            
-            # FIXED
-            for i in range(len(actions_label_id)):
-                if actions_label_id[i][1] == 16:
-                    actions_label_id[i][1] = 17
-
-            # print(len(observations))
-            # 1800 length by now
-            percent = self.time_step / len(observations)
-            percent = 10000 / len(observations)
-            if percent < 1:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = cut_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior,
-                    percentage=percent,
-                    time_step=self.time_step,
-                )
-            else:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = expend_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior, # TODO
-                    percentage=percent,
-                )
-
+            # Not cached: __getitem__ serves Procthor records with __get_procthor_short__
+            (
+                observations,
+                actions_behavior_id,
+                actions_behavior_val,
+                actions_label_id,
+                actions_label_val,
+                rewards,
+                command,
+                actions_behavior_prior
+            ) = self.__preprocess_procthor__(path)
 
             # Ensure that all arrays are of correct dtype
             obs_arr = torch.from_numpy(observations).float()
@@ -843,9 +838,7 @@ class MazeDataSetRandomActionTest(Dataset):
                 command = np.zeros((len(observations), 16, 16, 3)).astype(np.uint8)
             
             # FIXED
-            for i in range(len(actions_label_id)):
-                if actions_label_id[i][1] == 16:
-                    actions_label_id[i][1] = 17
+            actions_label_id[actions_label_id[:, 1] == 16, 1] = 17
 
             # print(len(observations))
             # 1800 length by now
@@ -1085,72 +1078,24 @@ class ProcthorDataSet(Dataset):
             return None
     
     
+    def __preprocess_procthor__(self, path):
+        return preprocess_procthor(path, self.time_step)
+
     def __get_procthor__(self, index):
 
         path = self.file_list[index]
         try:
-            observations = np.load(path + "/observations.npy").astype(np.uint8)
-            actions_behavior_id = np.load(path + "/actions_behavior_id.npy").astype(np.int32)
-            actions_behavior_val = np.load(path + "/actions_behavior_val.npy").astype(np.float32)
-            actions_label_id = np.load(path + "/actions_label_id.npy").astype(np.int32)
-            actions_label_val = np.load(path + "/actions_label_val.npy").astype(np.float32)
-            if os.path.exists(path + "/actions_behavior_prior.npy"):
-                actions_behavior_prior = np.load(path + "/actions_behavior_prior.npy").astype(np.int32)
-
-            rewards = np.load(path + "/rewards.npy").astype(np.float32)
-            if os.path.exists(path + "/commands.npy"):
-                command = np.load(path + "/commands.npy").astype(np.uint8)
-            else:
-                assert False, "WE MUST HAVE COMMAND!, No command found in %s" % path
-                command = np.zeros((len(observations), 16, 16, 3)).astype(np.uint8)
-            
-            # print(len(observations))
-
-            percent = self.time_step / len(observations)
-            if percent < 1:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = cut_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior,
-                    percentage=percent,
-                    time_step=self.time_step,
-                )
-            else:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = expend_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior, # TODO
-                    percentage=percent,
-                )
-
+            # Read from the offline cache if it exists (see dump_procthor_cache)
+            (
+                observations,
+                actions_behavior_id,
+                actions_behavior_val,
+                actions_label_id,
+                actions_label_val,
+                rewards,
+                command,
+                actions_behavior_prior
+            ) = cached_procthor_arrays(path, type(self).__name__, self.time_step, self.__preprocess_procthor__)
 
             # Ensure that all arrays are of correct dtype
             obs_arr = torch.from_numpy(observations).float()
@@ -1400,6 +1345,9 @@ class MazeDataSetShort(Dataset):
         except Exception as e:
             print(f"Unexpected reading error founded when loading {path}: {e}")
             return None
+    def __preprocess_procthor__(self, path):
+        return preprocess_procthor(path, self.time_step, target_fallback=True)
+
     def __get_procthor__(self, index):
         cutting_length = self.cutting_length
         true_index = int(index // cutting_length)
@@ -1407,70 +1355,17 @@ class MazeDataSetShort(Dataset):
         assert true_index*cutting_length + overflow == index
         path = self.file_list[true_index]
         try:
-            observations = np.load(path + "/observations.npy").astype(np.uint8)
-            actions_behavior_id = np.load(path + "/actions_behavior_id.npy").astype(np.int32)
-            actions_behavior_val = np.load(path + "/actions_behavior_val.npy").astype(np.float32)
-            actions_label_id = np.load(path + "/actions_label_id.npy").astype(np.int32)
-            actions_label_val = np.load(path + "/actions_label_val.npy").astype(np.float32)
-            if os.path.exists(path + "/actions_behavior_prior.npy"):
-                actions_behavior_prior = np.load(path + "/actions_behavior_prior.npy").astype(np.int32)
-
-            rewards = np.load(path + "/rewards.npy").astype(np.float32)
-            if os.path.exists(path + "/commands.npy"):
-                command = np.load(path + "/commands.npy").astype(np.uint8)
-            elif os.path.exists(path + "/target.npy"):
-                command = np.load(path + "/target.npy").astype(np.uint8)
-            else:
-                assert False, "WE MUST HAVE COMMAND!, No command found in %s" % path
-                command = np.zeros((len(observations), 16, 16, 3)).astype(np.uint8)
-            
-            # print(len(observations))
-
-            percent = self.time_step / len(observations)
-            if percent < 1:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = cut_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior,
-                    percentage=percent,
-                    time_step=self.time_step,
-                )
-            else:
-                (
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior
-                ) = expend_data(
-                    observations,
-                    actions_behavior_id,
-                    actions_behavior_val,
-                    actions_label_id,
-                    actions_label_val,
-                    rewards,
-                    command,
-                    actions_behavior_prior, # TODO
-                    percentage=percent,
-                )
-
+            # Read from the offline cache if it exists (see dump_procthor_cache)
+            (
+                observations,
+                actions_behavior_id,
+                actions_behavior_val,
+                actions_label_id,
+                actions_label_val,
+                rewards,
+                command,
+                actions_behavior_prior
+            ) = cached_procthor_arrays(path, type(self).__name__, self.time_step, self.__preprocess_procthor__)
 
             # Ensure that all arrays are of correct dtype
             obs_arr = torch.from_numpy(observations).float()
@@ -3,11 +3,18 @@ import sys
 import random
 import torch
 import numpy as np
+from collections import OrderedDict
 from torch.utils.data import DataLoader, Dataset
+from .manifest import valid_records
 
 
 class LMDataSet(Dataset):
-    def __init__(self, directory, file_size, verbose=False):
+    """
+    Every file is a (N, L) array of token sequences, a sample is one row
+    Files are memory-mapped and at most max_open_files maps are kept per worker (least recently used are closed),
+    a row is read as a view so only its pages are loaded from the disk
+    """
+    def __init__(self, directory, file_size, max_open_files=64, verbose=False):
         if(verbose):
             print("\nInitializing data set from file: %s..." % directory)
         self.file_list = []
@@ -18,18 +25,39 @@ class LMDataSet(Dataset):
         else:
             directories.append(directory)
         for d in directories:
-            file_list = os.listdir(d)
-            self.file_list.extend([os.path.join(d, file) for file in file_list])
+            for record in valid_records(d, "lm", verbose=verbose):
+                if(record["length"] < self.file_size):
+                    print(f'[Warning] Skip {record["path"]} that has fewer sequences ({record["length"]}) than file_size ({self.file_size})')
+                    continue
+                self.file_list.append(record["path"])
         self.data_list = []
         for file in self.file_list:
             self.data_list.extend([(file, i) for i in range(self.file_size)])
         if(verbose):
-            print("...finished initializing data set, number of samples: %s\n" % len(self.index_inverse_list))
+            print("...finished initializing data set, number of samples: %s\n" % len(self.data_list))
+        self.max_open_files = max(1, max_open_files)
+        # Opened lazily so that the memory maps are created in each worker process
+        self._handles = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        return state
+
+    def _open(self, path):
+        if(path in self._handles):
+            self._handles.move_to_end(path)
+        else:
+            # copy-on-write mapping: pages are shared with the page cache, the rows stay writable for torch
+            self._handles[path] = np.load(path, mmap_mode='c')
+            while(len(self._handles) > self.max_open_files):
+                self._handles.popitem(last=False)
+        return self._handles[path]
 
     def __getitem__(self, index):
         path, sub_index = self.data_list[index]
-        data = np.load(path)
-        return torch.from_numpy(data[sub_index][:-1]).to(torch.int64), torch.from_numpy(data[sub_index][1:]).to(torch.int64)
+        data = self._open(path)[sub_index]
+        return torch.from_numpy(data[:-1]).to(torch.int64), torch.from_numpy(data[1:]).to(torch.int64)
 
     def __len__(self):
         return len(self.data_list)
@@ -5,6 +5,7 @@ import random
 import torch
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
+from .manifest import valid_records
 
 class MultiAgentDataSet(Dataset):
     """
@@ -39,8 +40,7 @@ class MultiAgentDataSet(Dataset):
         else:
             directories.append(directory)
         for d in directories:
-            file_list = os.listdir(d)
-            self.file_list.extend([os.path.join(d, file) for file in file_list])
+            self.file_list.extend([record["path"] for record in valid_records(d, "multiagent", verbose=verbose)])
             
         self.time_step = time_step
         self.max_obs = max_obs
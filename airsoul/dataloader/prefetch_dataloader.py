@@ -1,14 +1,24 @@
 import os
 import sys
+import time
 import random
 import torch
 import itertools
 import queue
 import numpy as np
 import multiprocessing
+from multiprocessing import shared_memory
+from collections import namedtuple
 from torch.utils.data import DataLoader, Dataset
 from torch.utils.data.dataloader import default_collate as torch_collate
 from airsoul.utils.tools import Logger, log_progress, log_debug, log_warn, log_fatal
+from airsoul.utils.checkpoint import set_rng_states
+
+class DataLoaderError(RuntimeError):
+    """
+    Unrecoverable failure of the data loading, it is not retried as an invalid sample
+    """
+    pass
 
 class BaseDataLoader(DataLoader):
     def __init__(self, dataset, rank=0, world_size=1, batch_size=4, collate_fn=torch_collate):
@@ -22,14 +32,44 @@ class BaseDataLoader(DataLoader):
         self.local_index = 0
         self.data_volume = len(self.dataset)
         self.length = (self.data_volume - 1) // (self.batch_size * self.world_size) + 1
+        self.resume_state = None
 
-    def __iter__(self):
+    def state_dict(self):
+        """
+        Epoch (shuffler seed) and position of this rank
+        """
+        return {"iter": self.iter, "index": self.index, "local_index": self.local_index}
+
+    def load_state_dict(self, state, rng_states=None):
+        """
+        The next iteration continues the saved epoch from the saved position,
+        if that epoch was completed the next iteration starts the following epoch
+        rng_states: global random states restored once the shuffler is drawn, as they were when saving
+        """
+        if(state["local_index"] < self.length):
+            self.iter = state["iter"] - 1
+            self.resume_state = dict(state, rng_states=rng_states)
+        else:
+            self.iter = state["iter"]
+            if(rng_states is not None):
+                set_rng_states(rng_states)
+
+    def start_epoch(self):
         self.index = self.rank
         self.local_index = 0
         # Set the random shuffler for the data loader
         self.iter += 1
         torch.manual_seed(self.iter)
         self.index_shuffler = torch.randperm(self.data_volume).tolist()
+        if(self.resume_state is not None):
+            self.index = self.resume_state["index"]
+            self.local_index = self.resume_state["local_index"]
+            if(self.resume_state["rng_states"] is not None):
+                set_rng_states(self.resume_state["rng_states"])
+            self.resume_state = None
+
+    def __iter__(self):
+        self.start_epoch()
         return self
 
     def __next__(self):
@@ -42,6 +82,8 @@ class BaseDataLoader(DataLoader):
             # In case the data is invalid, fetch further data
             try:
                 sub_data = self.get()
+            except DataLoaderError:
+                raise
             except Exception as e:
                 log_warn("Error fetching data from dataset: ", e)
                 continue
@@ -59,14 +101,121 @@ class BaseDataLoader(DataLoader):
     def __len__(self):
         return self.length
 
-def worker_fn(dataset, length, index_queue, output_queue):
+SHM_ALIGNMENT = 64
+# The slots of a loader may take at most this fraction of the free space of /dev/shm,
+# which is shared with the other ranks of the node
+SHM_MAX_FRACTION = 0.5
+
+def shm_free_bytes():
+    """
+    Free bytes of the file system backing the shared memory, None if unknown
+    SharedMemory(create=True) succeeds beyond that capacity, writing past it kills the process with SIGBUS
+    """
+    try:
+        stat = os.statvfs("/dev/shm")
+    except (OSError, AttributeError):
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+# Handle passed through the output queue in place of a sample written into a shared-memory slot,
+# token identifies the worker process that wrote it
+SharedSlot = namedtuple("SharedSlot", ["slot_id", "meta", "token"])
+# Owner of a slot that is free or held by the main process
+SLOT_UNOWNED = 0
+
+def sample_nbytes(sample):
+    """
+    Bytes required to hold a sample in a shared-memory slot, None if it can not be placed there
+    """
+    if(sample is None):
+        return 0
+    elif(isinstance(sample, torch.Tensor)):
+        return (sample.numel() * sample.element_size() + SHM_ALIGNMENT - 1) // SHM_ALIGNMENT * SHM_ALIGNMENT
+    elif(isinstance(sample, tuple) or isinstance(sample, list)):
+        nbytes = 0
+        for sub in sample:
+            sub_nbytes = sample_nbytes(sub)
+            if(sub_nbytes is None):
+                return None
+            nbytes += sub_nbytes
+        return nbytes
+    return None
+
+def pack_sample(sample, buf, offset=0):
+    """
+    Copy the tensors of a (nested tuple / list of) tensor sample into buf
+    Returns the meta data required to rebuild the sample and the next free offset
+    """
+    if(sample is None):
+        return ("n",), offset
+    elif(isinstance(sample, torch.Tensor)):
+        sample = sample.detach().cpu()
+        if(sample.numel() > 0):
+            torch.frombuffer(buf, dtype=sample.dtype, count=sample.numel(), offset=offset).view(sample.shape).copy_(sample)
+        meta = ("t", sample.dtype, tuple(sample.shape), offset)
+        return meta, offset + sample_nbytes(sample)
+    else:
+        metas = []
+        for sub in sample:
+            sub_meta, offset = pack_sample(sub, buf, offset)
+            metas.append(sub_meta)
+        return (("l" if isinstance(sample, list) else "u"), metas), offset
+
+def unpack_sample(meta, buf):
+    """
+    Rebuild the sample as views over buf, no data is copied
+    """
+    if(meta[0] == "n"):
+        return None
+    elif(meta[0] == "t"):
+        _, dtype, shape, offset = meta
+        numel = 1
+        for n in shape:
+            numel *= n
+        if(numel < 1):
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(buf, dtype=dtype, count=numel, offset=offset).view(shape)
+    elif(meta[0] == "l"):
+        return [unpack_sample(sub, buf) for sub in meta[1]]
+    else:
+        return tuple([unpack_sample(sub, buf) for sub in meta[1]])
+
+def transport_sample(sample, slots, free_slots, slot_owner=None, token=SLOT_UNOWNED):
+    """
+    Write the sample into a free shared-memory slot and return its handle
+    Falls back to returning the sample itself (pickled through the queue) if no slot is free
+    or the sample does not fit, so workers never block on slots
+    slot_owner: shared array where the slot is marked as held by token until the main process receives it,
+        so the slots of a worker that dies can be reclaimed
+    """
+    if(slots is None or sample is None):
+        return sample
+    nbytes = sample_nbytes(sample)
+    if(nbytes is None):
+        return sample
+    try:
+        slot_id = free_slots.get_nowait()
+    except queue.Empty:
+        return sample
+    if(slot_owner is not None):
+        slot_owner[slot_id] = token
+    if(nbytes > slots[slot_id].size):
+        if(slot_owner is not None):
+            slot_owner[slot_id] = SLOT_UNOWNED
+        free_slots.put(slot_id)
+        return sample
+    meta, _ = pack_sample(sample, slots[slot_id].buf)
+    return SharedSlot(slot_id, meta, token)
+
+def worker_fn(worker_id, dataset, length, index_queue, output_queue, slots=None, free_slots=None,
+              slot_owner=None, token=SLOT_UNOWNED):
     while True:
-        try:
-            index = index_queue.get(timeout=0)
-        except queue.Empty:
-            continue
-        if index is None:
+        # Block until a (sequence, index) request or the shutdown sentinel (None) arrives,
+        # idle workers do not consume CPU
+        request = index_queue.get()
+        if request is None:
             break
+        seq, index = request
 
         if index > length - 1:
             # Allowing fetch index to exceed max length to accommodate certain mistake
@@ -74,10 +223,10 @@ def worker_fn(dataset, length, index_queue, output_queue):
         else:
             real_idx = index
         try:
-            output_queue.put((real_idx, dataset[real_idx]))
+            output_queue.put((worker_id, seq, transport_sample(dataset[real_idx], slots, free_slots, slot_owner, token)))
         except Exception as e:
             log_warn(f"DataLoader:unexpected error when getting {real_idx}:{e}")
-            output_queue.put((real_idx, None))
+            output_queue.put((worker_id, seq, None))
 
 class PrefetchDataLoader(BaseDataLoader):
     def __init__(
@@ -89,7 +238,29 @@ class PrefetchDataLoader(BaseDataLoader):
         num_workers=2,
         prefetch_batches=2,
         collate_fn=torch_collate,
+        use_shared_memory=False,
+        shm_slot_bytes=None,
+        shm_num_slots=None,
+        supervise_interval=1.0,
+        max_respawns=3,
+        ordered=True,
+        reorder_capacity=None,
     ):
+        """
+        use_shared_memory: workers write samples into preallocated shared-memory slots and only pass slot handles
+            through the output queue; slots are recycled once collate_fn has consumed the batch, so collate_fn
+            must copy the data (torch default_collate does)
+        shm_slot_bytes: size of each slot, by default estimated from the first sample of the dataset
+        shm_num_slots: number of slots, by default covers the reorder window plus one batch;
+            shared memory is disabled if the slots do not fit into the free space of /dev/shm
+        supervise_interval: seconds between liveness checks of the workers while waiting for data,
+            dead workers are respawned and their pending indices are dispatched again
+        max_respawns: a sample that kills its worker more than max_respawns times raises DataLoaderError
+        ordered: deliver samples in the order of the shuffler; if False, deliver whichever sample is ready first,
+            which is sufficient for training since the shuffler is random anyway
+        reorder_capacity: maximum number of samples requested but not yet delivered, bounding the reorder buffer;
+            workers idle once the window is full. Defaults to prefetch_batches * batch_size
+        """
         super().__init__(dataset, 
             batch_size=batch_size, 
             rank=rank, 
@@ -99,82 +270,275 @@ class PrefetchDataLoader(BaseDataLoader):
         self.num_workers = num_workers
         self.prefetch_batches = prefetch_batches
         self.output_queue = multiprocessing.Queue()
-        self.index_queues = []
-        self.workers = []
+        self.index_queues = [None] * num_workers
+        self.workers = [None] * num_workers
+        # {sequence: index} dispatched to each worker whose outputs have not arrived yet
+        self.inflight = [dict() for _ in range(num_workers)]
         self.worker_cycle = itertools.cycle(range(num_workers))
-        self.cache = {}
-
-        for _ in range(num_workers):
-            index_queue = multiprocessing.Queue()
-            worker = multiprocessing.Process(
-                target=worker_fn, args=(self.dataset, self.data_volume, index_queue, self.output_queue)
-            )
-            worker.daemon = True
-            worker.start()
-            self.workers.append(worker)
-            self.index_queues.append(index_queue)
+        self.supervise_interval = supervise_interval
+        self.max_respawns = max_respawns
+        # {sequence: respawns} of the samples pending when their worker died
+        self.respawns = dict()
+        self.ordered = ordered
+        if(reorder_capacity is None):
+            reorder_capacity = prefetch_batches * batch_size
+        self.reorder_capacity = max(reorder_capacity, 1)
+        # Every request carries a sequence number increasing across epochs
+        # Ordered mode delivers sequences consume_seq, consume_seq + 1, ... through the reorder buffer
+        self.dispatch_seq = 0
+        self.consume_seq = 0
+        self.reorder_buffer = {}
+
+        self.slots = None
+        self.free_slots = None
+        self.slot_owner = None
+        self.used_slots = []
+        # Every worker process gets a new token, marking the slots it holds
+        self.worker_tokens = [SLOT_UNOWNED] * num_workers
+        self.spawn_count = 0
+        if(use_shared_memory):
+            if(shm_num_slots is None):
+                shm_num_slots = self.reorder_capacity + batch_size
+            self.init_shared_memory(shm_slot_bytes, shm_num_slots)
+
+        for worker_id in range(num_workers):
+            self.spawn_worker(worker_id)
+        self.closed = False
+
+    def spawn_worker(self, worker_id):
+        index_queue = multiprocessing.Queue()
+        self.spawn_count += 1
+        self.worker_tokens[worker_id] = self.spawn_count
+        worker = multiprocessing.Process(
+            target=worker_fn, args=(worker_id, self.dataset, self.data_volume, index_queue, self.output_queue,
+                                    self.slots, self.free_slots, self.slot_owner, self.spawn_count)
+        )
+        worker.daemon = True
+        worker.start()
+        self.workers[worker_id] = worker
+        self.index_queues[worker_id] = index_queue
+
+    def supervise(self):
+        """
+        Respawn dead workers and dispatch the indices they were holding to the new ones,
+        the shared-memory slots a dead worker was holding are returned to the free slots
+        """
+        for worker_id, worker in enumerate(self.workers):
+            if(worker.is_alive()):
+                continue
+            log_warn(f"DataLoader:worker {worker_id} exited unexpectedly (exitcode={worker.exitcode}), respawning...")
+            # Outputs still in the feeder thread of a killed worker are lost,
+            # so every pending sample of the worker is a suspect
+            for seq in self.inflight[worker_id]:
+                self.respawns[seq] = self.respawns.get(seq, 0) + 1
+            suspects = [index for seq, index in self.inflight[worker_id].items() if self.respawns[seq] > self.max_respawns]
+            if(len(suspects) > 0):
+                raise DataLoaderError(f"DataLoader:worker {worker_id} died more than {self.max_respawns} times " +
+                                      f"while loading one of the samples {suspects} (exitcode={worker.exitcode})")
+            self.index_queues[worker_id].close()
+            self.index_queues[worker_id].cancel_join_thread()
+            self.reclaim_slots(self.worker_tokens[worker_id])
+            self.spawn_worker(worker_id)
+            for seq, index in self.inflight[worker_id].items():
+                self.index_queues[worker_id].put((seq, index))
+
+    def dispatch(self, index):
+        worker_id = next(self.worker_cycle)
+        self.inflight[worker_id][self.dispatch_seq] = index
+        self.index_queues[worker_id].put((self.dispatch_seq, index))
+        self.dispatch_seq += 1
+
+    def fetch(self, timeout=60):
+        """
+        Wait for the next output of any worker, checking the workers every supervise_interval seconds
+        Outputs that are no longer expected (previous epochs, duplicates after a respawn) are discarded
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                worker_id, seq, data = self.output_queue.get(timeout=self.supervise_interval)
+            except queue.Empty:
+                self.supervise()
+                if(time.time() > deadline):
+                    raise DataLoaderError(f"DataLoader:no data from the workers in {timeout} seconds")
+                continue
+            if(isinstance(data, SharedSlot)):
+                if(self.slot_owner[data.slot_id] != data.token):
+                    # The writer died before the handle arrived and its slot was reclaimed
+                    continue
+                self.slot_owner[data.slot_id] = SLOT_UNOWNED
+            if(seq not in self.inflight[worker_id]):
+                self.discard(data)
+                continue
+            del self.inflight[worker_id][seq]
+            self.respawns.pop(seq, None)
+            return seq, data
+
+    def init_shared_memory(self, slot_bytes, num_slots):
+        if(slot_bytes is None):
+            try:
+                slot_bytes = sample_nbytes(self.dataset[0])
+            except Exception as e:
+                log_warn(f"DataLoader:failed to probe sample size for shared memory:{e}")
+                slot_bytes = None
+            if(slot_bytes is None or slot_bytes < 1):
+                log_warn("DataLoader:unable to estimate sample size, shared memory transport disabled")
+                return
+            # Leave room for samples larger than the probed one
+            slot_bytes = slot_bytes * 5 // 4 + SHM_ALIGNMENT
+        free_bytes = shm_free_bytes()
+        if(free_bytes is not None and slot_bytes * num_slots > free_bytes * SHM_MAX_FRACTION):
+            log_warn(f"DataLoader:shared memory slots ({num_slots} x {slot_bytes} bytes) exceed " +
+                     f"{SHM_MAX_FRACTION} of the free space of /dev/shm ({free_bytes} bytes), shared memory transport disabled")
+            return
+        try:
+            self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(num_slots)]
+        except Exception as e:
+            log_warn(f"DataLoader:failed to allocate shared memory ({num_slots} x {slot_bytes} bytes):{e}, " +
+                     "shared memory transport disabled")
+            self.release_shared_memory()
+            return
+        self.free_slots = multiprocessing.Queue()
+        self.slot_owner = multiprocessing.Array("l", num_slots, lock=False)
+        for slot_id in range(num_slots):
+            self.free_slots.put(slot_id)
+
+    def reclaim_slots(self, token):
+        """
+        Return the slots held by the worker process of token, written or not, to the free slots
+        """
+        if(self.slot_owner is None):
+            return
+        for slot_id in range(len(self.slots)):
+            if(self.slot_owner[slot_id] == token):
+                self.slot_owner[slot_id] = SLOT_UNOWNED
+                self.free_slots.put(slot_id)
+
+    def release_shared_memory(self):
+        if(self.slots is None):
+            return
+        for slot in self.slots:
+            try:
+                slot.close()
+            except BufferError:
+                # Tensors viewing the slot are still alive, the mapping goes away with them
+                pass
+            slot.unlink()
+        self.slots = None
+
+    def receive(self, data):
+        """
+        Rebuild samples delivered through shared-memory slots, the slot is held until the batch is collated
+        """
+        if(isinstance(data, SharedSlot)):
+            self.used_slots.append(data.slot_id)
+            return unpack_sample(data.meta, self.slots[data.slot_id].buf)
+        return data
+
+    def discard(self, data):
+        if(isinstance(data, SharedSlot)):
+            self.free_slots.put(data.slot_id)
+
+    def recycle(self):
+        for slot_id in self.used_slots:
+            self.free_slots.put(slot_id)
+        self.used_slots = []
 
     def prefetch(self):
         """
         Index shuffler introduced at prefetch stage
+        At most reorder_capacity samples are requested but not yet delivered
         """
-        while (self.prefetch_index < self.index + self.prefetch_batches * self.batch_size * self.world_size):
+        while (self.prefetch_index < self.index + self.reorder_capacity * self.world_size):
             real_prefetch_index = self.index_shuffler[self.prefetch_index % self.data_volume]
-            self.index_queues[next(self.worker_cycle)].put(real_prefetch_index)
+            self.dispatch(real_prefetch_index)
             self.prefetch_index += self.world_size
 
     def get(self):
         self.prefetch()
         sys.stdout.flush()
-        real_index = self.index_shuffler[self.index % self.data_volume]
-        if real_index in self.cache:
-            item = self.cache.pop(real_index)
+        if(self.ordered):
+            while self.consume_seq not in self.reorder_buffer:
+                (seq, data) = self.fetch(timeout=60)
+                self.reorder_buffer[seq] = data
+            item = self.reorder_buffer.pop(self.consume_seq)
+            self.consume_seq += 1
         else:
-            try:
-                (fetch_index, data) = self.output_queue.get(timeout=60)
-                if real_index == fetch_index:
-                    item = data
-                else:
-                    self.cache[fetch_index] = data
-                    return self.get()
-            except queue.Empty:
-                raise StopIteration("Data fetch timeout from the output queue.")
+            (_, item) = self.fetch(timeout=60)
         sys.stdout.flush()
 
         self.index += self.world_size
-        return item
+        return self.receive(item)
 
-    def __iter__(self):
-        self.local_index = 0
-        self.index = self.rank
-        self.prefetch_index = self.rank
+    def __next__(self):
+        batch = super().__next__()
+        # collate_fn has copied the samples out of the slots
+        self.recycle()
+        return batch
 
-        # Set the random shuffler for the data loader
-        self.iter += 1
-        torch.manual_seed(self.iter)
-        self.index_shuffler = torch.randperm(self.data_volume).tolist()
+    def __iter__(self):
+        self.start_epoch()
+        self.prefetch_index = self.index
 
-        self.cache = {}
+        # Requests of the last epoch that were never consumed are dropped,
+        # their outputs will be discarded once they arrive
+        for inflight in self.inflight:
+            inflight.clear()
+        self.respawns.clear()
+        for data in self.reorder_buffer.values():
+            self.discard(data)
+        self.recycle()
+        self.reorder_buffer = {}
+        self.consume_seq = self.dispatch_seq
         self.prefetch()
         return self
 
+    def shutdown(self, timeout=5.0):
+        """
+        Send the shutdown sentinel to every worker, terminate those that do not exit in time
+        """
+        if(getattr(self, "closed", True)):
+            return
+        self.closed = True
+        for index_queue in self.index_queues:
+            index_queue.put(None)
+        for w in self.workers:
+            w.join(timeout=timeout)
+            if w.is_alive():
+                w.terminate()
+        for q in self.index_queues:
+            q.close()
+            q.cancel_join_thread()
+        self.output_queue.close()
+        self.output_queue.cancel_join_thread()
+        if(self.free_slots is not None):
+            self.free_slots.close()
+            self.free_slots.cancel_join_thread()
+        self.release_shared_memory()
+
     def __del__(self):
         try:
-            for i in range(len(self.workers)):
-                self.index_queues[i].put(None)
-            for w in self.workers:
-                w.join()
-            for q in self.index_queues:
-                q.close()
-                q.cancel_join_thread()
-            self.output_queue.close()
-            self.output_queue.cancel_join_thread()
+            self.shutdown()
         except Exception as e:
             for w in self.workers:
-                if w.is_alive():
+                if w is not None and w.is_alive():
                     w.terminate()
             raise e
     
+def mark_last(iterable):
+    """
+    Yield (is_last, item) over the iterable, e.g. to find the last segment of segment_iterator
+    """
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield False, previous
+        previous = item
+    yield True, previous
+
 def segment_iterator(full_len, seg_len, device, *args):
     """
     Input shape: [Batch, Length, *]
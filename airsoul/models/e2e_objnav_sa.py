@@ -58,10 +58,11 @@ class E2EObjNavSA(nn.Module):
                     tags,
                     actions,
                     rewards,
-                    cache=None, need_cache=True, state_dropout=0.0,update_memory=True):
+                    cache=None, need_cache=True, state_dropout=0.0,update_memory=True,
+                    raw_images=True):
         """
         Input Size:
-            observations:[B, NT, C, W, H]
+            observations:[B, NT, C, W, H], or latents [B, NT, Z] if raw_images=False
             actions:[B, NT / (NT - 1)] 
             cache: [B, NC, H]
         """
@@ -69,8 +70,11 @@ class E2EObjNavSA(nn.Module):
         # Encode with VAE
         B = actions.shape[0]
         NT = actions.shape[1]
-        with torch.no_grad():
-            z_rec, _ = self.vae(observations)
+        if(raw_images):
+            with torch.no_grad():
+                z_rec, _ = self.vae(observations)
+        else:
+            z_rec = observations
         wm_out, pm_out, new_cache = self.decision_model(
                 z_rec, prompts, tags, actions, rewards,
                 cache=cache, need_cache=need_cache, state_dropout=state_dropout, 
@@ -98,8 +102,12 @@ class E2EObjNavSA(nn.Module):
                         update_memory=True,
                         use_loss_weight=True,
                         is_training=True,
-                        reduce_dim=1):
-                        
+                        reduce_dim=1,
+                        raw_images=True):
+        """
+        raw_images=False: observations are precomputed VAE latents [B, NT, Z] (see MazeDataSet latent_key),
+            the encoder is skipped and the raw image loss is not available (wm-raw = 0)
+        """
         self.img_encoder.requires_grad_(False)
         self.img_decoder.requires_grad_(False)
         self.vae.requires_grad_(False)
@@ -111,7 +119,10 @@ class E2EObjNavSA(nn.Module):
         
         
 
-        inputs = img_pro(observations)
+        if(raw_images):
+            inputs = img_pro(observations)
+        else:
+            inputs = observations
         bsz = behavior_actions.shape[0]
         seq_len = behavior_actions.shape[1]
 
@@ -130,7 +141,8 @@ class E2EObjNavSA(nn.Module):
                 cache=None, 
                 need_cache=False,  # TO change back to False
                 state_dropout=state_dropout,
-                update_memory=update_memory)
+                update_memory=update_memory,
+                raw_images=raw_images)
         # if cache is None:
         #     print("cache is None, using new cache")
         # else:
@@ -138,12 +150,27 @@ class E2EObjNavSA(nn.Module):
 
         z_pred, a_pred, r_pred = self.decision_model.post_decoder(wm_out, pm_out)
         # Encode the last frame to latent space
-        with torch.no_grad():
-            z_rec_l, _ = self.vae(inputs[:, -1:])
-            z_rec_l = torch.cat((z_rec, z_rec_l), dim=1)
+        if(raw_images):
+            with torch.no_grad():
+                z_rec_l, _ = self.vae(inputs[:, -1:])
+                z_rec_l = torch.cat((z_rec, z_rec_l), dim=1)
+        else:
+            z_rec_l = inputs
 
         # Calculate the loss information
         loss = dict()
+        obs_pred = None
+
+        def raw_image_loss(z_pred, loss_wht):
+            # World Model Loss - Raw Image, there is no ground truth when training on latents
+            if(not raw_images):
+                return None, 0.0
+            obs_pred = self.vae.decoding(z_pred)
+            return obs_pred, weighted_loss(obs_pred, 
+                                        loss_type="mse",
+                                        gt=inputs[:, 1:], 
+                                        loss_wht=loss_wht, 
+                                        reduce_dim=reduce_dim)
     
         loss_weight_s = None
         loss_weight_a = (label_actions.ge(0) * label_actions.lt(self.nactions)).to(
@@ -169,12 +196,7 @@ class E2EObjNavSA(nn.Module):
                                             need_cnt=True)
 
             # World Model Loss - Raw Image
-            obs_pred = self.vae.decoding(z_pred)
-            loss["wm-raw"] = weighted_loss(obs_pred, 
-                                        loss_type="mse",
-                                        gt=inputs[:, 1:], 
-                                        loss_wht=loss_weight_s, 
-                                        reduce_dim=reduce_dim)
+            obs_pred, loss["wm-raw"] = raw_image_loss(z_pred, loss_weight_s)
         else:
             if is_training:
                 if self.config.decision_block.state_diffusion.prediction_type == "sample":
@@ -192,12 +214,7 @@ class E2EObjNavSA(nn.Module):
                                                     need_cnt=True)
 
                     # World Model Loss - Raw Image
-                    obs_pred = self.vae.decoding(z_pred)
-                    loss["wm-raw"] = weighted_loss(obs_pred, 
-                                                loss_type="mse",
-                                                gt=inputs[:, 1:], 
-                                                loss_wht=loss_weight_s.unsqueeze(0), 
-                                                reduce_dim=reduce_dim)
+                    obs_pred, loss["wm-raw"] = raw_image_loss(z_pred, loss_weight_s.unsqueeze(0))
                 else:
                     loss["wm-latent"], loss["count_wm"] = self.decision_model.s_diffusion.loss_DDPM(x0=z_rec_l[:, 1:],
                                                     cond=wm_out,
@@ -213,12 +230,7 @@ class E2EObjNavSA(nn.Module):
                                                 loss_wht=loss_weight_s, 
                                                 reduce_dim=reduce_dim,
                                                 need_cnt=True)
-                obs_pred = self.vae.decoding(z_pred)
-                loss["wm-raw"] = weighted_loss(obs_pred, 
-                                            loss_type="mse",
-                                            gt=inputs[:, 1:], 
-                                            loss_wht=loss_weight_s, 
-                                            reduce_dim=reduce_dim)
+                obs_pred, loss["wm-raw"] = raw_image_loss(z_pred, loss_weight_s)
 
                 
 
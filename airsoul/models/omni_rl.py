@@ -195,6 +195,7 @@ class OmniRL(POTARDecisionModel):
             tags: None if not included
             temp: temperature for sampling
             single_batch: if true, add additional batch to input tensor
+                otherwise observation / prompt / tag are tensors of [B, 1], e.g. B environments stepped in lockstep
         Returns:
             o_pred: predicted states, only valid if future_prediction is True
             a_pred: predicted actions 
@@ -231,11 +232,13 @@ class OmniRL(POTARDecisionModel):
                 tag_in = tag_in.unsqueeze(0)
             obs_in = obs_in.unsqueeze(0)
 
+        # Expand the placeholder action / reward to the batch size
+        B = obs_in.shape[0]
         if(self.r_included):
-            default_r = self.default_r.to(device)
+            default_r = self.default_r.to(device).expand(B, *self.default_r.shape[1:])
         else:
             default_r = None
-        default_a = self.default_a.to(device)
+        default_a = self.default_a.to(device).expand(B, *self.default_a.shape[1:])
 
         wm_out, pm_out, _ = self.forward(
             obs_in,
@@ -6,12 +6,16 @@ from .transformers import ARTransformerEncoderLayer, ARTransformerEncoder
 from .diffusion import DiffusionLayers
 from .rope_mha import RoPEMultiheadAttention
 from .recursion import SimpleLSTM, PRNN
-from .mamba import MambaBlock
 from .blockrec_wrapper import BlockRecurrentWrapper
 from .causal_proxy import CausalBlock
-from .gsa import GLABlock, GSABlock
-
-from .rwkv6 import RWKV6Layer
-from .rwkv7 import RWKV7Layer
-from .deltanet import GatedDeltaNet
+from airsoul.utils.tools import lazy_attributes
 
+# Layers built on optional backends (fla, mamba_ssm) are only imported on first access
+__getattr__ = lazy_attributes(__name__, {
+    "MambaBlock": ".mamba",
+    "GLABlock": ".gsa",
+    "GSABlock": ".gsa",
+    "RWKV6Layer": ".rwkv6",
+    "RWKV7Layer": ".rwkv7",
+    "GatedDeltaNet": ".deltanet",
+})
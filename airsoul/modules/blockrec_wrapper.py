@@ -10,12 +10,31 @@ import numpy
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.checkpoint import checkpoint
-from airsoul.utils import memory_cpy, format_cache, log_warn, log_fatal
+from airsoul.utils import memory_detach, format_cache, log_warn, log_fatal
 
 
+def cat_kv(mem, cache):
+    if(isinstance(mem, torch.Tensor)):
+        return torch.cat((mem, cache), dim=1)
+    # KVCache of ARTransformerEncoder
+    return mem.concat(cache)
+
+def tail_kv(cache, length):
+    if(isinstance(cache, torch.Tensor)):
+        return cache[:, cache.shape[1] - length:].detach().clone()
+    return cache.tail(length)
+
+def len_kv(cache):
+    if(isinstance(cache, torch.Tensor)):
+        return cache.shape[1]
+    return len(cache)
+
 class BlockRecurrentWrapper(nn.Module):
     """
     Wrapping a temporal modeler with a memory cache to make it block-recurrent
+    The temporal module never modifies a cache it receives and returns new states instead,
+    so the memory and the caches handed to the caller are shared (only detached) rather than copied,
+    and calls with update_memory=False leave the memory as it is
     """
     def __init__(self, temporal_module, memory_length, memory_type='kv'):
         """
@@ -39,15 +58,15 @@ class BlockRecurrentWrapper(nn.Module):
             if(cache is not None and self.memory is not None):
                 new_cache = []
                 for mem, ca in zip(self.memory, cache):
-                    new_cache.append(torch.cat((mem, ca), dim=1))
+                    new_cache.append(cat_kv(mem, ca))
             elif(self.memory is not None):
                 new_cache = self.memory
             else:
-                new_cache = memory_cpy(cache)
+                new_cache = memory_detach(cache)
             return new_cache
         elif(self.memory_type == "mem"):
             if(cache is not None):
-                new_cache = memory_cpy(cache)
+                new_cache = memory_detach(cache)
             else:
                 new_cache = self.memory
             return new_cache
@@ -59,12 +78,12 @@ class BlockRecurrentWrapper(nn.Module):
         # We always keep memory detached and independent from the computation graph
         if(self.memory_type == "kv"):
             if(cache is not None):
-                self.memory = [c[:, -self.mem_len:].detach().clone() for c in cache]
+                self.memory = [tail_kv(c, self.mem_len) for c in cache]
             else:
                 self.memory = None
         elif(self.memory_type == "mem"):
             # Just update the memory and the cache
-            self.memory = memory_cpy(cache)
+            self.memory = memory_detach(cache)
         else:
             log_fatal(f"No such memory type: {self.memory_type}")
         return None
@@ -72,15 +91,14 @@ class BlockRecurrentWrapper(nn.Module):
     def update_cache_only(self, cache):
         if(self.memory_type == 'kv'):
             if(self.memory is None):
-                return memory_cpy(cache)
+                return memory_detach(cache)
             else:
                 new_cache = []
                 for m,c in zip(self.memory, cache):
-                    m_len = m.shape[1]
-                    new_cache.append(c[m_len:].detach().clone())
+                    new_cache.append(tail_kv(c, len_kv(c) - len_kv(m)))
                 return new_cache
         elif(self.memory_type == "mem"):
-            return memory_cpy(cache)
+            return memory_detach(cache)
         else:
             log_fatal(f"No such memory type: {self.memory_type}")
     def get_o_list(self):
@@ -103,7 +121,7 @@ class BlockRecurrentWrapper(nn.Module):
             # Update the position at the same time
             self.position += src.shape[1]
             if need_cache:
-                new_cache = memory_cpy(self.memory)
+                new_cache = memory_detach(self.memory)
         elif(need_cache):
             new_cache = self.update_cache_only(new_cache)
         else:
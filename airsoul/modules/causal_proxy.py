@@ -5,12 +5,7 @@ from torch.nn import functional as F
 from .recursion import PRNN, SimpleLSTM
 from .block_wrapper import MultiBlocks
 from .transformers import ARTransformerEncoder
-from .mamba import MambaBlock
 from .blockrec_wrapper import BlockRecurrentWrapper
-from .gsa import GLABlock, GSABlock
-from .rwkv6 import RWKV6Layer
-from .rwkv7 import RWKV7Layer
-from .deltanet import GatedDeltaNet
 
 class CausalBlock(nn.Module):
     """
@@ -36,6 +31,8 @@ class CausalBlock(nn.Module):
                 context_window=config.context_window
             )
         elif(self.model_type == "gsa"):
+            # The optional backends are only imported when they are used
+            from .gsa import GSABlock
             main_encoder = MultiBlocks(
                 GSABlock,
                 config.num_layers,
@@ -49,6 +46,7 @@ class CausalBlock(nn.Module):
                 is_generate=is_generate,
             )
         elif(self.model_type == "gla"):
+            from .gsa import GLABlock
             main_encoder = MultiBlocks(
                 GLABlock,
                 config.num_layers,
@@ -60,6 +58,7 @@ class CausalBlock(nn.Module):
                 is_generate=is_generate
             )
         elif(self.model_type == "mamba"):
+            from .mamba import MambaBlock
             main_encoder = MultiBlocks(
                 # This module uses roughly 3 * expand * d_model^2 parameters
                 MambaBlock,
@@ -74,6 +73,7 @@ class CausalBlock(nn.Module):
                 expand=config.expand,    # Block expansion factor
             )
         elif(self.model_type == "rwkv6"):
+            from .rwkv6 import RWKV6Layer
             main_encoder = MultiBlocks(
                 RWKV6Layer,
                 config.num_layers,
@@ -87,6 +87,7 @@ class CausalBlock(nn.Module):
                 num_heads=config.nhead,
             )
         elif(self.model_type == "rwkv7"):
+            from .rwkv7 import RWKV7Layer
             main_encoder = MultiBlocks(
                 RWKV7Layer,
                 config.num_layers,
@@ -96,6 +97,7 @@ class CausalBlock(nn.Module):
                 num_heads=config.nhead
             )
         elif(self.model_type == "deltanet"):
+            from .deltanet import GatedDeltaNet
             main_encoder = MultiBlocks(
                 GatedDeltaNet,
                 config.num_layers,
@@ -1,9 +1,101 @@
+import math
 import torch
 from torch import nn
-from fla.models.gated_deltanet.modeling_gated_deltanet import GatedDeltaNetBlock
-from fla.models.gated_deltanet.configuration_gated_deltanet import GatedDeltaNetConfig
-from fla.models.utils import Cache
-from airsoul.utils import format_cache, memory_cpy, log_warn 
+from torch.nn import functional as F
+from airsoul.utils import format_cache, memory_borrow, log_warn
+from .linear_attention import (fla_available, chunk_gated_delta_rule, recurrent_gated_delta_rule,
+                               RMSNorm, RMSNormGated, ShortConvolution)
+
+# Without the fla Triton kernels (no CUDA or no fla), the plain PyTorch block below is used instead
+if(fla_available()):
+    from fla.models.gated_deltanet.modeling_gated_deltanet import GatedDeltaNetBlock
+    from fla.models.gated_deltanet.configuration_gated_deltanet import GatedDeltaNetConfig
+    from fla.models.utils import Cache
+
+class TorchGatedDeltaNetBlock(nn.Module):
+    """
+    Gated DeltaNet block in plain PyTorch, following fla GatedDeltaNetBlock:
+    RMSNorm, gated delta rule attention with short convolutions on q, k, v, RMSNorm and a SwiGLU MLP, with residual connections
+    State: {'recurrent_state': [B, H, K, V], 'conv_state': (q, k, v convolution states)}
+    """
+    def __init__(self,
+                hidden_size: int=512,
+                intermediate_size: int=None,
+                num_heads: int=4,
+                head_dim: int=256,
+                expand_v: int=2,
+                conv_size: int=4,
+                hidden_ratio: int=4,
+                norm_eps: float=1.0e-6,
+                mode: str='chunk',
+                chunk_size: int=32):
+        super().__init__()
+        self.mode = mode
+        self.num_heads = num_heads
+        self.key_dim = num_heads * head_dim
+        self.value_dim = int(self.key_dim * expand_v)
+        self.chunk_size = chunk_size
+        if(intermediate_size is None):
+            intermediate_size = 256 * ((int(hidden_size * hidden_ratio * 2 / 3) + 255) // 256)
+
+        self.attn_norm = RMSNorm(hidden_size, eps=norm_eps)
+        self.mlp_norm = RMSNorm(hidden_size, eps=norm_eps)
+
+        # Attention
+        self.q_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.k_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.v_proj = nn.Linear(hidden_size, self.value_dim, bias=False)
+        self.a_proj = nn.Linear(hidden_size, num_heads, bias=False)
+        self.b_proj = nn.Linear(hidden_size, num_heads, bias=False)
+        self.A_log = nn.Parameter(torch.log(torch.empty(num_heads).uniform_(1, 16)))
+        # softplus(dt_bias) is initialized within [0.001, 0.1]
+        dt = torch.exp(torch.rand(num_heads) * (math.log(0.1) - math.log(0.001)) + math.log(0.001)).clamp(min=1.0e-4)
+        self.dt_bias = nn.Parameter(dt + torch.log(-torch.expm1(-dt)))
+        self.q_conv1d = ShortConvolution(self.key_dim, conv_size)
+        self.k_conv1d = ShortConvolution(self.key_dim, conv_size)
+        self.v_conv1d = ShortConvolution(self.value_dim, conv_size)
+        self.g_proj = nn.Linear(hidden_size, self.value_dim, bias=False)
+        self.o_norm = RMSNormGated(self.value_dim // num_heads, eps=norm_eps)
+        self.o_proj = nn.Linear(self.value_dim, hidden_size, bias=False)
+
+        # MLP
+        self.gate_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.up_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.down_proj = nn.Linear(intermediate_size, hidden_size, bias=False)
+
+    def attention(self, x, state, use_cache):
+        B, T, _ = x.shape
+        conv_q, conv_k, conv_v = (None, None, None) if state is None else state['conv_state']
+        q, conv_q = self.q_conv1d(self.q_proj(x), cache=conv_q, output_final_state=use_cache)
+        k, conv_k = self.k_conv1d(self.k_proj(x), cache=conv_k, output_final_state=use_cache)
+        v, conv_v = self.v_conv1d(self.v_proj(x), cache=conv_v, output_final_state=use_cache)
+        q, k, v = (t.view(B, T, self.num_heads, -1) for t in (q, k, v))
+        beta = self.b_proj(x).sigmoid()
+        g = -self.A_log.float().exp() * F.softplus(self.a_proj(x).float() + self.dt_bias)
+
+        initial_state = None if state is None else state['recurrent_state']
+        if(self.mode == 'fused_recurrent' or T == 1):
+            o, final_state = recurrent_gated_delta_rule(q, k, v, g, beta,
+                                                        initial_state=initial_state, output_final_state=use_cache)
+        else:
+            o, final_state = chunk_gated_delta_rule(q, k, v, g, beta, initial_state=initial_state,
+                                                    output_final_state=use_cache, chunk_size=self.chunk_size)
+
+        o = self.o_norm(o, self.g_proj(x).view(B, T, self.num_heads, -1))
+        o = self.o_proj(o.reshape(B, T, self.value_dim))
+        if(not use_cache):
+            return o, None
+        return o, {'recurrent_state': final_state, 'conv_state': (conv_q, conv_k, conv_v)}
+
+    def forward(self, x, state=None, use_cache=False):
+        """
+        state: dict or None, it is not modified
+        Returns the output and the new state (None if use_cache is False)
+        """
+        o, new_state = self.attention(self.attn_norm(x), state, use_cache)
+        residual = x + o
+        h = self.mlp_norm(residual)
+        return residual + self.down_proj(F.silu(self.gate_proj(h)) * self.up_proj(h)), new_state
 
 class GatedDeltaNet(nn.Module):
     def __init__(self,
@@ -20,26 +112,38 @@ class GatedDeltaNet(nn.Module):
             mode = 'chunk'
         else:
             mode = 'fused_recurrent'
-        self.config = GatedDeltaNetConfig(attn_mode = mode,
-                                          hidden_size = io_size,
-                                          intermediate_size = intermediate_size,
-                                          num_heads = num_heads,
-                                          vocab_size = 32000,
-                                          expand_v = expend_v, # default 2
-                                          conv_size = 4)
-        self.encoder = GatedDeltaNetBlock(config=self.config, 
-                                          layer_idx=0) # manage cache outside the fla lib
-        
+        self.use_fla = fla_available()
+        if(self.use_fla):
+            self.config = GatedDeltaNetConfig(attn_mode = mode,
+                                              hidden_size = io_size,
+                                              intermediate_size = intermediate_size,
+                                              num_heads = num_heads,
+                                              vocab_size = 32000,
+                                              expand_v = expend_v, # default 2
+                                              conv_size = 4)
+            self.encoder = GatedDeltaNetBlock(config=self.config,
+                                              layer_idx=0) # manage cache outside the fla lib
+        else:
+            self.encoder = TorchGatedDeltaNetBlock(hidden_size = io_size,
+                                                   intermediate_size = intermediate_size,
+                                                   num_heads = num_heads,
+                                                   expand_v = expend_v,
+                                                   conv_size = 4,
+                                                   mode = mode)
+
     def forward(self, x, cache=None, need_cache=False):
+        if(not self.use_fla):
+            return self.encoder(x, state=cache, use_cache=(need_cache or cache is not None))
+
         if(need_cache and cache is None):
             cache = Cache.from_legacy_cache(None)
         elif(cache is not None):
-            # avoid in-place modification of the cache
-            cache = Cache.from_legacy_cache([memory_cpy(cache)])
-    
+            # fla updates the states in place, the input cache is left untouched for the caller
+            cache = Cache.from_legacy_cache([memory_borrow(cache)])
+
         use_cache = (cache is not None)
 
         # Notice that cache is changed in-place
         out, _, new_cache = self.encoder(hidden_states=x, past_key_values=cache, use_cache=use_cache)
 
-        return out, new_cache.states[0]
\ No newline at end of file
+        return out, new_cache.states[0]
@@ -1,9 +1,131 @@
 import torch
 from torch import nn
-from fla.layers.gsa import GatedSlotAttention
-from fla.layers.gla import GatedLinearAttention
-from fla.models.utils import Cache
-from airsoul.utils import format_cache, memory_cpy, log_warn 
+from torch.nn import functional as F
+from airsoul.utils import format_cache, memory_borrow, log_warn
+from .linear_attention import fla_available, chunk_gla, recurrent_gla, RMSNorm, RMSNormGated
+
+# Without the fla Triton kernels (no CUDA or no fla), the plain PyTorch layers below are used instead
+if(fla_available()):
+    from fla.layers.gsa import GatedSlotAttention
+    from fla.layers.gla import GatedLinearAttention
+    from fla.models.utils import Cache
+
+class TorchGLA(nn.Module):
+    """
+    Gated linear attention in plain PyTorch, with the projections of fla GatedLinearAttention:
+    low-rank key gates, swish output gate and a gated RMSNorm for each head
+    mode: 'chunk' or 'fused_recurrent' (step by step), a single token is always processed step by step
+    """
+    def __init__(self,
+                mode: str='chunk',
+                hidden_size: int=1024,
+                expand_k: float=0.5,
+                expand_v: float=1.0,
+                num_heads: int=4,
+                gate_logit_normalizer: int=16,
+                gate_low_rank_dim: int=16,
+                norm_eps: float=1.0e-5,
+                chunk_size: int=32):
+        super().__init__()
+        self.mode = mode
+        self.num_heads = num_heads
+        self.key_dim = int(hidden_size * expand_k)
+        self.value_dim = int(hidden_size * expand_v)
+        self.gate_logit_normalizer = gate_logit_normalizer
+        self.chunk_size = chunk_size
+
+        self.q_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.k_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.v_proj = nn.Linear(hidden_size, self.value_dim, bias=False)
+        self.g_proj = nn.Linear(hidden_size, self.value_dim, bias=False)
+        self.gk_proj = nn.Sequential(nn.Linear(hidden_size, gate_low_rank_dim, bias=False),
+                                     nn.Linear(gate_low_rank_dim, self.key_dim, bias=True))
+        self.o_proj = nn.Linear(self.value_dim, hidden_size, bias=False)
+        self.g_norm_swish_gate = RMSNormGated(self.value_dim // num_heads, eps=norm_eps)
+
+    def forward(self, x, state=None, use_cache=False):
+        """
+        state: {'recurrent_state': [B, H, K, V]} or None, it is not modified
+        Returns the output and the new state (None if use_cache is False)
+        """
+        B, T, _ = x.shape
+        q = self.q_proj(x).view(B, T, self.num_heads, -1)
+        k = self.k_proj(x).view(B, T, self.num_heads, -1)
+        v = self.v_proj(x).view(B, T, self.num_heads, -1)
+        gk = F.logsigmoid(self.gk_proj(x).view(B, T, self.num_heads, -1)) / self.gate_logit_normalizer
+
+        initial_state = None if state is None else state['recurrent_state']
+        if(self.mode == 'fused_recurrent' or T == 1):
+            o, final_state = recurrent_gla(q, k, v, gk, initial_state=initial_state, output_final_state=use_cache)
+        else:
+            o, final_state = chunk_gla(q, k, v, gk, initial_state=initial_state, output_final_state=use_cache,
+                                       chunk_size=self.chunk_size)
+
+        o = self.g_norm_swish_gate(o, self.g_proj(x).view(B, T, self.num_heads, -1))
+        o = self.o_proj(o.reshape(B, T, self.value_dim))
+        return o, ({'recurrent_state': final_state} if use_cache else None)
+
+class TorchGSA(nn.Module):
+    """
+    Gated slot attention in plain PyTorch, with the projections of fla GatedSlotAttention
+    The keys and the values are written to num_slots slots with forget gates,
+    which is two gated linear attentions sharing the gates: queries read the key slots, the softmax of it reads the value slots
+    gate_bound: lower bound of the log forget gates
+    """
+    def __init__(self,
+                mode: str='chunk',
+                hidden_size: int=1024,
+                expand_k: float=1.0,
+                expand_v: float=1.0,
+                num_heads: int=4,
+                num_slots: int=64,
+                gate_logit_normalizer: int=8,
+                gate_bound: float=50,
+                norm_eps: float=1.0e-5,
+                scale: float=1.0,
+                chunk_size: int=32):
+        super().__init__()
+        self.mode = mode
+        self.num_heads = num_heads
+        self.num_slots = num_slots
+        self.key_dim = int(hidden_size * expand_k)
+        self.value_dim = int(hidden_size * expand_v)
+        self.gate_logit_normalizer = gate_logit_normalizer
+        self.gate_bound = gate_bound
+        self.scale = scale
+        self.chunk_size = chunk_size
+
+        self.q_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.k_proj = nn.Linear(hidden_size, self.key_dim, bias=False)
+        self.v_proj = nn.Linear(hidden_size, self.value_dim, bias=False)
+        self.f_proj = nn.Linear(hidden_size, num_heads * num_slots, bias=False)
+        self.g_norm = RMSNorm(self.value_dim, eps=norm_eps)
+        self.o_proj = nn.Linear(self.value_dim, hidden_size, bias=False)
+
+    def forward(self, x, state=None, use_cache=False):
+        """
+        state: {'recurrent_state': (key slots [B, H, K, M], value slots [B, H, M, V])} or None, it is not modified
+        """
+        B, T, _ = x.shape
+        q = F.silu(self.q_proj(x).view(B, T, self.num_heads, -1))
+        k = F.silu(self.k_proj(x).view(B, T, self.num_heads, -1))
+        v = F.silu(self.v_proj(x).view(B, T, self.num_heads, -1))
+        f = F.logsigmoid(self.f_proj(x).view(B, T, self.num_heads, self.num_slots)) / self.gate_logit_normalizer
+        f = f.clamp(min=-self.gate_bound)
+        s = 1.0 - f.exp()
+
+        hk, hv = (None, None) if state is None else state['recurrent_state']
+        if(self.mode == 'fused_recurrent' or T == 1):
+            ok, hk = recurrent_gla(q, k, s, gv=f, scale=self.scale, initial_state=hk, output_final_state=use_cache)
+            o, hv = recurrent_gla(ok.softmax(-1), s, v, gk=f, scale=1.0, initial_state=hv, output_final_state=use_cache)
+        else:
+            ok, hk = chunk_gla(q, k, s, gv=f, scale=self.scale, initial_state=hk, output_final_state=use_cache,
+                               chunk_size=self.chunk_size)
+            o, hv = chunk_gla(ok.softmax(-1), s, v, gk=f, scale=1.0, initial_state=hv, output_final_state=use_cache,
+                              chunk_size=self.chunk_size)
+
+        o = self.o_proj(self.g_norm(o.reshape(B, T, self.value_dim)))
+        return o, ({'recurrent_state': (hk, hv)} if use_cache else None)
 
 class GLABlock(nn.Module):
     def __init__(self,
@@ -12,32 +134,42 @@ class GLABlock(nn.Module):
                 layer_idx: int=0,
                 is_generate: bool=False):
         super().__init__()
-        
+
         self.hidden_size = io_size
         self.layer_idx = layer_idx
         if(not is_generate):
             mode = 'chunk'
         else:
             mode = 'fused_recurrent'
-        self.encoder = GatedLinearAttention(
-                  mode=mode,
-                  hidden_size=io_size,
-                  num_heads=num_heads,
-                  layer_idx=0)
-        
+        self.use_fla = fla_available()
+        if(self.use_fla):
+            self.encoder = GatedLinearAttention(
+                      mode=mode,
+                      hidden_size=io_size,
+                      num_heads=num_heads,
+                      layer_idx=0)
+        else:
+            self.encoder = TorchGLA(
+                      mode=mode,
+                      hidden_size=io_size,
+                      num_heads=num_heads)
+
     def forward(self, x, cache=None, need_cache=False):
+        if(not self.use_fla):
+            return self.encoder(x, state=cache, use_cache=(need_cache or cache is not None))
+
         if(need_cache and cache is None):
             cache = Cache.from_legacy_cache(None)
         elif(cache is not None):
-            # avoid in-place modification of the cache
-            cache = Cache.from_legacy_cache([memory_cpy(cache)])
-    
+            # fla updates the states in place, the input cache is left untouched for the caller
+            cache = Cache.from_legacy_cache([memory_borrow(cache)])
+
         use_cache = (cache is not None)
 
         # Notice that cache is changed in-place
         out, _, new_cache = self.encoder(hidden_states=x, past_key_values=cache, use_cache=use_cache)
         return out, new_cache.states[0]
-    
+
 class GSABlock(GLABlock):
     def __init__(self,
                 io_size: int=512,
@@ -53,10 +185,19 @@ class GSABlock(GLABlock):
             mode = 'chunk'
         else:
             mode = 'fused_recurrent'
-        self.encoder = GatedSlotAttention(
-                  mode=mode,
-                  hidden_size=io_size,
-                  num_heads=num_heads,
-                  num_slots=num_slots,
-                  gate_bound=gate_bound,
-                  layer_idx=0)
+        self.use_fla = fla_available()
+        if(self.use_fla):
+            self.encoder = GatedSlotAttention(
+                      mode=mode,
+                      hidden_size=io_size,
+                      num_heads=num_heads,
+                      num_slots=num_slots,
+                      gate_bound=gate_bound,
+                      layer_idx=0)
+        else:
+            self.encoder = TorchGSA(
+                      mode=mode,
+                      hidden_size=io_size,
+                      num_heads=num_heads,
+                      num_slots=num_slots,
+                      gate_bound=gate_bound)
@@ -0,0 +1,346 @@
+import importlib.util
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+"""
+Plain PyTorch implementations of the linear-attention recurrences behind the fla layers (GLA, GSA, RWKV6, RWKV7, Gated DeltaNet),
+used where the fla Triton kernels can not run, e.g. on CPU-only machines
+
+Inputs are [batch, seq, head, dim] as in fla, states are [batch, head, key_dim, value_dim] in float32.
+chunk_* compute the attention inside chunks of chunk_size in parallel and carry the state from chunk to chunk,
+recurrent_* step over the tokens (cheaper for a single token); both return the same outputs and final states.
+"""
+
+def fla_available():
+    """
+    Whether the fla layers can run: fla and triton are installed and a CUDA device is present
+    """
+    return (torch.cuda.is_available()
+            and importlib.util.find_spec("fla") is not None
+            and importlib.util.find_spec("triton") is not None)
+
+def _heads_first(x, chunk_size=None):
+    """
+    [B, T, H, D] -> float32 [B, H, T, D], zero-padded to a multiple of chunk_size
+    Padded steps have zero keys and gates, they leave the state unchanged
+    """
+    x = x.transpose(1, 2).float()
+    if(chunk_size is not None and x.shape[2] % chunk_size != 0):
+        x = F.pad(x, (0, 0, 0, chunk_size - x.shape[2] % chunk_size))
+    return x
+
+def _initial_state(initial_state, q, K, V):
+    if(initial_state is None):
+        return q.new_zeros(q.shape[0], q.shape[1], K, V)
+    return initial_state.float()
+
+def _pairwise_decay(Gq, Gk, mask):
+    """
+    exp(Gq[t] - Gk[s]) for the (t, s) pairs in mask, 0 elsewhere: [B, H, C, C, D]
+    """
+    return (Gq.unsqueeze(3) - Gk.unsqueeze(2)).masked_fill(~mask.unsqueeze(-1), float('-inf')).exp()
+
+def chunk_gla(q, k, v, gk=None, gv=None, u=None, scale=None, initial_state=None, output_final_state=False, chunk_size=32):
+    """
+    Gated linear attention S_t = diag(exp(gk_t)) S_{t-1} diag(exp(gv_t)) + k_t v_t^T, o_t = S_t^T q_t * scale
+    gk: [B, T, H, K], gv: [B, T, H, V] log decays (<= 0), None for no decay
+    u: [H, K] bonus of RWKV6, o_t = (S_{t-1} + diag(u) k_t v_t^T)^T q_t * scale
+    Returns o: [B, T, H, V] and the final state (None if not output_final_state)
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    C = chunk_size
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    q, k, v = (_heads_first(x, C) for x in (q, k, v))
+    q = q * scale
+    gk = None if gk is None else _heads_first(gk, C)
+    gv = None if gv is None else _heads_first(gv, C)
+    S = _initial_state(initial_state, q, K, V)
+
+    # With the bonus, the query at t reads the state before the key at t is added
+    exclusive = u is not None
+    mask = torch.ones(C, C, dtype=torch.bool, device=q.device).tril(-1 if exclusive else 0)
+    outputs = []
+    for i in range(0, q.shape[2], C):
+        qc, kc, vc = q[:, :, i:i + C], k[:, :, i:i + C], v[:, :, i:i + C]
+        if(gk is None):
+            A = (qc @ kc.transpose(-1, -2)).masked_fill(~mask, 0.0)
+            q_in, k_out, decay_k = qc, kc, None
+        else:
+            G = gk[:, :, i:i + C].cumsum(2)
+            Gq = G - gk[:, :, i:i + C] if exclusive else G
+            A = (qc.unsqueeze(3) * kc.unsqueeze(2) * _pairwise_decay(Gq, G, mask)).sum(-1)
+            q_in, k_out, decay_k = qc * Gq.exp(), kc * (G[:, :, -1:] - G).exp(), G[:, :, -1].exp()
+        if(gv is None):
+            oc = A @ vc + q_in @ S
+            v_out, decay_v = vc, None
+        else:
+            G = gv[:, :, i:i + C].cumsum(2)
+            Gq = G - gv[:, :, i:i + C] if exclusive else G
+            oc = (A.unsqueeze(-1) * vc.unsqueeze(2) * _pairwise_decay(Gq, G, mask)).sum(3) + (q_in @ S) * Gq.exp()
+            v_out, decay_v = vc * (G[:, :, -1:] - G).exp(), G[:, :, -1].exp()
+        if(exclusive):
+            oc = oc + (qc * u.float().unsqueeze(1) * kc).sum(-1, keepdim=True) * vc
+        outputs.append(oc)
+
+        if(decay_k is not None):
+            S = S * decay_k.unsqueeze(-1)
+        if(decay_v is not None):
+            S = S * decay_v.unsqueeze(-2)
+        S = S + k_out.transpose(-1, -2) @ v_out
+
+    o = torch.cat(outputs, dim=2)[:, :, :T].transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def recurrent_gla(q, k, v, gk=None, gv=None, u=None, scale=None, initial_state=None, output_final_state=False):
+    """
+    Step-by-step version of chunk_gla
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    q, k, v = (_heads_first(x) for x in (q, k, v))
+    q = q * scale
+    gk = None if gk is None else _heads_first(gk)
+    gv = None if gv is None else _heads_first(gv)
+    S = _initial_state(initial_state, q, K, V)
+
+    outputs = []
+    for t in range(T):
+        kv = k[:, :, t].unsqueeze(-1) * v[:, :, t].unsqueeze(-2)
+        if(u is not None):
+            outputs.append(((S + u.float().unsqueeze(-1) * kv) * q[:, :, t].unsqueeze(-1)).sum(-2))
+        if(gk is not None):
+            S = S * gk[:, :, t].exp().unsqueeze(-1)
+        if(gv is not None):
+            S = S * gv[:, :, t].exp().unsqueeze(-2)
+        S = S + kv
+        if(u is None):
+            outputs.append((S * q[:, :, t].unsqueeze(-1)).sum(-2))
+
+    o = torch.stack(outputs, dim=2).transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def chunk_dplr(q, k, v, a, b, gk, scale=None, initial_state=None, output_final_state=False, chunk_size=32):
+    """
+    Diagonal plus low-rank recurrence of RWKV7, S_t = diag(exp(gk_t)) S_{t-1} + b_t (a_t^T S_{t-1}) + k_t v_t^T, o_t = S_t^T q_t * scale
+    q, k, a, b, gk: [B, T, H, K], v: [B, T, H, V]
+    Inside a chunk the reads d_t = a_t^T S_{t-1} depend on each other through a unit lower-triangular system, solved once per chunk
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    C = chunk_size
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    q, k, v, a, b, gk = (_heads_first(x, C) for x in (q, k, v, a, b, gk))
+    q = q * scale
+    S = _initial_state(initial_state, q, K, V)
+
+    inclusive = torch.ones(C, C, dtype=torch.bool, device=q.device).tril()
+    strict = inclusive.tril(-1)
+    eye = torch.eye(C, device=q.device)
+    outputs = []
+    for i in range(0, q.shape[2], C):
+        qc, kc, vc, ac, bc = q[:, :, i:i + C], k[:, :, i:i + C], v[:, :, i:i + C], a[:, :, i:i + C], b[:, :, i:i + C]
+        G = gk[:, :, i:i + C].cumsum(2)
+        # the read at t sees the state after t - 1
+        Gr = G - gk[:, :, i:i + C]
+        decay_r = _pairwise_decay(Gr, G, strict)
+        decay_o = _pairwise_decay(G, G, inclusive)
+        A_ab = (ac.unsqueeze(3) * bc.unsqueeze(2) * decay_r).sum(-1)
+        A_ak = (ac.unsqueeze(3) * kc.unsqueeze(2) * decay_r).sum(-1)
+        A_qb = (qc.unsqueeze(3) * bc.unsqueeze(2) * decay_o).sum(-1)
+        A_qk = (qc.unsqueeze(3) * kc.unsqueeze(2) * decay_o).sum(-1)
+
+        # (I - A_ab) D = (a * exp(Gr)) S + A_ak V, D = W S + U
+        WU = torch.linalg.solve_triangular(eye - A_ab, torch.cat([ac * Gr.exp(), A_ak @ vc], dim=-1),
+                                           upper=False, unitriangular=True)
+        W, U = WU.split([K, V], dim=-1)
+        D = W @ S + U
+        outputs.append((qc * G.exp()) @ S + A_qb @ D + A_qk @ vc)
+
+        decay_end = (G[:, :, -1:] - G).exp()
+        S = (S * G[:, :, -1].exp().unsqueeze(-1) + (bc * decay_end).transpose(-1, -2) @ D
+             + (kc * decay_end).transpose(-1, -2) @ vc)
+
+    o = torch.cat(outputs, dim=2)[:, :, :T].transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def recurrent_dplr(q, k, v, a, b, gk, scale=None, initial_state=None, output_final_state=False):
+    """
+    Step-by-step version of chunk_dplr
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    q, k, v, a, b, gk = (_heads_first(x) for x in (q, k, v, a, b, gk))
+    q = q * scale
+    S = _initial_state(initial_state, q, K, V)
+
+    outputs = []
+    for t in range(T):
+        read = (a[:, :, t].unsqueeze(-1) * S).sum(-2, keepdim=True)
+        S = (S * gk[:, :, t].exp().unsqueeze(-1) + b[:, :, t].unsqueeze(-1) * read
+             + k[:, :, t].unsqueeze(-1) * v[:, :, t].unsqueeze(-2))
+        outputs.append((S * q[:, :, t].unsqueeze(-1)).sum(-2))
+
+    o = torch.stack(outputs, dim=2).transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def chunk_gated_delta_rule(q, k, v, g, beta, scale=None, initial_state=None, output_final_state=False,
+                           use_qk_l2norm=True, chunk_size=32):
+    """
+    Gated delta rule, S_t = exp(g_t) (I - beta_t k_t k_t^T) S_{t-1} + beta_t k_t v_t^T, o_t = S_t^T q_t * scale
+    q, k: [B, T, H, K], v: [B, T, H, V], g (log decay) and beta: [B, T, H]
+    The decay is a scalar for each head, so the intra-chunk terms are plain matmuls (WY representation)
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    C = chunk_size
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    if(use_qk_l2norm):
+        q, k = F.normalize(q.float(), dim=-1, eps=1.0e-6), F.normalize(k.float(), dim=-1, eps=1.0e-6)
+    q, k, v = (_heads_first(x, C) for x in (q, k, v))
+    g, beta = (_heads_first(x.unsqueeze(-1), C) for x in (g, beta))
+    q = q * scale
+    S = _initial_state(initial_state, q, K, V)
+
+    inclusive = torch.ones(C, C, dtype=torch.bool, device=q.device).tril()
+    strict = inclusive.tril(-1)
+    eye = torch.eye(C, device=q.device)
+    outputs = []
+    for i in range(0, q.shape[2], C):
+        qc, kc, vc, bc = q[:, :, i:i + C], k[:, :, i:i + C], v[:, :, i:i + C], beta[:, :, i:i + C]
+        G = g[:, :, i:i + C].cumsum(2)
+        decay = (G - G.transpose(-1, -2)).masked_fill(~inclusive, float('-inf')).exp()
+        L = (bc * (kc @ kc.transpose(-1, -2)) * decay).masked_fill(~strict, 0.0)
+        # (I + L) D = beta V - beta exp(G) K S, D = U - W S
+        UW = torch.linalg.solve_triangular(eye + L, torch.cat([bc * vc, bc * G.exp() * kc], dim=-1),
+                                           upper=False, unitriangular=True)
+        U, W = UW.split([V, K], dim=-1)
+        D = U - W @ S
+        outputs.append((qc * G.exp()) @ S + ((qc @ kc.transpose(-1, -2)) * decay) @ D)
+        S = S * G[:, :, -1:].exp() + (kc * (G[:, :, -1:] - G).exp()).transpose(-1, -2) @ D
+
+    o = torch.cat(outputs, dim=2)[:, :, :T].transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def recurrent_gated_delta_rule(q, k, v, g, beta, scale=None, initial_state=None, output_final_state=False, use_qk_l2norm=True):
+    """
+    Step-by-step version of chunk_gated_delta_rule
+    """
+    B, T, H, K = q.shape
+    V = v.shape[-1]
+    scale = K ** -0.5 if scale is None else scale
+    dtype = v.dtype
+    if(use_qk_l2norm):
+        q, k = F.normalize(q.float(), dim=-1, eps=1.0e-6), F.normalize(k.float(), dim=-1, eps=1.0e-6)
+    q, k, v = (_heads_first(x) for x in (q, k, v))
+    g, beta = (_heads_first(x.unsqueeze(-1)) for x in (g, beta))
+    q = q * scale
+    S = _initial_state(initial_state, q, K, V)
+
+    outputs = []
+    for t in range(T):
+        S = S * g[:, :, t].exp().unsqueeze(-1)
+        kt = k[:, :, t].unsqueeze(-1)
+        delta = (v[:, :, t].unsqueeze(-2) - (kt * S).sum(-2, keepdim=True)) * beta[:, :, t].unsqueeze(-1)
+        S = S + kt * delta
+        outputs.append((S * q[:, :, t].unsqueeze(-1)).sum(-2))
+
+    o = torch.stack(outputs, dim=2).transpose(1, 2).to(dtype)
+    return o, (S if output_final_state else None)
+
+def token_shift(x, last=None):
+    """
+    x shifted by one step along the sequence, the first step takes `last` ([B, D], zeros if None)
+    """
+    if(last is None):
+        return F.pad(x, (0, 0, 1, -1))
+    return torch.cat([last.unsqueeze(1).to(x.dtype), x[:, :-1]], dim=1)
+
+def sqrelu(x):
+    return F.relu(x) ** 2
+
+class RMSNorm(nn.Module):
+    def __init__(self, hidden_size, eps=1.0e-5):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(hidden_size))
+
+    def forward(self, x):
+        x_f = x.float()
+        return (x_f * torch.rsqrt(x_f.pow(2).mean(-1, keepdim=True) + self.eps)).to(x.dtype) * self.weight
+
+class RMSNormGated(RMSNorm):
+    """
+    RMSNorm(x) * swish(g), as the fused norm-gate of fla
+    """
+    def forward(self, x, g):
+        return super().forward(x) * F.silu(g)
+
+class LoRA(nn.Module):
+    def __init__(self, input_dim, output_dim, low_rank_dim, bias=True, activation='tanh'):
+        super().__init__()
+        activations = {'tanh': nn.Tanh(), 'sigmoid': nn.Sigmoid(), None: nn.Identity()}
+        self.lora = nn.Sequential(
+            nn.Linear(input_dim, low_rank_dim, bias=False),
+            activations[activation],
+            nn.Linear(low_rank_dim, output_dim, bias=bias))
+
+    def forward(self, x):
+        return self.lora(x)
+
+class LerpLinear(nn.Module):
+    """
+    Linear layer over the interpolation x + mu * (shifted x - x)
+    """
+    def __init__(self, input_dim, output_dim, low_rank_dim=None):
+        super().__init__()
+        if(low_rank_dim is None):
+            self.linear = nn.Linear(input_dim, output_dim, bias=False)
+        else:
+            self.linear = LoRA(input_dim, output_dim, low_rank_dim)
+        self.mu = nn.Parameter(torch.zeros(input_dim))
+
+    def forward(self, x, delta):
+        return self.linear(x + delta * self.mu)
+
+class DDLerpLinear(nn.Module):
+    """
+    Linear layer over x + mu * (shifted x - x) with a data-dependent mu
+    """
+    def __init__(self, input_dim, output_dim, low_rank_dim=None):
+        super().__init__()
+        if(low_rank_dim is None):
+            self.linear = nn.Linear(input_dim, output_dim, bias=False)
+        else:
+            self.linear = LoRA(input_dim, output_dim, low_rank_dim)
+
+    def forward(self, x, mu, delta):
+        return self.linear(x + delta * mu)
+
+class ShortConvolution(nn.Conv1d):
+    """
+    Causal depthwise convolution over the time steps, x: [B, T, D]
+    The state holds the last kernel_size - 1 inputs: [B, D, kernel_size - 1]
+    """
+    def __init__(self, hidden_size, kernel_size, bias=False, activation='silu'):
+        super().__init__(hidden_size, hidden_size, kernel_size, groups=hidden_size, bias=bias)
+        self.activation = activation
+
+    def forward(self, x, cache=None, output_final_state=False):
+        x = x.transpose(1, 2)
+        if(cache is None):
+            cache = x.new_zeros(x.shape[0], x.shape[1], self.kernel_size[0] - 1)
+        x = torch.cat([cache.to(x.dtype), x], dim=-1)
+        y = F.conv1d(x, self.weight, self.bias, groups=self.groups)
+        if(self.activation == 'silu'):
+            y = F.silu(y)
+        final_state = x[..., x.shape[-1] - self.kernel_size[0] + 1:] if output_final_state else None
+        return y.transpose(1, 2), final_state
@@ -1,9 +1,125 @@
+import math
 import torch
 from torch import nn
-# from mamba_ssm import Mamba, Mamba2
-# from mamba_ssm.utils.generation import InferenceParams
+from torch.nn import functional as F
 from airsoul.utils import log_warn
 
+# The CUDA selective scan of mamba_ssm is used for whole sequences when it is installed,
+# the plain PyTorch scan otherwise, and whenever a state is carried in (the kernel takes no initial state)
+try:
+    from mamba_ssm.ops.selective_scan_interface import selective_scan_fn
+except (ImportError, OSError):
+    selective_scan_fn = None
+
+def selective_scan(u, delta, A, B, C, D=None, z=None, initial_state=None, return_last_state=False, chunk_size=64):
+    """
+    Selective scan of Mamba in plain PyTorch: h_t = exp(delta_t A) h_{t-1} + delta_t B_t u_t, y_t = C_t h_t + D u_t, times silu(z_t)
+    u, delta, z: [B, D, L], A: [D, N], B, C: [B, N, L], D: [D], initial_state: [B, D, N]
+    Inside a chunk the recurrence is solved by a parallel (Hillis-Steele) scan in log2(chunk_size) steps,
+    the state is carried from chunk to chunk; a single token costs O(1)
+    Returns y: [B, D, L] and the last state [B, D, N] (None if not return_last_state)
+    """
+    dtype = u.dtype
+    u, delta, A, B, C = u.float(), delta.float(), A.float(), B.float(), C.float()
+    batch, dim, L = u.shape
+    h = u.new_zeros(batch, dim, A.shape[1]) if initial_state is None else initial_state.float()
+
+    ys = []
+    for i in range(0, L, chunk_size):
+        dt = delta[:, :, i:i + chunk_size]
+        # decays and inputs of the steps: [B, D, l, N]
+        decay = torch.exp(dt.unsqueeze(-1) * A.unsqueeze(1))
+        x = (dt * u[:, :, i:i + chunk_size]).unsqueeze(-1) * B[:, :, i:i + chunk_size].transpose(1, 2).unsqueeze(1)
+        step = 1
+        while(step < x.shape[2]):
+            x = x + decay * F.pad(x, (0, 0, step, 0))[:, :, :-step]
+            decay = decay * F.pad(decay, (0, 0, step, 0), value=1.0)[:, :, :-step]
+            step *= 2
+        states = x + decay * h.unsqueeze(2)
+        ys.append((states * C[:, :, i:i + chunk_size].transpose(1, 2).unsqueeze(1)).sum(-1))
+        h = states[:, :, -1]
+
+    y = torch.cat(ys, dim=2)
+    if(D is not None):
+        y = y + u * D.float().unsqueeze(-1)
+    if(z is not None):
+        y = y * F.silu(z.float())
+    return y.to(dtype), (h if return_last_state else None)
+
+class Mamba(nn.Module):
+    """
+    Mamba (S6) mixer with the parameters and initialization of mamba_ssm Mamba
+    State: (conv_state [B, d_inner, d_conv], ssm_state [B, d_inner, d_state]), the last d_conv inputs of the convolution
+    and the scan state as in mamba_ssm; a state passed in is never modified
+    """
+    def __init__(self,
+                d_model: int,
+                d_state: int=16,
+                d_conv: int=4,
+                expand: int=2,
+                dt_rank="auto",
+                dt_min: float=0.001,
+                dt_max: float=0.1,
+                dt_init_floor: float=1.0e-4,
+                conv_bias: bool=True,
+                bias: bool=False,
+                chunk_size: int=64):
+        super().__init__()
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.d_inner = int(expand * d_model)
+        self.dt_rank = math.ceil(d_model / 16) if dt_rank == "auto" else dt_rank
+        self.chunk_size = chunk_size
+
+        self.in_proj = nn.Linear(d_model, self.d_inner * 2, bias=bias)
+        self.conv1d = nn.Conv1d(self.d_inner, self.d_inner, d_conv, groups=self.d_inner, padding=d_conv - 1, bias=conv_bias)
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + d_state * 2, bias=False)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True)
+        self.out_proj = nn.Linear(self.d_inner, d_model, bias=bias)
+
+        # softplus(dt_proj.bias) is initialized within [dt_min, dt_max]
+        dt_init_std = self.dt_rank ** -0.5
+        nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        dt = torch.exp(torch.rand(self.d_inner) * (math.log(dt_max) - math.log(dt_min)) + math.log(dt_min)).clamp(min=dt_init_floor)
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(dt + torch.log(-torch.expm1(-dt)))
+        # S4D real initialization
+        self.A_log = nn.Parameter(torch.log(torch.arange(1, d_state + 1, dtype=torch.float32)).repeat(self.d_inner, 1))
+        self.D = nn.Parameter(torch.ones(self.d_inner))
+
+    def forward(self, hidden_states, state=None, use_cache=False):
+        """
+        hidden_states: [B, L, d_model]
+        Returns the output and the new state (None if use_cache is False)
+        """
+        x, z = self.in_proj(hidden_states).transpose(1, 2).chunk(2, dim=1)
+        conv_state, ssm_state = (None, None) if state is None else state
+
+        # Causal depthwise convolution, preceded by the cached inputs
+        if(conv_state is None):
+            x_pad = F.pad(x, (self.d_conv - 1, 0))
+        else:
+            x_pad = torch.cat([conv_state[..., 1:].to(x.dtype), x], dim=-1)
+        x = F.silu(F.conv1d(x_pad, self.conv1d.weight, self.conv1d.bias, groups=self.d_inner))
+
+        dt, B, C = torch.split(self.x_proj(x.transpose(1, 2)), [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = self.dt_proj.weight @ dt.transpose(1, 2)
+        B, C = B.transpose(1, 2).contiguous(), C.transpose(1, 2).contiguous()
+        A = -torch.exp(self.A_log.float())
+        if(ssm_state is None and selective_scan_fn is not None and x.is_cuda):
+            y = selective_scan_fn(x, dt, A, B, C, self.D.float(), z=z, delta_bias=self.dt_proj.bias.float(),
+                                  delta_softplus=True, return_last_state=use_cache)
+            y, last_state = y if use_cache else (y, None)
+        else:
+            delta = F.softplus(dt + self.dt_proj.bias.unsqueeze(-1).to(dt.dtype))
+            y, last_state = selective_scan(x, delta, A, B, C, self.D, z=z, initial_state=ssm_state,
+                                           return_last_state=use_cache, chunk_size=self.chunk_size)
+
+        out = self.out_proj(y.transpose(1, 2))
+        if(not use_cache):
+            return out, None
+        return out, (x_pad[..., -self.d_conv:], last_state)
+
 class MambaBlock(nn.Module):
     def __init__(self,
                 io_size: int=512,
@@ -19,29 +135,47 @@ class MambaBlock(nn.Module):
         self.expand = expand
 
         self.layer_idx = layer_idx
+        # The recurrent state has a fixed size, the sequence length is not bounded by max_position_encoding
         self.max_position_encoding = max_position_encoding
         self.encoder = Mamba(
                   d_model=io_size,
                   d_state=d_state,
                   d_conv=d_conv,
-                  expand=expand,
-                  layer_idx=self.layer_idx)
-        
+                  expand=expand)
+
     def forward(self, x, cache=None, need_cache=False):
-        if(need_cache):
-            if(cache is None):
-                cache = InferenceParams(max_seqlen=self.max_position_encoding, max_batch_size=x.shape[0])
-            else:
-                n_cache = InferenceParams(max_seqlen=self.max_position_encoding, max_batch_size=x.shape[0])
-                n_cache.key_value_memory_dict[self.layer_idx] = (cache[0].clone(), cache[1].clone())
-                cache = n_cache
-                log_warn("Attention!!! Mamba-ssm has bugs for chunk-wise inference")
-        else:
-            cache = None
+        """
+        cache: (conv_state, ssm_state) or None, the segment continues from it
+        """
+        return self.encoder(x, state=cache, use_cache=(need_cache or cache is not None))
 
-        out = self.encoder(x, inference_params=cache)
+if __name__=="__main__":
+    # The chunked scan must match a step-by-step loop,
+    # and the block must give the same outputs for a whole sequence, token by token, and in two segments
+    torch.manual_seed(0)
+    batch, dim, N, L = 2, 16, 8, 100
+    u, z = torch.randn(batch, dim, L), torch.randn(batch, dim, L)
+    delta = F.softplus(torch.randn(batch, dim, L))
+    A = -torch.rand(dim, N) * 4
+    B, C = torch.randn(batch, N, L), torch.randn(batch, N, L)
+    D = torch.randn(dim)
+    h0 = torch.randn(batch, dim, N)
+    y, h = selective_scan(u, delta, A, B, C, D, z, initial_state=h0, return_last_state=True, chunk_size=16)
+    h_ref, y_ref = h0, []
+    for t in range(L):
+        h_ref = torch.exp(delta[:, :, t, None] * A) * h_ref + (delta[:, :, t] * u[:, :, t])[..., None] * B[:, None, :, t]
+        y_ref.append(((h_ref * C[:, None, :, t]).sum(-1) + D * u[:, :, t]) * F.silu(z[:, :, t]))
+    print("scan deviation:", (y - torch.stack(y_ref, dim=-1)).abs().max().item(), "state deviation:", (h - h_ref).abs().max().item())
 
-        if(need_cache):
-            return out, cache.key_value_memory_dict[self.layer_idx]
-        else:
-            return out, None
+    block = MambaBlock(io_size=32, d_state=8, d_conv=4, expand=2).eval()
+    x = torch.randn(2, 40, 32)
+    with torch.no_grad():
+        full, _ = block(x, need_cache=True)
+        cache, steps = None, []
+        for t in range(40):
+            out, cache = block(x[:, t:t+1], cache=cache, need_cache=True)
+            steps.append(out)
+        out1, cache = block(x[:, :13], need_cache=True)
+        out2, _ = block(x[:, 13:], cache=cache, need_cache=True)
+    print("token by token deviation:", (full - torch.cat(steps, dim=1)).abs().max().item(),
+          "two segments deviation:", (full - torch.cat([out1, out2], dim=1)).abs().max().item())
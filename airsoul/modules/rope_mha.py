@@ -1,22 +1,10 @@
 import copy
 import torch
 import math
+import weakref
 import torch.nn as nn
 import torch.nn.functional as F
 
-def scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, scale=None) -> torch.Tensor:
-    # Efficient implementation equivalent to the following:
-    L, S = query.size(-2), key.size(-2)
-    scale_factor = 1 / math.sqrt(query.size(-1)) if scale is None else scale
-
-    attn_weight = query @ key.transpose(-2, -1) * scale_factor
-    if attn_mask is not None:
-        attn_weight += attn_mask
-    attn_weight = torch.softmax(attn_weight, dim=-1)
-    attn_weight = torch.dropout(attn_weight, dropout_p, train=True)
-
-    return attn_weight @ value
-
 # Modified from facebookresearch/llama/model.py
 def apply_rotary_emb(
     xq: torch.Tensor,
@@ -28,18 +16,35 @@ def apply_rotary_emb(
     q0_pos: the start position of xq
     k0_pos: the start position of xk
     """
-    bsz, q_len, _, _ = xq.shape
-    k_len = xk.shape[1]
+    return rotate_emb(xq, freqs_cis, q0_pos), rotate_emb(xk, freqs_cis, k0_pos)
 
-    freqs_cis = freqs_cis.to(xq.device)
-    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
-    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
-    xqm_ = freqs_cis[:, q0_pos:(q0_pos + q_len)]
-    xkm_ = freqs_cis[:, k0_pos:(k0_pos + k_len)]
-    xq_out = torch.view_as_real(xq_ * xqm_).flatten(3)
-    xk_out = torch.view_as_real(xk_ * xkm_).flatten(3)
+def rotate_emb(x: torch.Tensor, freqs_cis, x0_pos: int = 0):
+    """
+    x: [bs, seq, nhead, d_head], x0_pos: the start position of x
+    freqs_cis: RotaryEmbedding, or complex table from precompute_freqs_cis
+    """
+    if(isinstance(freqs_cis, RotaryEmbedding)):
+        return freqs_cis.rotate(x, x0_pos)
+    x_len = x.shape[1]
+    freqs_cis = freqs_cis.to(x.device)
+    x_ = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
+    x_out = torch.view_as_real(x_ * freqs_cis[:, x0_pos:(x0_pos + x_len)]).flatten(3)
+    return x_out.type_as(x)
 
-    return xq_out.type_as(xq), xk_out.type_as(xk)
+def shift_rotary_emb(x: torch.Tensor, freqs_cis, shift: int):
+    """
+    Move already rotated x by shift positions (shift can be negative)
+    Rotations compose additively, so rotating position p by shift equals rotating p + shift
+    """
+    if(shift == 0):
+        return x
+    if(isinstance(freqs_cis, RotaryEmbedding)):
+        return freqs_cis.shift(x, shift)
+    rot = freqs_cis[0, abs(shift), 0].to(x.device)
+    if(shift < 0):
+        rot = rot.conj()
+    x_ = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
+    return torch.view_as_real(x_ * rot).flatten(-2).type_as(x)
 
 # Taken from facebookresearch/llama/model.py
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
@@ -54,6 +59,220 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 
     return freqs_cis
 
+class RotaryEmbedding(object):
+    """
+    Rotary embedding with the angles of precompute_freqs_cis, the tables are kept once for each device
+    real: rotate the (x[2i], x[2i+1]) pairs with cos / sin in the dtype of x (e.g. bf16 under autocast), without the float32 upcast
+        None: real arithmetic on accelerators, the complex float32 multiply on CPU, where it is a single vectorized kernel
+        and several times faster than the real-valued rotation
+    """
+    def __init__(self, dim: int, end: int, theta: float = 10000.0, real=None):
+        self.end = end
+        self.real = real
+        self.freqs_cis = precompute_freqs_cis(dim, end, theta)
+        # cos / sin repeated for each element of the pairs, sin signed as (-sin, sin): [1, end, 1, dim]
+        self.cos = self.freqs_cis.real.repeat_interleave(2, dim=-1)
+        self.sin = torch.stack((-self.freqs_cis.imag, self.freqs_cis.imag), dim=-1).flatten(-2)
+        self.tables = dict()
+
+    def __len__(self):
+        return self.end
+
+    def use_real(self, device):
+        if(self.real is None):
+            return device.type != 'cpu'
+        return self.real
+
+    def table(self, device):
+        """
+        (cos, sin) with real arithmetic, the complex table otherwise
+        """
+        key = (device, self.use_real(device))
+        if(key not in self.tables):
+            if(key[1]):
+                self.tables[key] = (self.cos.to(device), self.sin.to(device))
+            else:
+                self.tables[key] = self.freqs_cis.to(device)
+        return self.tables[key]
+
+    @staticmethod
+    def _rotate(x, cos, sin):
+        # (x1, x2) -> (x1 * cos - x2 * sin, x2 * cos + x1 * sin)
+        return torch.addcmul(x * cos, x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2), sin)
+
+    def rotate(self, x: torch.Tensor, x0_pos: int = 0):
+        """
+        x: [bs, seq, nhead, d_head], x0_pos: the start position of x
+        """
+        table = self.table(x.device)
+        if(not self.use_real(x.device)):
+            return rotate_emb(x, table, x0_pos)
+        cos, sin = table
+        x_len = x.shape[1]
+        return self._rotate(x, cos[:, x0_pos:(x0_pos + x_len)].to(x.dtype), sin[:, x0_pos:(x0_pos + x_len)].to(x.dtype))
+
+    def shift(self, x: torch.Tensor, shift: int):
+        """
+        Rotate all the positions of x (any layout with d_head last) by shift, shift can be negative
+        """
+        table = self.table(x.device)
+        if(not self.use_real(x.device)):
+            return shift_rotary_emb(x, table, shift)
+        cos, sin = table
+        cos = cos[0, abs(shift), 0].to(x.dtype)
+        sin = sin[0, abs(shift), 0].to(x.dtype)
+        if(shift < 0):
+            sin = -sin
+        return self._rotate(x, cos, sin)
+
+def rotary_length(freqs_cis):
+    """
+    Number of positions covered by a RotaryEmbedding or a complex table [1, end, 1, d_head // 2]
+    """
+    if(isinstance(freqs_cis, RotaryEmbedding)):
+        return len(freqs_cis)
+    return freqs_cis.shape[1]
+
+class KVStorage(object):
+    """
+    Preallocated key / value buffers shared by the KVCache views over them
+    The key in slot i is rotated at position i
+    """
+    def __init__(self, key, value, capacity):
+        bsz, nhead, length, _ = key.shape
+        capacity = max(capacity, length, 1)
+        self.key = key.new_empty((bsz, nhead, capacity, key.shape[-1]))
+        self.value = value.new_empty((bsz, nhead, capacity, value.shape[-1]))
+        self.key[:, :, :length] = key
+        self.value[:, :, :length] = value
+        self.views = weakref.WeakSet()
+
+    @property
+    def capacity(self):
+        return self.key.shape[2]
+
+    def writable(self, start, end):
+        """
+        Whether slots start...end-1 are free from all the alive views
+        """
+        for view in list(self.views):
+            if(view.start < end and view.end > start):
+                return False
+        return True
+
+    def compact(self, freqs_cis):
+        """
+        Move the slots used by the alive views to the front of the buffers, keys are rotated back by the same offset
+        All the views are re-pointed, their entries and relative positions are unchanged
+        """
+        views = list(self.views)
+        begin = min(view.start for view in views)
+        end = max(view.end for view in views)
+        if(begin < 1):
+            return
+        # the rotation writes a new tensor, so the overlapping source and target are never aliased
+        self.key[:, :, :end - begin] = shift_rotary_emb(self.key[:, :, begin:end], freqs_cis, -begin)
+        self.value[:, :, :end - begin] = self.value[:, :, begin:end].clone()
+        for view in views:
+            view.start -= begin
+
+class KVCache(object):
+    """
+    Key / Value cache of a self-attention layer, key and value: [bs, nhead, length, d_head]
+    A cache is a window start...end-1 over a KVStorage, its keys are stored after the rotary embedding at the positions
+    of their slots, so the next entry goes to position `end`; attention reads a plain slice of the buffers
+    The storage works as a ring: tail() only moves the start of the window, once the end of the buffers is reached
+    the alive windows are moved back to the front in place, and the buffers are reallocated only if they still do not fit
+    append() never modifies an existing cache (copy-on-write): it writes in place unless another alive cache on the
+    same storage covers the slots, e.g. the BlockRecurrentWrapper memory under update_memory=False
+    """
+    def __init__(self, storage, start, length, freqs_cis):
+        self.storage = storage
+        self.start = start
+        self.length = length
+        self.freqs_cis = freqs_cis
+        storage.views.add(self)
+
+    @classmethod
+    def create(cls, key, value, freqs_cis, capacity=None):
+        """
+        key: rotated from position 0
+        """
+        if(capacity is None):
+            capacity = 2 * key.shape[2]
+        return cls(KVStorage(key.detach(), value.detach(), capacity), 0, key.shape[2], freqs_cis)
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    @property
+    def key(self):
+        return self.storage.key[:, :, self.start:self.end]
+
+    @property
+    def value(self):
+        return self.storage.value[:, :, self.start:self.end]
+
+    def __len__(self):
+        return self.length
+
+    def reserve(self, n):
+        """
+        Returns a cache with the same entries where n entries can be written in place after `end`,
+        and whose positions end...end+n-1 are covered by the rotary table
+        Keys of the entries to append must be rotated from the `end` of the returned cache
+        """
+        e = self.end + n
+        limit = min(self.storage.capacity, rotary_length(self.freqs_cis))
+        if(self.storage.writable(self.end, e)):
+            if(e > limit and self.start > 0 and e - self.start <= limit):
+                # compaction keeps the order of the windows, the slots after this one stay free
+                self.storage.compact(self.freqs_cis)
+            if(self.end + n <= limit):
+                return self
+        storage = KVStorage(shift_rotary_emb(self.key, self.freqs_cis, -self.start), self.value,
+                            max(self.length + n, 2 * self.storage.capacity))
+        return KVCache(storage, 0, self.length, self.freqs_cis)
+
+    def append(self, key, value):
+        """
+        Returns a new cache with key, value ([bs, nhead, n, d_head]) placed after the current entries
+        key: rotated from position `end`
+        """
+        key = key.detach()
+        value = value.detach()
+        n = key.shape[2]
+        cache = self.reserve(n)
+        key = shift_rotary_emb(key, self.freqs_cis, cache.end - self.end)
+        cache.storage.key[:, :, cache.end:cache.end + n] = key
+        cache.storage.value[:, :, cache.end:cache.end + n] = value
+        return KVCache(cache.storage, cache.start, cache.length + n, self.freqs_cis)
+
+    def tail(self, n):
+        """
+        A new cache of the last n entries, a view on the same storage
+        """
+        n = min(n, self.length)
+        return KVCache(self.storage, self.end - n, n, self.freqs_cis)
+
+    def concat(self, other):
+        """
+        A new cache with the entries of other placed after the current ones
+        """
+        if(other.storage is self.storage and other.start == self.end):
+            # other continues this cache in the same storage, e.g. the cache returned with update_memory=False
+            return KVCache(self.storage, self.start, self.length + other.length, self.freqs_cis)
+        cache = self.reserve(len(other))
+        return cache.append(shift_rotary_emb(other.key, self.freqs_cis, cache.end - other.start), other.value)
+
+    def clone(self):
+        return KVCache.create(shift_rotary_emb(self.key, self.freqs_cis, -self.start), self.value, self.freqs_cis,
+                              capacity=self.storage.capacity)
+
+    def detach(self):
+        return self
+
 class RoPEMultiheadAttention(nn.Module):
     def __init__(self, d_model, nheads, dropout=0.10):
         super().__init__()
@@ -100,9 +319,58 @@ class RoPEMultiheadAttention(nn.Module):
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis, q0_pos=q0_pos, k0_pos=k0_pos)
 
         # Reshape for attention calculation: (b_sz, n_head, s_len, d_head)
-        xq = xq.transpose(1, 2)
-        xk = xk.transpose(1, 2)
-        xv = xv.transpose(1, 2)
+        return self.attend(xq.transpose(1, 2), xk.transpose(1, 2), xv.transpose(1, 2), attn_mask)
+
+    def key_value(self, x: torch.Tensor, freqs_cis: torch.Tensor, x0_pos=0):
+        """
+        Rotated keys and values of x: (b_sz, n_head, s_len, d_head)
+        """
+        batch_size, x_len, _ = x.shape
+        xk = self.klayer(x).view(batch_size, x_len, self.n_heads, self.d_head)
+        xv = self.vlayer(x).view(batch_size, x_len, self.n_heads, self.d_head)
+        xk = rotate_emb(xk, freqs_cis, x0_pos)
+        return xk.transpose(1, 2), xv.transpose(1, 2)
+
+    def incremental(self, x: torch.Tensor, freqs_cis: torch.Tensor, cache=None, attn_mask=None, need_cache=False, is_causal=False):
+        """
+        Self-attention of x placed after the positions in cache, only x is projected
+        x_shape: [bs, seq, hidden]
+        cache: KVCache or None
+        attn_mask: boolean (True to attend) or additive float mask, is_causal: apply causal masking in the fused kernel
+        Returns the output and the cache extended with x (None if need_cache is False)
+        """
+        batch_size, q_len, _ = x.shape
+        if(cache is not None):
+            cache = cache.reserve(q_len)
+        x0_pos = 0 if cache is None else cache.end
+        xq = self.qlayer(x).view(batch_size, q_len, self.n_heads, self.d_head)
+        xq = rotate_emb(xq, freqs_cis, x0_pos).transpose(1, 2)
+        xk, xv = self.key_value(x, freqs_cis, x0_pos=x0_pos)
+
+        new_cache = None
+        if(cache is None):
+            keys, values = xk, xv
+            if(need_cache):
+                new_cache = KVCache.create(xk, xv, freqs_cis)
+        elif(torch.is_grad_enabled() and (xk.requires_grad or xv.requires_grad)):
+            # The cache is detached, keep the current keys and values in the graph
+            keys = torch.cat([cache.key.to(xk.dtype), xk], dim=2)
+            values = torch.cat([cache.value.to(xv.dtype), xv], dim=2)
+            if(need_cache):
+                new_cache = cache.append(xk, xv)
+        else:
+            new_cache = cache.append(xk, xv)
+            keys, values = new_cache.key, new_cache.value
+            if(not need_cache):
+                new_cache = None
+
+        return self.attend(xq, keys, values, attn_mask, is_causal=is_causal), new_cache
+
+    def attend(self, xq, xk, xv, attn_mask=None, is_causal=False):
+        """
+        xq, xk, xv: (b_sz, n_head, s_len, d_head)
+        """
+        batch_size, _, q_len, _ = xq.shape
 
         # Required as we are not using a nn.Dropout layer
         if self.training:
@@ -110,14 +378,14 @@ class RoPEMultiheadAttention(nn.Module):
         else:
             att_dropout = 0.0
 
-        # Using beta torch functionality (subject to change)
-        # See - https://shorturl.at/jtI17
-        att = scaled_dot_product_attention(
-            query=xq,
-            key=xk,
-            value=xv,
+        # Fused attention, the score matrix is not materialized where the backend allows
+        att = F.scaled_dot_product_attention(
+            xq,
+            xk.to(xq.dtype),
+            xv.to(xq.dtype),
             attn_mask=attn_mask,
             dropout_p=att_dropout,
+            is_causal=is_causal,
         )
 
         # Shape (b_sz, s_len, n_head, d_head)
@@ -127,10 +395,24 @@ class RoPEMultiheadAttention(nn.Module):
         return self.resid_dropout(self.att_proj_linear(out))
 
 if __name__=="__main__":
+    import time
     rmha = RoPEMultiheadAttention(128, 8, 0.10)
     freqs_cis = precompute_freqs_cis(128 // 8, 1024)
+    rope = RotaryEmbedding(128 // 8, 1024)
     q = torch.randn(4, 512, 128)
     k = torch.randn(4, 1024, 128)
     v = torch.randn(4, 1024, 128)
-    output = rmha(q, k, v, freqs_cis, attn_mask=None, q0_pos=512, k0_pos=0)
+    output = rmha(q, k, v, rope, attn_mask=None, q0_pos=512, k0_pos=0)
     print(output.shape)
+
+    # CPU throughput of the complex and the real-valued rotations (parity: tests/test_rope.py)
+    real_rope = RotaryEmbedding(128 // 8, 1024, real=True)
+    x = torch.randn(4, 512, 8, 16)
+    for name, table, dtype in [("complex float32", rope, torch.float32), ("complex bf16", rope, torch.bfloat16),
+                               ("real float32", real_rope, torch.float32), ("real bf16", real_rope, torch.bfloat16)]:
+        xt = x.to(dtype)
+        rotate_emb(xt, table, 100)
+        t0 = time.perf_counter()
+        for _ in range(50):
+            rotate_emb(xt, table, 100)
+        print(f"{name}: {(time.perf_counter() - t0) / 50 * 1000:.3f} ms per rotation")
@@ -1,10 +1,110 @@
 import torch
 from torch import nn
-from fla.models.rwkv6.modeling_rwkv6 import RWKV6Block
-from fla.models.rwkv6.configuration_rwkv6 import RWKV6Config
-from fla.models.utils import Cache
-from airsoul.utils import format_cache, memory_cpy, log_warn
+from torch.nn import functional as F
+from airsoul.utils import format_cache, memory_borrow, log_warn
+from .linear_attention import fla_available, chunk_gla, recurrent_gla, token_shift, sqrelu, LerpLinear, DDLerpLinear
 
+# Without the fla Triton kernels (no CUDA or no fla), the plain PyTorch block below is used instead
+if(fla_available()):
+    from fla.models.rwkv6.modeling_rwkv6 import RWKV6Block
+    from fla.models.rwkv6.configuration_rwkv6 import RWKV6Config
+    from fla.models.utils import Cache
+
+class TorchRWKV6Block(nn.Module):
+    """
+    RWKV6 block in plain PyTorch, following fla RWKV6Block:
+    pre-norm, time mixing (data-dependent token shift, decays and bonus) and channel mixing with residual connections
+    gate_bound: upper bound of the decay rates, i.e. lower bound of the log decays
+    State: {'recurrent_state': [B, H, K, V], 'conv_state': last input of the time mixing, 'ffn_state': last input of the channel mixing}
+    """
+    def __init__(self,
+                hidden_size: int=512,
+                expand_k: float=0.5,
+                expand_v: float=1,
+                hidden_ratio: float=3.5,
+                intermediate_size: int=None,
+                num_heads: int=4,
+                gate_bound: float=50.0,
+                proj_low_rank_dim: int=32,
+                gate_low_rank_dim: int=64,
+                norm_eps: float=1.0e-5,
+                mode: str='chunk',
+                chunk_size: int=32):
+        super().__init__()
+        self.mode = mode
+        self.num_heads = num_heads
+        self.key_dim = int(hidden_size * expand_k)
+        self.value_dim = int(hidden_size * expand_v)
+        self.proj_low_rank_dim = proj_low_rank_dim
+        self.gate_bound = gate_bound
+        self.chunk_size = chunk_size
+        if(intermediate_size is None):
+            intermediate_size = 32 * ((int(hidden_size * hidden_ratio) + 31) // 32)
+
+        self.pre_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+        self.attn_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+        self.ffn_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+
+        # Time mixing
+        self.x_proj = nn.Sequential(LerpLinear(hidden_size, proj_low_rank_dim * 5),
+                                    nn.Tanh(),
+                                    nn.Linear(proj_low_rank_dim * 5, hidden_size, bias=False))
+        self.x_bias = nn.Parameter(torch.zeros(5, hidden_size))
+        self.r_proj = DDLerpLinear(hidden_size, self.key_dim)
+        self.w_proj = DDLerpLinear(hidden_size, self.key_dim, low_rank_dim=gate_low_rank_dim)
+        self.k_proj = DDLerpLinear(hidden_size, self.key_dim)
+        self.v_proj = DDLerpLinear(hidden_size, self.value_dim)
+        self.g_proj = DDLerpLinear(hidden_size, self.value_dim)
+        self.bonus = nn.Parameter(torch.zeros(num_heads, self.key_dim // num_heads))
+        self.g_norm = nn.GroupNorm(num_heads, self.value_dim, eps=norm_eps)
+        self.o_proj = nn.Linear(self.value_dim, hidden_size, bias=False)
+
+        # Channel mixing
+        self.key = LerpLinear(hidden_size, intermediate_size)
+        self.value = nn.Linear(intermediate_size, hidden_size, bias=False)
+        self.receptance = LerpLinear(hidden_size, hidden_size)
+
+    def time_mixing(self, x, state):
+        B, T, H = x.shape
+        delta = token_shift(x, None if state is None else state['conv_state']) - x
+        mix = self.x_proj[0](x, delta).view(B, T, -1, self.proj_low_rank_dim)
+        mix = torch.einsum('btnr,hnr->btnh', self.x_proj[1](mix), self.x_proj[2].weight.view(H, 5, -1))
+        r, w, k, v, g = (mix + self.x_bias).unbind(-2)
+        r = self.r_proj(x, r, delta).view(B, T, self.num_heads, -1)
+        w = -self.w_proj(x, w, delta).exp().clamp(max=self.gate_bound)
+        k = self.k_proj(x, k, delta).view(B, T, self.num_heads, -1)
+        v = self.v_proj(x, v, delta).view(B, T, self.num_heads, -1)
+        g = self.g_proj(x, g, delta)
+        w = w.view(B, T, self.num_heads, -1)
+
+        initial_state = None if state is None else state['recurrent_state']
+        if(self.mode == 'fused_recurrent' or T == 1):
+            o, final_state = recurrent_gla(r, k, v, w, u=self.bonus, scale=1.0,
+                                           initial_state=initial_state, output_final_state=True)
+        else:
+            o, final_state = chunk_gla(r, k, v, w, u=self.bonus, scale=1.0,
+                                       initial_state=initial_state, output_final_state=True, chunk_size=self.chunk_size)
+        o = self.g_norm(o.reshape(B * T, self.value_dim)).view(B, T, self.value_dim) * F.silu(g)
+        return self.o_proj(o), final_state
+
+    def channel_mixing(self, x, state):
+        delta = token_shift(x, None if state is None else state['ffn_state']) - x
+        return torch.sigmoid(self.receptance(x, delta)) * self.value(sqrelu(self.key(x, delta)))
+
+    def forward(self, x, state=None, use_cache=False):
+        """
+        state: dict or None, it is not modified
+        Returns the output and the new state (None if use_cache is False)
+        """
+        residual = self.pre_norm(x)
+        h = self.attn_norm(residual)
+        o, final_state = self.time_mixing(h, state)
+        residual = residual + o
+        h2 = self.ffn_norm(residual)
+        out = residual + self.channel_mixing(h2, state)
+        if(not use_cache):
+            return out, None
+        return out, {'recurrent_state': final_state, 'conv_state': h[:, -1], 'ffn_state': h2[:, -1]}
 
 class RWKV6Layer(nn.Module):
     def __init__(self,
@@ -17,25 +117,39 @@ class RWKV6Layer(nn.Module):
                 layer_idx: int = 0,
                 gate_bound: float=50.0):
         super().__init__()
-        self.config = RWKV6Config(
-                  hidden_size=io_size,
-                  expand_k=expand_k,
-                  expand_v=expand_v,
-                  hidden_ratio=hidden_ratio,
-                  intermediate_size=intermediate_size,
-                  num_heads=num_heads,
-                  gate_bound=gate_bound)
         self.layer_idx = layer_idx
-        self.encoder = RWKV6Block(
-                  self.config,
-                  layer_idx=0)
+        self.use_fla = fla_available()
+        if(self.use_fla):
+            self.config = RWKV6Config(
+                      hidden_size=io_size,
+                      expand_k=expand_k,
+                      expand_v=expand_v,
+                      hidden_ratio=hidden_ratio,
+                      intermediate_size=intermediate_size,
+                      num_heads=num_heads,
+                      gate_bound=gate_bound)
+            self.encoder = RWKV6Block(
+                      self.config,
+                      layer_idx=0)
+        else:
+            self.encoder = TorchRWKV6Block(
+                      hidden_size=io_size,
+                      expand_k=expand_k,
+                      expand_v=expand_v,
+                      hidden_ratio=hidden_ratio,
+                      intermediate_size=intermediate_size,
+                      num_heads=num_heads,
+                      gate_bound=gate_bound)
 
     def forward(self, x, cache=None, need_cache=False):
+        if(not self.use_fla):
+            return self.encoder(x, state=cache, use_cache=(need_cache or cache is not None))
+
         if(need_cache and cache is None):
             cache = Cache.from_legacy_cache(None)
         elif(cache is not None):
-            # avoid in-place modification of the cache
-            cache = Cache.from_legacy_cache([memory_cpy(cache)])
+            # fla updates the states in place, the input cache is left untouched for the caller
+            cache = Cache.from_legacy_cache([memory_borrow(cache)])
 
         use_cache = (cache is not None)
 
@@ -1,10 +1,122 @@
 import torch
 from torch import nn
-from fla.models.rwkv7.modeling_rwkv7 import RWKV7Block
-from fla.models.rwkv7.configuration_rwkv7 import RWKV7Config
-from fla.models.utils import Cache
-from airsoul.utils import format_cache, memory_cpy, log_warn
+from torch.nn import functional as F
+from airsoul.utils import format_cache, memory_borrow, log_warn
+from .linear_attention import fla_available, chunk_dplr, recurrent_dplr, token_shift, sqrelu, LoRA
 
+# Without the fla Triton kernels (no CUDA or no fla), the plain PyTorch block below is used instead
+if(fla_available()):
+    from fla.models.rwkv7.modeling_rwkv7 import RWKV7Block
+    from fla.models.rwkv7.configuration_rwkv7 import RWKV7Config
+    from fla.models.utils import Cache
+
+class TorchRWKV7Block(nn.Module):
+    """
+    RWKV7 block in plain PyTorch, following fla RWKV7Block:
+    pre-norm, time mixing with the generalized delta rule and channel mixing with residual connections
+    is_first_layer: the values of this layer are v_first, the other layers interpolate their values towards v_first
+    State: {'recurrent_state': [B, H, K, V], 'conv_state': last input of the time mixing, 'ffn_state': last input of the channel mixing}
+    """
+    def __init__(self,
+                hidden_size: int=512,
+                intermediate_size: int=None,
+                num_heads: int=4,
+                is_first_layer: bool=False,
+                hidden_ratio: float=4,
+                decay_low_rank_dim: int=64,
+                gate_low_rank_dim: int=128,
+                a_low_rank_dim: int=64,
+                v_low_rank_dim: int=16,
+                norm_eps: float=1.0e-5,
+                mode: str='chunk',
+                chunk_size: int=32):
+        super().__init__()
+        self.mode = mode
+        self.num_heads = num_heads
+        self.head_dim = hidden_size // num_heads
+        self.is_first_layer = is_first_layer
+        self.chunk_size = chunk_size
+        if(intermediate_size is None):
+            intermediate_size = int(hidden_size * hidden_ratio)
+
+        self.pre_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+        self.attn_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+        self.ffn_norm = nn.LayerNorm(hidden_size, eps=norm_eps)
+
+        # Time mixing
+        self.x_r, self.x_w, self.x_k, self.x_v, self.x_a, self.x_g = (
+            nn.Parameter(torch.zeros(1, 1, hidden_size)) for _ in range(6))
+        self.k_k = nn.Parameter(torch.zeros(hidden_size))
+        self.k_a = nn.Parameter(torch.zeros(hidden_size))
+        self.r_k = nn.Parameter(torch.zeros(num_heads, self.head_dim))
+        self.r_proj = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.k_proj = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.v_proj = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.o_proj = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.w_lora = LoRA(hidden_size, hidden_size, low_rank_dim=decay_low_rank_dim, activation='tanh')
+        if(not is_first_layer):
+            self.v_lora = LoRA(hidden_size, hidden_size, low_rank_dim=v_low_rank_dim, activation=None)
+        self.a_lora = LoRA(hidden_size, hidden_size, low_rank_dim=a_low_rank_dim, activation=None)
+        self.g_lora = LoRA(hidden_size, hidden_size, low_rank_dim=gate_low_rank_dim, activation='sigmoid', bias=False)
+        self.g_norm = nn.GroupNorm(num_heads, hidden_size, eps=self.head_dim * norm_eps)
+
+        # Channel mixing
+        self.ffn_x_k = nn.Parameter(torch.zeros(hidden_size))
+        self.key = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.value = nn.Linear(intermediate_size, hidden_size, bias=False)
+
+    def time_mixing(self, x, state, v_first):
+        B, T, D = x.shape
+        delta = token_shift(x, None if state is None else state['conv_state']) - x
+        xr, xw, xk, xv, xa, xg = (torch.addcmul(x, delta, mu) for mu in (self.x_r, self.x_w, self.x_k, self.x_v, self.x_a, self.x_g))
+
+        r = self.r_proj(xr)
+        # log decays, the decays are within (exp(-exp(-0.5)), 1)
+        w = -0.6065306597126334 * self.w_lora(xw).sigmoid()
+        k = self.k_proj(xk)
+        v = self.v_proj(xv)
+        if(self.is_first_layer):
+            v_first = v
+        else:
+            v = torch.lerp(v, v_first, self.v_lora(xv).sigmoid())
+        a = self.a_lora(xa).sigmoid()
+        g = self.g_lora(xg)
+
+        kk = F.normalize((k * self.k_k).view(B, T, self.num_heads, -1), dim=-1, eps=1.0e-6)
+        k = k.addcmul(k * (a - 1), self.k_a)
+        r, w, k, v, a = (t.view(B, T, self.num_heads, -1) for t in (r, w, k, v, a))
+
+        # Remove the value read along kk with the learning rate a, then write the new key-value pair
+        initial_state = None if state is None else state['recurrent_state']
+        if(self.mode == 'fused_recurrent' or T == 1):
+            o, final_state = recurrent_dplr(r, k, v, -kk, kk * a, w, scale=1.0,
+                                            initial_state=initial_state, output_final_state=True)
+        else:
+            o, final_state = chunk_dplr(r, k, v, -kk, kk * a, w, scale=1.0,
+                                        initial_state=initial_state, output_final_state=True, chunk_size=self.chunk_size)
+
+        o = self.g_norm(o.reshape(B * T, D)).view(B, T, D)
+        o = o + ((r * k * self.r_k).sum(-1, keepdim=True) * v).view(B, T, D)
+        return self.o_proj(o * g), final_state, v_first
+
+    def channel_mixing(self, x, state):
+        delta = token_shift(x, None if state is None else state['ffn_state']) - x
+        return self.value(sqrelu(self.key(torch.addcmul(x, delta, self.ffn_x_k))))
+
+    def forward(self, x, state=None, use_cache=False, v_first=None):
+        """
+        state: dict or None, it is not modified
+        Returns the output, the new state (None if use_cache is False) and v_first
+        """
+        residual = self.pre_norm(x)
+        h = self.attn_norm(residual)
+        o, final_state, v_first = self.time_mixing(h, state, v_first)
+        residual = residual + o
+        h2 = self.ffn_norm(residual)
+        out = residual + self.channel_mixing(h2, state)
+        if(not use_cache):
+            return out, None, v_first
+        return out, {'recurrent_state': final_state, 'conv_state': h[:, -1], 'ffn_state': h2[:, -1]}, v_first
 
 class RWKV7Layer(nn.Module):
     def __init__(self,
@@ -13,32 +125,46 @@ class RWKV7Layer(nn.Module):
                 num_heads: int = 4,
                 layer_idx: int = 0):
         super().__init__()
-        self.config = RWKV7Config(
-                  hidden_size=io_size,
-                  intermediate_size=intermediate_size,
-                  num_heads=num_heads)
         self.layer_idx = layer_idx
         if layer_idx == 0:
             is_first_layer = True
         else:
             is_first_layer = False
-        self.encoder = RWKV7Block(
-                  self.config,
-                  layer_idx=0,
-                  is_first_layer = is_first_layer)
+        self.use_fla = fla_available()
+        if(self.use_fla):
+            self.config = RWKV7Config(
+                      hidden_size=io_size,
+                      intermediate_size=intermediate_size,
+                      num_heads=num_heads)
+            self.encoder = RWKV7Block(
+                      self.config,
+                      layer_idx=0,
+                      is_first_layer = is_first_layer)
+        else:
+            self.encoder = TorchRWKV7Block(
+                      hidden_size=io_size,
+                      intermediate_size=intermediate_size,
+                      num_heads=num_heads,
+                      is_first_layer=is_first_layer)
 
     def forward(self, x, cache=None, need_cache=False):
-        if(need_cache and cache is None):
-            cache_ = Cache.from_legacy_cache(None)
-        elif(cache is not None):
-            # avoid in-place modification of the cache
-            cache_copy = memory_cpy(cache)
-            cache_ = Cache.from_legacy_cache([cache_copy[0]])
-
         if cache is None:
             v_first = v_first = torch.zeros_like(x)
         else:
-            v_first = cache_copy[1]
+            # only read by the block
+            v_first = cache[1].detach()
+
+        if(not self.use_fla):
+            out, new_state, v_first = self.encoder(x, state=None if cache is None else cache[0],
+                                                   use_cache=(need_cache or cache is not None), v_first=v_first)
+            return out, (new_state, v_first)
+
+        cache_ = None
+        if(need_cache and cache is None):
+            cache_ = Cache.from_legacy_cache(None)
+        elif(cache is not None):
+            # fla updates the states in place, the input cache is left untouched for the caller
+            cache_ = Cache.from_legacy_cache([memory_borrow(cache[0])])
 
         use_cache = (cache_ is not None)
 
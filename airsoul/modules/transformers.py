@@ -1,10 +1,22 @@
 import copy
 import torch
 import torch.nn as nn
-from .rope_mha import RoPEMultiheadAttention, precompute_freqs_cis
+from .rope_mha import RoPEMultiheadAttention, KVCache, RotaryEmbedding
 from torch.utils.checkpoint import checkpoint
 from airsoul.utils import Logger, log_progress, log_debug, log_warn, log_fatal
 
+def causal_mask(qs, e, context_window=-1, device=None):
+    """
+    Boolean mask [e - qs, e] of queries at positions qs...e-1 over keys at 0...e-1, True for visible keys
+    Query i attends to keys j with i - context_window <= j <= i (no lower bound if context_window < 0)
+    """
+    q_pos = torch.arange(qs, e, device=device).unsqueeze(1)
+    k_pos = torch.arange(0, e, device=device).unsqueeze(0)
+    mask = (k_pos <= q_pos)
+    if(context_window > -1):
+        mask = mask & (k_pos >= q_pos - context_window)
+    return mask
+
 class ARTransformerEncoderLayer(nn.Module):
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1):
         super(ARTransformerEncoderLayer, self).__init__()
@@ -24,22 +36,18 @@ class ARTransformerEncoderLayer(nn.Module):
                 src : torch.Tensor, 
                 rope : torch.Tensor, 
                 attn_mask : torch.Tensor, 
-                cache=None):
+                cache=None,
+                need_cache=False,
+                is_causal=False):
         """
-        Cache: B, NT, H
+        Cache: KVCache of the previous positions, or None
+        attn_mask: boolean mask or None, is_causal: use the fused causal masking instead
         SRC: Other Parts
+        Returns the output and the cache extended with src (None if need_cache is False)
         """
         # Self Attention
-        if cache is not None:
-            q0_pos=cache.shape[1]
-            kv = self.norm1(torch.cat([cache, src], dim=1))
-            output = kv[:, q0_pos:]
-        else:
-            q0_pos=0
-            output = self.norm1(src)
-            kv = output
-        
-        output = self.self_attn(output, kv, kv, rope, attn_mask=attn_mask, q0_pos=q0_pos)
+        output, new_cache = self.self_attn.incremental(self.norm1(src), rope, 
+                cache=cache, attn_mask=attn_mask, need_cache=need_cache, is_causal=is_causal)
 
         # Residual Connection
         output = src + output
@@ -48,7 +56,20 @@ class ARTransformerEncoderLayer(nn.Module):
         output = output + self.dropout(self.linear2(self.dropout(self.activation(self.linear1(self.norm2(output))))))
 
         # Apply other layers and return output
-        return output
+        return output, new_cache
+
+    def extend_cache(self, src, rope, cache=None):
+        """
+        Extend the cache with src without computing the outputs
+        """
+        with torch.no_grad():
+            if(cache is not None):
+                cache = cache.reserve(src.shape[1])
+            x0_pos = 0 if cache is None else cache.end
+            xk, xv = self.self_attn.key_value(self.norm1(src), rope, x0_pos=x0_pos)
+            if(cache is None):
+                return KVCache.create(xk, xv, rope)
+            return cache.append(xk, xv)
 
 class ARTransformerEncoder(nn.Module):
     def __init__(self, 
@@ -66,42 +87,50 @@ class ARTransformerEncoder(nn.Module):
         self.d_head = d_model // nhead
         self.max_position_encoding = max_position_encoding
 
-        attn_mask = (torch.triu(torch.ones(max_position_encoding, max_position_encoding)) == 1).transpose(1, 0)
-        attn_mask = attn_mask.float().masked_fill(attn_mask == False, float('-inf')).masked_fill(attn_mask == True, float(0.0))
-
+        # The causal mask is generated on the fly for each call instead of being kept as a dense buffer
         # If context-free, only window of 2 is allowed
+        self.context_window = context_window
         if(context_window > -1):
-            ext_mask = (torch.triu(torch.ones(max_position_encoding, max_position_encoding), diagonal=-context_window) == 1)
-            attn_mask = attn_mask.masked_fill(ext_mask == False, float('-inf'))
-            log_warn(f"[Warning] Context-Window is applied, Use an attention mask of {attn_mask}")
+            log_warn(f"[Warning] Context-Window is applied, each position attends to the previous {context_window} positions")
 
-        self.rope_embedding = precompute_freqs_cis(self.d_head, self.max_position_encoding)
-        self.register_buffer('attn_mask', attn_mask)
+        self.rope_embedding = RotaryEmbedding(self.d_head, self.max_position_encoding)
+
+    def attention_mask(self, qs, e, device):
+        """
+        Returns (attn_mask, is_causal) for queries at positions qs...e-1
+        """
+        if(self.context_window < 0):
+            if(qs == 0):
+                return None, True
+            elif(e - qs == 1):
+                # A single query at the end sees all the keys
+                return None, False
+        return causal_mask(qs, e, self.context_window, device=device), False
 
     def forward(self, src, cache=None, need_cache=False, checkpoints_density=-1):
+        """
+        cache: list of KVCache, one for each layer
+        """
         # Every checkpoints_density we arrange a checkpoint
         # If checkpoints_density < 1 we do not use checkpoints
         # Calculate Cache Size
         l = src.shape[1]
-        ks = 0
         if(cache is None):
             qs = 0
             e = l
         else:
-            qs = cache[0].shape[1]
+            qs = len(cache[0])
             e = qs + l
             
         if(e > self.max_position_encoding):
             log_fatal(f"The sequence length input to ARTransformerEncoder {e} "
                    + f"is larger than max_position_encoding {self.max_position_encoding}")
         new_cache = None
+        if(need_cache):
+            new_cache = []
 
         output=src
-        if(need_cache):
-            if(cache is not None):
-                new_cache = [torch.cat([cache[0], output.detach()], dim=1)]
-            else:
-                new_cache = [output.detach()]
+        attn_mask, is_causal = self.attention_mask(qs, e, src.device)
         for i, layer in enumerate(self.layers):
             if(checkpoints_density < 1):
                 need_checkpoint=False
@@ -109,18 +138,17 @@ class ARTransformerEncoder(nn.Module):
                 need_checkpoint=True
             else:
                 need_checkpoint=False
-            if(cache is not None):
-                if(not need_checkpoint):
-                    output = layer(output, self.rope_embedding, self.attn_mask[qs:e, ks:e], cache[i]) 
-                else:
-                    output = checkpoint(lambda x: layer(x, self.rope_embedding, self.attn_mask[qs:e, ks:e], cache[i]), output)
-                if(need_cache):
-                    new_cache.append(torch.cat([cache[i + 1], output.detach()], dim=1))
+            l_cache = None if cache is None else cache[i]
+            if(not need_checkpoint):
+                output, n_cache = layer(output, self.rope_embedding, attn_mask, 
+                                        cache=l_cache, need_cache=need_cache, is_causal=is_causal)
             else:
-                if(not need_checkpoint):
-                    output = layer(output, self.rope_embedding, self.attn_mask[qs:e, ks:e])
-                else:
-                    output = checkpoint(lambda x: layer(x, self.rope_embedding, self.attn_mask[qs:e, ks:e]), output)
+                layer_in = output
+                # Bind layer and cache now, the function is called again during backward
+                output = checkpoint(lambda x, layer=layer, l_cache=l_cache: 
+                                    layer(x, self.rope_embedding, attn_mask, cache=l_cache, is_causal=is_causal)[0], layer_in)
                 if(need_cache):
-                    new_cache.append(output.detach())
+                    n_cache = layer.extend_cache(layer_in, self.rope_embedding, cache=l_cache)
+            if(need_cache):
+                new_cache.append(n_cache)
         return output, new_cache
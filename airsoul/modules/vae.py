@@ -1,4 +1,5 @@
 import torch
+import hashlib
 from torch import nn
 from torch.nn import functional as F
 from airsoul.utils import weighted_loss
@@ -32,6 +33,16 @@ class VAE(nn.Module):
         z_log_var = z_log_var.reshape(nB, nT, self.hidden_size)
         return z_exp, z_log_var
 
+    def checksum(self):
+        """
+        Hash of the VAE weights, keys the latents cached on disk so that they are invalidated when the VAE changes
+        """
+        sha = hashlib.sha1()
+        for name, tensor in sorted(self.state_dict().items()):
+            sha.update(name.encode())
+            sha.update(tensor.detach().float().cpu().numpy().tobytes())
+        return sha.hexdigest()[:12]
+
     def reconstruct(self,inputs, _sigma=1.0):
         nB, nT, nC, nW, nH = inputs.shape
         z_exp, z_log_var = self.forward(inputs)
@@ -1,13 +1,23 @@
 from .losses import weighted_loss, parameters_regularization
 from .scheduler import LinearScheduler, noam_scheduler
-from .video_writer import VideoWriter
 from .stats import DistStatistics
 from .data_proc import rewards2go, img_pro, img_post, downsample, sa_dropout
-from .tools import model_path, safety_check, count_parameters,  format_cache, memory_cpy, check_model_validity, custom_load_model, apply_gradient_safely
+from .tools import model_path, safety_check, count_parameters,  format_cache, memory_cpy, memory_detach, memory_borrow, check_model_validity, custom_load_model, apply_gradient_safely, fused_safety_check, mmap_load
 from .tools import Configure, Logger, log_warn, log_debug, log_progress, log_fatal
-from .tools import create_folder, import_with_caution, plotLongDemo
-from .trainer import EpochManager, Runner
-from .generator import GeneratorRunner, GeneratorBase
+from .tools import create_folder, import_with_caution, plotLongDemo, lazy_attributes
+from .grad_sync import BucketedAllReduce, final_backward
+from .profiler import StepProfiler, PROFILE_PHASES
+from .checkpoint import AsyncCheckpointWriter, atomic_save
 from .vocab import tag_vocabulary, tag_mapping_gamma, tag_mapping_id
-from .visualization import AgentVisualizer
-from .rl_base import TabularQ
\ No newline at end of file
+
+# The trainer, the generators and the plotting / gym stacks are only imported on first access,
+# e.g. data loader workers importing the data sets do not pay for them
+__getattr__ = lazy_attributes(__name__, {
+    "EpochManager": ".trainer",
+    "Runner": ".trainer",
+    "GeneratorRunner": ".generator",
+    "GeneratorBase": ".generator",
+    "VideoWriter": ".video_writer",
+    "AgentVisualizer": ".visualization",
+    "TabularQ": ".rl_base",
+})
@@ -0,0 +1,159 @@
+import os
+import re
+import random
+import shutil
+import numpy
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from .tools import log_warn, log_debug
+
+"""
+Asynchronous and atomic checkpoint writing
+
+The state dict is snapshotted to CPU memory in the calling thread, then serialized by a background writer
+to a temporary file that is renamed over the target: an interrupted save never leaves a truncated checkpoint.
+"""
+
+def atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if(os.path.exists(tmp_path)):
+            os.remove(tmp_path)
+
+def cpu_snapshot(state, memo=None):
+    """
+    Copy of a (nested) state dict with all the tensors in CPU memory, a tensor referenced twice is copied once
+    """
+    if(memo is None):
+        memo = dict()
+    if(isinstance(state, torch.Tensor)):
+        if(id(state) not in memo):
+            memo[id(state)] = state.detach().to('cpu', copy=True)
+        return memo[id(state)]
+    elif(isinstance(state, dict)):
+        return type(state)((k, cpu_snapshot(v, memo)) for k, v in state.items())
+    elif(isinstance(state, list) or isinstance(state, tuple)):
+        return type(state)(cpu_snapshot(v, memo) for v in state)
+    return state
+
+def get_rng_states():
+    states = {"torch": torch.get_rng_state(),
+              "numpy": numpy.random.get_state(),
+              "random": random.getstate()}
+    if(torch.cuda.is_available()):
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"])
+    numpy.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+    if(torch.cuda.is_available() and "cuda" in states):
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+def training_state_path(ckpt_path, name):
+    return f'{ckpt_path}/training_state_{name}.pth'
+
+def latest_training_checkpoint(save_model_path):
+    """
+    The latest ckpt_XX directory under save_model_path containing a training state, None if there is none
+    """
+    if(not os.path.isdir(save_model_path)):
+        return None
+    ckpts = []
+    for name in os.listdir(save_model_path):
+        match = re.fullmatch(r"ckpt_(\d+)", name)
+        path = os.path.join(save_model_path, name)
+        if(match is not None and os.path.isdir(path)
+                and any(file.startswith("training_state_") for file in os.listdir(path))):
+            ckpts.append((int(match.group(1)), path))
+    if(len(ckpts) < 1):
+        return None
+    return max(ckpts)[1]
+
+def rotate_checkpoints(save_model_path, keep):
+    """
+    Remove all but the `keep` latest ckpt_XX directories
+    """
+    ckpts = []
+    for name in os.listdir(save_model_path):
+        match = re.fullmatch(r"ckpt_(\d+)", name)
+        if(match is not None and os.path.isdir(os.path.join(save_model_path, name))):
+            ckpts.append((int(match.group(1)), name))
+    for _, name in sorted(ckpts)[:-keep]:
+        shutil.rmtree(os.path.join(save_model_path, name), ignore_errors=True)
+
+class AsyncCheckpointWriter(object):
+    """
+    Write checkpoints in a background thread
+    max_inflight: number of snapshots waiting or being written, save() blocks until the oldest one finishes beyond it
+    keep_checkpoints: number of latest ckpt_XX directories retained under save_model_path, None or <= 0 keeps all
+    A failed write is raised by the next save(), wait() or close()
+    """
+    def __init__(self, save_model_path=None, max_inflight=1, keep_checkpoints=None, verbose=False):
+        self.save_model_path = save_model_path
+        self.max_inflight = max(1, max_inflight)
+        self.keep_checkpoints = keep_checkpoints
+        self.verbose = verbose
+        # A single worker keeps the writes and the rotation in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.inflight = []
+        self.error = None
+
+    def _write(self, state, path):
+        try:
+            atomic_save(state, path)
+            log_debug(f"...saved checkpoint {path}", on=self.verbose)
+            if(self.save_model_path is not None and self.keep_checkpoints is not None and self.keep_checkpoints > 0):
+                rotate_checkpoints(self.save_model_path, self.keep_checkpoints)
+            return True
+        except Exception as e:
+            log_warn(f"Failed to save checkpoint {path}: {e}")
+            if(self.error is None):
+                self.error = e
+            return False
+
+    def _write_files(self, files):
+        # The remaining files of a checkpoint that failed are not written
+        for path, state in files.items():
+            if(not self._write(state, path)):
+                break
+
+    def raise_error(self):
+        """
+        Raise the first write failure since the last call, if any
+        """
+        if(self.error is not None):
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state_dict, path, extra_files=None):
+        """
+        extra_files: {path: state} written after state_dict, all of them share a single CPU snapshot
+        """
+        files = {path: state_dict}
+        if(extra_files is not None):
+            files.update(extra_files)
+        self.inflight = [future for future in self.inflight if not future.done()]
+        while(len(self.inflight) >= self.max_inflight):
+            self.inflight.pop(0).result()
+        self.raise_error()
+        self.inflight.append(self.executor.submit(self._write_files, cpu_snapshot(files)))
+
+    def wait(self):
+        for future in self.inflight:
+            future.result()
+        self.inflight = []
+        self.raise_error()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
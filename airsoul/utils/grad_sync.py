@@ -0,0 +1,146 @@
+import torch
+import torch.distributed as dist
+from contextlib import contextmanager, nullcontext
+from .tools import log_warn
+
+"""
+Bucketed all-reduce of the gradients
+
+The gradients are flattened into buffers of at most bucket_size_mb and each buffer is averaged with one collective,
+instead of one collective per parameter tensor.
+Every bucket is reduced exactly once per step, so all the ranks issue the same collectives in the same order.
+With overlap=True the buckets are reduced asynchronously as soon as all of their gradients are accumulated,
+but only during the backward marked by last_backward(): earlier backwards of the step (e.g. segment-wise training)
+still change the gradients. The buckets not launched by then are reduced in sync().
+The buckets are launched in order, a parameter without gradient in the last backward holds back the following buckets.
+The computers enclose their last backward with final_backward(self.grad_sync, last_seg).
+A gradient that is None on every rank stays None, as with DistributedDataParallel.
+Within no_sync() the gradients are only accumulated locally, e.g. for all the micro-batches but the last one.
+"""
+
+class BucketedAllReduce(object):
+    def __init__(self, model, world_size, bucket_size_mb=25, overlap=False, verbose=False):
+        self.world_size = world_size
+        self.enabled = (world_size > 1)
+        self.overlap = overlap and self.enabled
+        self.hooks = []
+        self.deferred = False
+        self.armed = False
+
+        # Gradients are produced roughly in the reversed order of the parameters
+        params = [param for param in model.parameters() if param.requires_grad]
+        bucket_bytes = bucket_size_mb * 1024 * 1024
+        self.buckets = []
+        bucket, nbytes = [], 0
+        for param in reversed(params):
+            if(len(bucket) > 0 and (nbytes + param.numel() * param.element_size() > bucket_bytes
+                    or param.dtype != bucket[0].dtype or param.device != bucket[0].device)):
+                self.buckets.append(bucket)
+                bucket, nbytes = [], 0
+            bucket.append(param)
+            nbytes += param.numel() * param.element_size()
+        if(len(bucket) > 0):
+            self.buckets.append(bucket)
+        self.bucket_index = {id(param): i for i, bucket in enumerate(self.buckets) for param in bucket}
+
+        if(self.overlap):
+            if(hasattr(torch.Tensor, "register_post_accumulate_grad_hook")):
+                for param in params:
+                    self.hooks.append(param.register_post_accumulate_grad_hook(self._on_grad_ready))
+            else:
+                log_warn("grad_sync_overlap requires torch>=2.1, gradients are reduced after backward", on=verbose)
+                self.overlap = False
+        self._reset()
+
+        if(verbose and self.enabled):
+            print(f"...all-reduce {len(params)} gradients in {len(self.buckets)} buckets of at most {bucket_size_mb} MB")
+
+    def _reset(self):
+        self.ready = [set() for _ in self.buckets]
+        self.pending = dict()
+        self.next_bucket = 0
+
+    def _launch(self, i):
+        # The gradients are followed by one presence flag per parameter, nonzero after the reduction
+        # if any rank has the gradient
+        bucket = self.buckets[i]
+        flags = torch.tensor([float(param.grad is not None) for param in bucket], dtype=bucket[0].dtype, device=bucket[0].device)
+        flat = torch.cat([(param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1)
+                          for param in bucket] + [flags])
+        flat.div_(self.world_size)
+        self.pending[i] = (dist.all_reduce(flat, async_op=True), flat)
+
+    def _unflatten(self, i, flat):
+        bucket = self.buckets[i]
+        present = (flat[-len(bucket):] > 0).tolist()
+        offset = 0
+        for param, has_grad in zip(bucket, present):
+            n = param.numel()
+            # A parameter without gradient on this rank still takes the average of the others
+            if(param.grad is not None):
+                param.grad.copy_(flat[offset:offset + n].view_as(param))
+            elif(has_grad):
+                param.grad = flat[offset:offset + n].view_as(param).clone()
+            offset += n
+
+    def _on_grad_ready(self, param):
+        if(self.deferred or not self.armed):
+            return
+        i = self.bucket_index[id(param)]
+        if(i < self.next_bucket):
+            raise RuntimeError("A gradient is accumulated after its bucket was reduced, " +
+                               "last_backward() must only enclose the last backward of the step")
+        self.ready[i].add(id(param))
+        # Launch in bucket order so that all the ranks issue the collectives in the same order
+        while(self.next_bucket < len(self.buckets)
+                and len(self.ready[self.next_bucket]) == len(self.buckets[self.next_bucket])):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    def sync(self):
+        """
+        Average the gradients across the ranks, call after the last backward and before the optimizer step
+        """
+        if(not self.enabled):
+            return
+        for i in range(self.next_bucket, len(self.buckets)):
+            self._launch(i)
+        for i in range(len(self.buckets)):
+            handle, flat = self.pending[i]
+            handle.wait()
+            self._unflatten(i, flat)
+        self._reset()
+
+    @contextmanager
+    def last_backward(self):
+        """
+        Enclose the last backward of the step, the buckets are reduced while it runs (overlap=True)
+        Inside no_sync() it has no effect
+        """
+        self.armed = self.overlap
+        try:
+            yield
+        finally:
+            self.armed = False
+
+    @contextmanager
+    def no_sync(self):
+        self.deferred = True
+        try:
+            yield
+        finally:
+            self.deferred = False
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+def final_backward(grad_sync, last):
+    """
+    Context of a backward in compute(): grad_sync.last_backward() for the last backward of the step, nothing otherwise
+    grad_sync: the BucketedAllReduce of the trainer or None
+    """
+    if(grad_sync is None or not last):
+        return nullcontext()
+    return grad_sync.last_backward()
@@ -3,10 +3,7 @@ from torch import nn
 from torch.nn import functional as F
 import os
 import pathlib
-from tqdm import tqdm
 import numpy as np
-from PIL import Image
-from scipy import linalg
 
 def ent_loss(act_out):
     """
@@ -86,6 +83,7 @@ def get_activations(
        activations of the given tensor when feeding inception with the
        query tensor.
     """
+    from tqdm import tqdm
     model.eval()
     # get the last feature layer of the model
     model = model.to(device)
@@ -140,6 +138,7 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     Returns:
     --   : The Frechet Distance.
     """
+    from scipy import linalg
 
     mu1 = np.atleast_1d(mu1)
     mu2 = np.atleast_1d(mu2)
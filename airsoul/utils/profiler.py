@@ -0,0 +1,137 @@
+import time
+import torch
+import torch.distributed as dist
+from contextlib import nullcontext
+
+"""
+Per-phase timing of the training steps
+
+Phases are timed exclusively: the time spent in a nested phase is not counted in the enclosing one,
+e.g. "compute" is the part of computer.compute outside of its "forward", "backward" and "stat" phases.
+Every `interval` steps the milliseconds per step of each phase are gathered from all the ranks with a single collective,
+their mean and maximum (the slowest rank) are written to the logger.
+With interval <= 0 phase() returns a shared no-op context and nothing is timed.
+"""
+
+PROFILE_PHASES = ["data", "forward", "backward", "compute", "grad_sync", "optimizer", "stat", "checkpoint"]
+
+_NULL_CONTEXT = nullcontext()
+
+class _Phase(object):
+    __slots__ = ("profiler", "name")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+
+    def __exit__(self, *args):
+        self.profiler._exit()
+
+class StepProfiler(object):
+    """
+    interval: number of steps between two reports, <= 0 disables the profiler
+    device: CUDA devices are synchronized at the phase boundaries, so that the asynchronous kernels are charged to their phase
+    """
+    def __init__(self, interval=0, phases=PROFILE_PHASES, device=None, logger=None):
+        self.interval = interval
+        self.enabled = (interval > 0)
+        self.phases = list(phases)
+        self.index = {name: i for i, name in enumerate(self.phases)}
+        self.contexts = {name: _Phase(self, name) for name in self.phases}
+        self.device = device
+        self.sync_cuda = (device is not None and torch.device(device).type == 'cuda')
+        self.logger = logger
+        self._reset()
+
+    @staticmethod
+    def logger_keys(phases=PROFILE_PHASES):
+        return [f"{name}_ms" for name in phases] + [f"{name}_max_ms" for name in phases]
+
+    def _reset(self):
+        self.totals = [0.0] * len(self.phases)
+        self.stack = []
+        self.mark = None
+        self.steps = 0
+
+    def state_dict(self):
+        """
+        Steps and times accumulated towards the next report
+        """
+        return {"steps": self.steps, "totals": list(self.totals)}
+
+    def load_state_dict(self, state):
+        self.steps = state["steps"]
+        self.totals = list(state["totals"])
+
+    def _now(self):
+        if(self.sync_cuda):
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _enter(self, name):
+        now = self._now()
+        if(len(self.stack) > 0):
+            self.totals[self.index[self.stack[-1]]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+
+    def _exit(self):
+        now = self._now()
+        self.totals[self.index[self.stack.pop()]] += now - self.mark
+        self.mark = now
+
+    def phase(self, name):
+        if(not self.enabled):
+            return _NULL_CONTEXT
+        if(name not in self.contexts):
+            raise ValueError(f"Unknown profiling phase {name}, expect one of {self.phases}")
+        return self.contexts[name]
+
+    def iterate(self, iterable, name="data"):
+        """
+        Time the waiting for each item of iterable as the phase `name`
+        """
+        if(not self.enabled):
+            return iterable
+        return self._timed_iter(iterable, self.phase(name))
+
+    def _timed_iter(self, iterable, context):
+        iterator = iter(iterable)
+        while True:
+            with context:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, epoch=-1, iteration=-1):
+        """
+        Mark the end of a step, returns {phase: (mean_ms, max_ms)} and writes it to the logger once every interval steps
+        Must be called by all the ranks in the same steps
+        """
+        if(not self.enabled):
+            return None
+        self.steps += 1
+        if(self.steps < self.interval):
+            return None
+
+        device = self.device if self.sync_cuda else 'cpu'
+        times = torch.tensor(self.totals, dtype=torch.float64, device=device) * (1000.0 / self.steps)
+        if(dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            gathered = [torch.empty_like(times) for _ in range(dist.get_world_size())]
+            dist.all_gather(gathered, times)
+            times = torch.stack(gathered, dim=0)
+        else:
+            times = times.unsqueeze(0)
+        means = times.mean(dim=0).tolist()
+        maxes = times.max(dim=0).values.tolist()
+        self.totals = [0.0] * len(self.phases)
+        self.steps = 0
+
+        if(self.logger is not None):
+            self.logger(*means, *maxes, epoch=epoch, iteration=iteration)
+        return {name: (means[i], maxes[i]) for i, name in enumerate(self.phases)}
@@ -11,14 +11,47 @@ from .tools import log_debug, log_warn, log_fatal
 class DistStatistics(object):
     """
     Provide distributed statistics over GPUs
+    Every key keeps a preallocated accumulator of (count, sum, sum of squares, number of inf/NaN) on the device,
+    all keys are packed into one flat tensor and reduced with a single collective when the statistics are requested
+    interval: due() is True every `interval` calls, to reduce and log only at that interval instead of every batch
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, interval=1, **kwargs):
+        self.interval = max(1, int(interval))
+        self._calls = 0
         self.reset()
 
     def reset(self):
-        self._sum = dict()
-        self._sum2 = dict()
-        self._count = dict()
+        self._acc = dict()
+        self._length = dict()
+
+    def due(self):
+        """
+        Count one call, True when the statistics are to be reduced (identical on all the ranks)
+        """
+        self._calls += 1
+        return (self._calls % self.interval == 0)
+
+    def state_dict(self):
+        """
+        Position in the due() interval, restored on resume so that the reductions keep their steps
+        """
+        return {"calls": self._calls}
+
+    def load_state_dict(self, state):
+        self._calls = state["calls"]
+
+    def _accumulator(self, key, length, device):
+        if(key not in self._acc):
+            self._acc[key] = torch.zeros((4, max(length, 1)), device=device)
+            self._length[key] = 0
+        elif(self._acc[key].shape[1] < length):
+            # Grow the capacity geometrically to avoid reallocating at every longer value
+            capacity = max(length, 2 * self._acc[key].shape[1])
+            acc = torch.zeros((4, capacity), device=self._acc[key].device)
+            acc[:, :self._acc[key].shape[1]] = self._acc[key]
+            self._acc[key] = acc
+        self._length[key] = max(self._length[key], length)
+        return self._acc[key]
 
     def gather(self, device, count=None, **kwargs):
         """
@@ -28,93 +61,91 @@ class DistStatistics(object):
         with torch.no_grad():
             # Reshape the count to 1-dimensional tensor
             if(count is None):
-                fcount = torch.Tensor([1]).to(device)
-            elif(isinstance(count, list) or isinstance(count, tuple)):
-                fcount = torch.Tensor(count).to(device)
+                fcount = torch.ones((1,), device=device)
             elif(isinstance(count, torch.Tensor)):
-                fcount = count.clone().to(device)
+                fcount = count.detach().to(device=device, dtype=torch.float32)
             else:
-                fcount = torch.Tensor([count]).to(device)
+                fcount = torch.tensor(count, dtype=torch.float32, device=device)
             assert fcount.ndim < 2, f"count must be float/int or a list"
             if(fcount.ndim < 1):
                 fcount = fcount.unsqueeze(0)
-            
+
             for key, value in kwargs.items():
                 # Reshape value to 1-dimensional tensor
                 if isinstance(value, list) or isinstance(value, tuple):
-                    fvalue = torch.stack(value, dim=0).to(device)
+                    fvalue = torch.stack(value, dim=0).detach().to(device=device, dtype=torch.float32)
                 elif(isinstance(value, torch.Tensor)):
-                    fvalue = value.clone().to(device)
+                    fvalue = value.detach().to(device=device, dtype=torch.float32)
                 else:
-                    fvalue = torch.Tensor(value).to(device)
+                    fvalue = torch.tensor(value, dtype=torch.float32, device=device)
                 assert fvalue.ndim < 2, f"requires value dimension < 2, get {fvalue.shape}"
                 if(fvalue.ndim < 1):
                     fvalue = fvalue.unsqueeze(0)
 
-                # Expand such that the count and the value have the same dimension
+                # The count is broadcasted if it is a scalar
                 c_dim = fcount.numel()
                 v_dim = fvalue.numel()
-                if(c_dim == 1 and c_dim < v_dim):
-                    fcount_e = fcount.expand(v_dim).clone().to(device)
-                elif(c_dim > 1 and c_dim != v_dim):
+                if(c_dim > 1 and c_dim != v_dim):
                     log_fatal(f"dimension mismatch between statistic count {fcount.shape} and value {fvalue.shape}")
-                else:
-                    fcount_e = fcount.clone()
+                length = max(c_dim, v_dim)
 
+                # inf/NaN are counted as zeros, they are reported when reducing to avoid a host sync here
                 illegal = torch.isinf(fvalue) | torch.isnan(fvalue)
-                if illegal.any():
-                    log_warn(f"'Device:{device}' stating '{key}' has inf/NaN")
-                    fvalue = torch.where(illegal, fvalue, torch.zeros_like(fvalue))
-                
-                if(key not in self._count):
-                    self._sum[key] = fvalue * fcount_e
-                    self._sum2[key] = fvalue ** 2 * fcount_e
-                    self._count[key] = fcount_e
-                else:
-                    if(self._count[key].shape[0] < v_dim):
-                        expand_l = v_dim - self._count[key].shape[0]
-                        self._count[key] = torch.cat((self._count[key], torch.zeros((expand_l,), device=device)), dim=0)
-                        self._sum[key] = torch.cat((self._sum[key], torch.zeros((expand_l,), device=device)), dim=0)
-                        self._sum2[key] = torch.cat((self._sum2[key], torch.zeros((expand_l,), device=device)), dim=0)
-                    self._sum[key][:v_dim] += fvalue * fcount_e
-                    self._sum2[key][:v_dim] += fvalue ** 2 * fcount_e
-                    self._count[key][:v_dim] += fcount_e
-
-    def _stat(self, key):
-        # Gather the statistics from different cards
-        max_length = torch.tensor([self._count[key].shape[0]], dtype=torch.int64, device=self._count[key].device)
-        dist.all_reduce(max_length, op=dist.ReduceOp.MAX)
-        max_length = max_length.item()
-
-        # Padding the current statistics to the maximum length if needed
-        if(max_length > self._count[key].shape[0]):
-            expand_l = max_length - self._count[key].shape[0]
-            self._count[key] = torch.cat((self._count[key], torch.zeros((expand_l,), device=self._count[key].device)), dim=0)
-            self._sum[key] = torch.cat((self._sum[key], torch.zeros((expand_l,), device=self._sum[key].device)), dim=0)
-            self._sum2[key] = torch.cat((self._sum2[key], torch.zeros((expand_l,), device=self._sum2[key].device)), dim=0)
-        
-        # Gather the statistics from different cards
-        sum_cnt = self._count[key].clone().to(self._count[key].device)
-        sum_mean = self._sum[key].clone().to(self._count[key].device)
-        sum_mean2 = self._sum2[key].clone().to(self._count[key].device)
-
-        dist.all_reduce(sum_cnt, dist.ReduceOp.SUM)
-        dist.all_reduce(sum_mean, dist.ReduceOp.SUM)
-        dist.all_reduce(sum_mean2, dist.ReduceOp.SUM)
-
-        x_mean = sum_mean / sum_cnt
-        x2_mean = sum_mean2 / sum_cnt
-        var = torch.sqrt(x2_mean - x_mean ** 2)
-
-        return x_mean, var, sum_cnt
+                fvalue = torch.where(illegal, torch.zeros_like(fvalue), fvalue)
+
+                acc = self._accumulator(key, length, device)
+                acc[0, :length] += fcount
+                acc[1, :length] += fvalue * fcount
+                acc[2, :length] += fvalue ** 2 * fcount
+                acc[3, :length] += illegal.float()
+
+    def _reduce(self, keys):
+        device = self._acc[keys[0]].device
+        distributed = dist.is_available() and dist.is_initialized()
+
+        # Align the lengths of each key over the cards
+        lengths = torch.tensor([self._length[key] for key in keys], dtype=torch.int64, device=device)
+        if(distributed):
+            dist.all_reduce(lengths, op=dist.ReduceOp.MAX)
+        lengths = lengths.tolist()
+
+        # Pack all the keys into a single tensor and gather the statistics from different cards
+        flat = torch.zeros((4, sum(lengths)), device=device)
+        offset = 0
+        for key, length in zip(keys, lengths):
+            n = min(length, self._acc[key].shape[1])
+            flat[:, offset:offset + n] = self._acc[key][:, :n]
+            offset += length
+        if(distributed):
+            dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        # A single device-to-host transfer, the statistics are computed on the host
+        flat = flat.cpu()
+
+        results = dict()
+        offset = 0
+        for key, length in zip(keys, lengths):
+            results[key] = flat[:, offset:offset + length]
+            offset += length
+        return results
 
     def __call__(self, reset=True):
         stat_res = dict()
         with torch.no_grad():
-            for key in self._count:
-                mean,std,cnt = self._stat(key)
+            keys = sorted(self._acc.keys())
+            if(len(keys) < 1):
+                return stat_res
+            reduced = self._reduce(keys)
+            n_illegal = torch.stack([reduced[key][3].sum() for key in keys]).tolist()
+            for key, n in zip(keys, n_illegal):
+                if(n > 0):
+                    log_warn(f"stating '{key}' has {int(n)} inf/NaN values, counted as zeros")
+
+                sum_cnt, sum_mean, sum_mean2 = reduced[key][0], reduced[key][1], reduced[key][2]
+                mean = sum_mean / sum_cnt
+                x2_mean = sum_mean2 / sum_cnt
+                std = torch.sqrt(x2_mean - mean ** 2)
                 # 95% Confidence Bound For Mean
-                bound = 2.0 * std / torch.sqrt(cnt)
+                bound = 2.0 * std / torch.sqrt(sum_cnt)
                 if(mean.numel() < 2):
                     mean = mean.squeeze().item()
                     std = std.squeeze().item()
@@ -123,7 +154,7 @@ class DistStatistics(object):
                     mean = mean.squeeze().tolist()
                     std = std.squeeze().tolist()
                     bound = bound.squeeze().tolist()
-                stat_res[key] = {"mean":mean,"std":std,'cnt':cnt,
+                stat_res[key] = {"mean":mean,"std":std,'cnt':sum_cnt,
                         'bound':bound}
             if(reset):
                 self.reset()
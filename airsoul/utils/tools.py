@@ -2,6 +2,7 @@ import os
 import re
 import sys
 import yaml
+import importlib
 import numpy
 import torch
 from torch.nn.utils import clip_grad_norm_
@@ -23,6 +24,19 @@ def import_with_caution(module_name):
         print(f'Warning: module {module_name} does not exist')
     return module
 
+def lazy_attributes(package, attributes):
+    """
+    Module-level __getattr__ (PEP 562) of a package, importing the attributes from their submodules on first access
+    attributes: {attribute name: relative submodule name}, e.g. {"Runner": ".trainer"}
+    """
+    def __getattr__(name):
+        if(name not in attributes):
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(attributes[name], package), name)
+        setattr(sys.modules[package], name, value)
+        return value
+    return __getattr__
+
 def log_sum_parameters_grad(model, rank=None):
     l1 = 0.0
     l2 = 0.0
@@ -47,7 +61,7 @@ def safety_check(tensor, replacement=None, msg=None, on=True):
         else:
             tensor[has_large] = replacement
         if(msg is not None):
-            log_warn(f"{msg}\tl2_norm={l2_norm}", on=on)
+            log_warn(f"{msg}\tl2_norm={torch.sqrt(torch.sum(tensor.float() ** 2))}", on=on)
     if has_inf.any():
         risk_level=max(risk_level, 2)
         if(replacement is None):
@@ -67,6 +81,44 @@ def safety_check(tensor, replacement=None, msg=None, on=True):
 
     return tensor, risk_level
 
+RISK_NAMES = {1: "LARGE", 2: "INF", 3: "NAN"}
+
+def fused_safety_check(tensors, large_threshold=1.0e+3):
+    """
+    Risk levels of a list of tensors with the same meaning as safety_check (0: normal, 1: x^2 > 1e+6, 2: INF, 3: NAN),
+    computed from the max-abs norm of every tensor with a single device-to-host transfer
+    """
+    tensors = [t.detach() for t in tensors]
+    valid = [i for i, t in enumerate(tensors) if t.numel() > 0]
+    risks = [0] * len(tensors)
+    if(len(valid) < 1):
+        return risks
+    try:
+        norms = torch._foreach_norm([tensors[i] for i in valid], float('inf'))
+    except (AttributeError, RuntimeError):
+        norms = [torch.linalg.vector_norm(tensors[i], float('inf')) for i in valid]
+    device = norms[0].device
+    norms = torch.stack([n.float().to(device) for n in norms])
+    # max-abs is NaN if any NaN, INF if any INF, the highest risk is kept
+    levels = torch.where(torch.isnan(norms), 3,
+                torch.where(torch.isinf(norms), 2,
+                    torch.where(norms > large_threshold, 1, 0)))
+    for i, level in zip(valid, levels.tolist()):
+        risks[i] = level
+    return risks
+
+def log_risk_groups(names, risks, msg, on=True):
+    """
+    Report the highest risk level of each parameter group (module) with a single warning
+    """
+    groups = dict()
+    for name, risk in zip(names, risks):
+        if(risk > 0):
+            group = name.rsplit('.', 1)[0]
+            groups[group] = max(groups.get(group, 0), risk)
+    if(len(groups) > 0):
+        log_warn(f"{msg}: " + ", ".join([f"{group}({RISK_NAMES[risk]})" for group, risk in groups.items()]), on=on)
+
 def format_cache(cache, prefix=''):
     if(cache is None):
         return prefix + ' None'
@@ -105,6 +157,41 @@ def memory_cpy(cache):
     else:
         return cache
 
+def memory_detach(cache):
+    """
+    Cache detached from the computation graph, the tensors are shared instead of copied
+    The temporal modules never modify a cache they receive, a detached cache can be kept while it is passed on
+    Use memory_cpy only to get an independent copy
+    """
+    if(cache is None):
+        return None
+    elif(isinstance(cache, torch.Tensor)):
+        return cache.detach()
+    elif(isinstance(cache, list)):
+        return [memory_detach(c) for c in cache]
+    elif(isinstance(cache, dict)):
+        return {k:memory_detach(cache[k]) for k in cache}
+    elif(isinstance(cache, tuple)):
+        return tuple([memory_detach(c) for c in cache])
+    elif(hasattr(cache, 'detach')):
+        return cache.detach()
+    else:
+        return cache
+
+def memory_borrow(cache, shared=("recurrent_state",)):
+    """
+    Detached cache to hand to a library that updates its states in place (e.g. fla Cache)
+    The containers are new, the tensors under the keys in `shared` are only read and replaced by the library,
+    they are shared with the input; all the other tensors (e.g. short convolution states, small) are cloned
+    """
+    if(isinstance(cache, list)):
+        return [memory_borrow(c, shared) for c in cache]
+    elif(isinstance(cache, dict)):
+        return {k:(memory_detach(cache[k]) if k in shared else memory_borrow(cache[k], shared)) for k in cache}
+    elif(isinstance(cache, tuple)):
+        return tuple([memory_borrow(c, shared) for c in cache])
+    return memory_cpy(cache)
+
 def model_path(save_model_path, epoch_id, *optimizers):
     directory_path = '%s/ckpt_%02d/' % (save_model_path, epoch_id)
     if not os.path.exists(directory_path):
@@ -127,13 +214,19 @@ def apply_gradient_safely(model, optimizer, scaler=None, clip_norm=1.0):
     # Clip graident first
     clip_grad_norm_(model.parameters(), clip_norm)
 
-    overflow=False
+    names, grads = [], []
     for name, param in model.named_parameters():
         if (param.grad is not None):
-            _, risk = safety_check(param.grad, msg=f"gradient_[{name}]")
-            if(risk > 1):
-                param.grad.zero_()
-                overflow=True
+            names.append(name)
+            grads.append(param.grad)
+    risks = fused_safety_check(grads)
+    log_risk_groups(names, risks, "gradient check")
+
+    overflow=False
+    for grad, risk in zip(grads, risks):
+        if(risk > 1):
+            grad.zero_()
+            overflow=True
     if(overflow):
         reset_optimizer_state(optimizer)
         if(scaler is not None):
@@ -151,6 +244,16 @@ def print_memory(info="Default"):
             "Memory cached:", 
             torch.cuda.memory_cached())
 
+def mmap_load(file_path):
+    """
+    Memory-map a checkpoint on CPU, the tensors are read from the disk only when they are accessed
+    """
+    try:
+        return torch.load(file_path, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or checkpoints in the legacy (non-zip) format can not be memory-mapped
+        return torch.load(file_path, map_location='cpu', weights_only=False)
+
 def custom_load_model(model, 
                       state_dict_path, 
                       black_list=[], 
@@ -162,9 +265,16 @@ def custom_load_model(model,
     strick_check: if true, parameters with NAN/INF and mismatching shape will cause error
         otherwise, they will be replaced by zero and matched with maximum shared parts
     """
-    saved_state_dict = torch.load(state_dict_path, weights_only=False)  
+    # Only the tensors required by the model are read from the memory-mapped file
+    saved_state_dict = mmap_load(state_dict_path)
     matched_state_dict = {} 
 
+    # Check all the required tensors at once, safety_check only runs on those at risk
+    # Blacklisted tensors are skipped below, checking them would page them in for nothing
+    checked_names = [param_name for param_name, _ in model.named_parameters()
+                     if param_name in saved_state_dict and not any(param_name.find(name) > -1 for name in black_list)]
+    risks = dict(zip(checked_names, fused_safety_check([saved_state_dict[param_name] for param_name in checked_names])))
+
     # Notice: load only trainable parameters
     for param_name, param_tensor in model.named_parameters():
         model_param_shape = param_tensor.shape  
@@ -179,12 +289,14 @@ def custom_load_model(model,
                 continue
 
             # check whether there are abnormal parameters
-            if(strict_check):
+            if(risks[param_name] < 1):
+                safe_param = saved_state_dict[param_name]
+            elif(strict_check):
                 safe_param, risk = safety_check(saved_state_dict[param_name], 
                                                 msg=f"loading parameters: {param_name}",
                                                 on=verbose)
                 if(risk > 1):
-                    log_fatal(e, "Quit Job...")
+                    log_fatal(f"Loading {param_name} with INF/NAN", "Quit Job...")
             else:
                 safe_param, risk = safety_check(saved_state_dict[param_name], 
                                                 replacement=0, 
@@ -232,16 +344,11 @@ def check_model_validity(model, verbose=False, level=1):
     level: 0 -> only accept all parameters l2 norm < 1e+6
            1 -> only accept all valid parameters
     """
-    param_isnormal = dict()
-    max_risk = 0
-    for param_name, param_tensor in model.named_parameters():
-        if(not param_tensor.requires_grad):
-            continue # Neglect non-trainable parameters
-
-        safe_param, risk = safety_check(param_tensor, 
-                                        msg=f"checking parameters: {param_name}",
-                                        on=verbose)
-        max_risk = max(risk, max_risk)
+    # Neglect non-trainable parameters
+    named_params = [(name, param) for name, param in model.named_parameters() if param.requires_grad]
+    risks = fused_safety_check([param for _, param in named_params])
+    log_risk_groups([name for name, _ in named_params], risks, "checking parameters", on=verbose)
+    max_risk = max(risks, default=0)
 
     return (max_risk > level)
 
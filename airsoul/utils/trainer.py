@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import argparse
 import torch
 import numpy
@@ -7,15 +8,48 @@ import torch.optim as optim
 import torch.distributed as dist
 import torch.multiprocessing as mp
 from functools import wraps
+from contextlib import ExitStack
 from torch.optim.lr_scheduler import LambdaLR
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.nn.utils import clip_grad_norm_
 from torch.utils.data import DataLoader, Dataset
 from torch.amp import autocast, GradScaler
 from airsoul.dataloader.prefetch_dataloader import PrefetchDataLoader
+from airsoul.dataloader.manifest import mark_run
 from .tools import Configure, Logger, log_progress, log_debug, log_warn, log_fatal, log_sum_parameters_grad
-from .tools import count_parameters, check_model_validity, model_path, safety_check, apply_gradient_safely, custom_load_model
+from .tools import count_parameters, check_model_validity, model_path, safety_check, apply_gradient_safely, custom_load_model, mmap_load
 from .scheduler import noam_scheduler
+from .grad_sync import BucketedAllReduce
+from .profiler import StepProfiler
+from .checkpoint import AsyncCheckpointWriter, get_rng_states, set_rng_states
+from .checkpoint import training_state_path, latest_training_checkpoint
+
+def split_micro_batches(batch_data, micro_batch_size):
+    """
+    Split the tensors of a batch along the batch dimension into micro-batches of at most micro_batch_size
+    Returns a list of (micro_batch_data, fraction of the batch)
+    """
+    bsz = None
+    for data in batch_data:
+        if(isinstance(data, torch.Tensor) and data.ndim > 0):
+            bsz = data.shape[0]
+            break
+    if(micro_batch_size is None or micro_batch_size <= 0 or bsz is None or bsz <= micro_batch_size):
+        return [(batch_data, 1.0)]
+    micro_batches = []
+    for start in range(0, bsz, micro_batch_size):
+        end = min(start + micro_batch_size, bsz)
+        micro_data = [data[start:end] if(isinstance(data, torch.Tensor) and data.ndim > 0 and data.shape[0] == bsz) 
+                      else data for data in batch_data]
+        micro_batches.append((micro_data, (end - start) / bsz))
+    return micro_batches
+
+def scale_gradients(model, factor):
+    if(factor == 1.0):
+        return
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    if(len(grads) > 0):
+        torch._foreach_mul_(grads, factor)
 
 def EpochManager(cls):
     @wraps(cls, updated=())
@@ -44,8 +78,14 @@ def EpochManager(cls):
                 dataset = DataType(self.config.data_path, 
                                     self.config.seq_len,
                                     verbose=self.main)
+                # Strict ordering is irrelevant for training as the data is shuffled anyway
+                ordered = not (self.is_training and self.config.has_attr("unordered_loading") 
+                                and self.config.unordered_loading)
+                # Pass the samples through shared-memory slots instead of pickling them through the queue
+                use_shared_memory = self.config.has_attr("use_shared_memory") and self.config.use_shared_memory
                 self.dataloader = PrefetchDataLoader(dataset, batch_size=self.config.batch_size, 
-                                            rank=self.rank, world_size=self.world_size)
+                                            rank=self.rank, world_size=self.world_size,
+                                            ordered=ordered, use_shared_memory=use_shared_memory)
                 self.computer.dataloader = self.dataloader
 
         def init_logger(self):
@@ -101,7 +141,98 @@ def EpochManager(cls):
                     self.scaler = GradScaler()
                 self.computer.scaler = self.scaler
 
+        def init_checkpoint_writer(self):
+            self.checkpoint_writer = None
+            self.save_training_state = self.get('save_training_state', config=self.config, default=False)
+            self.resume_epoch = None
+            self.resume_finished = False
+            if(self.is_training and self.main):
+                self.checkpoint_writer = AsyncCheckpointWriter(self.config.save_model_path,
+                        max_inflight=self.get('max_inflight_saves', config=self.config, default=1),
+                        keep_checkpoints=self.get('keep_checkpoints', config=self.config, default=None),
+                        verbose=self.main)
+
+        def init_profiler(self):
+            profile_interval = self.get('profile_interval', config=self.config, default=0)
+            profile_logger = None
+            if(profile_interval > 0):
+                if(self.is_training):
+                    process_name = f"Profile-Training-{self.computer.__class__.__name__}"
+                    log_file = self.log_config.training_log
+                else:
+                    process_name = f"Profile-Evaluation-{self.computer.__class__.__name__}"
+                    log_file = self.log_config.evaluation_log
+                profile_logger = Logger(
+                        *StepProfiler.logger_keys(),
+                        on=self.main,
+                        use_tensorboard=self.log_config.use_tensorboard,
+                        log_file=log_file,
+                        prefix=f"{self.run_name}-{process_name}",
+                        field=f"{self.log_config.tensorboard_log}/{self.run_name}-{process_name}")
+            self.profiler = StepProfiler(profile_interval, device=self.device, logger=profile_logger)
+            self.computer.profiler = self.profiler
+
+        def training_state(self, epoch_id, finished):
+            """
+            Everything required to continue the training exactly, the loader position and the RNG of every rank,
+            and the logging and profiling intervals; the model weights are in the model.pth next to it
+            """
+            stat = getattr(self.computer, 'stat', None)
+            rank_state = {"dataloader": self.dataloader.state_dict() if hasattr(self.dataloader, 'state_dict') else None,
+                          "rng": get_rng_states(),
+                          "stat": stat.state_dict() if hasattr(stat, 'state_dict') else None,
+                          "profiler": self.profiler.state_dict()}
+            if(self.world_size > 1):
+                rank_states = [None] * self.world_size
+                dist.all_gather_object(rank_states, rank_state)
+            else:
+                rank_states = [rank_state]
+            return {"epoch": epoch_id,
+                    "finished": finished,
+                    "saved_at": time.time(),
+                    "model": "model.pth",
+                    "optimizer": self.optimizer.state_dict(),
+                    "lr_scheduler": self.lr_scheduler.state_dict(),
+                    "scaler": self.scaler.state_dict() if self.scaler is not None else None,
+                    "ranks": rank_states}
+
+        def load_training_state(self, state):
+            self.optimizer.load_state_dict(state["optimizer"])
+            self.lr_scheduler.load_state_dict(state["lr_scheduler"])
+            if(self.scaler is not None and state["scaler"] is not None):
+                self.scaler.load_state_dict(state["scaler"])
+            rank_state = state["ranks"][self.rank]
+            if(rank_state["dataloader"] is not None and hasattr(self.dataloader, 'load_state_dict')):
+                self.dataloader.load_state_dict(rank_state["dataloader"], rng_states=rank_state["rng"])
+            else:
+                set_rng_states(rank_state["rng"])
+            stat = getattr(self.computer, 'stat', None)
+            if(rank_state.get("stat") is not None and hasattr(stat, 'load_state_dict')):
+                stat.load_state_dict(rank_state["stat"])
+            if(rank_state.get("profiler") is not None):
+                self.profiler.load_state_dict(rank_state["profiler"])
+            self.resume_epoch = state["epoch"]
+            self.resume_finished = state["finished"]
+
+        def save_checkpoint(self, epoch_id, finished):
+            # Gathering the training state involves all the ranks
+            state = self.training_state(epoch_id, finished) if self.save_training_state else None
+            if(not self.main):
+                return
+            log_debug("-"*40, "Check current validity and save model for safe...", on=self.main)
+            check_model_validity(self.model.module)
+            save_model_path = model_path(self.config.save_model_path, epoch_id)
+            extra_files = None
+            if(state is not None):
+                extra_files = {training_state_path(os.path.dirname(save_model_path),
+                                                   self.computer.__class__.__name__): state}
+            self.checkpoint_writer.save(self.model.state_dict(), save_model_path, extra_files=extra_files)
+
         def _valid_epoch(self, eid):
+            # Epochs completed before the resumed checkpoint
+            if(self.resume_epoch is not None and 
+                    (eid < self.resume_epoch or (eid == self.resume_epoch and self.resume_finished))):
+                return False
             if(hasattr(self.computer, 'valid_epoch')):
                 return self.computer.valid_epoch(eid)
             return True
@@ -123,11 +254,28 @@ def EpochManager(cls):
                 self.computer.preprocess()
             self.init_dataloader()
             self.init_logger()
+            self.init_profiler()
             self.init_optimizer()
+            self.init_checkpoint_writer()
+            self.computer.last_micro_batch = True
 
         def _postprocess(self):
             if(hasattr(self.computer, 'postprocess')):
                 self.computer.postprocess()
+            if(self.checkpoint_writer is not None):
+                self.checkpoint_writer.close()
+
+        def accumulation_context(self, grad_sync, last):
+            """
+            Defer the gradient collectives of all the micro-batches but the last one
+            """
+            stack = ExitStack()
+            if(not last):
+                if(hasattr(self.model, 'no_sync')):
+                    stack.enter_context(self.model.no_sync())
+                if(grad_sync is not None):
+                    stack.enter_context(grad_sync.no_sync())
+            return stack
 
         def run(self, epoch_id, device, device_type):
             if(not self._valid_epoch(epoch_id)):
@@ -141,39 +289,65 @@ def EpochManager(cls):
                 manual_sync = self.config.manual_sync
             else:
                 manual_sync = False
+            grad_sync = None
+            if(manual_sync and self.is_training):
+                grad_sync = BucketedAllReduce(self.model, self.world_size,
+                        bucket_size_mb=self.get('grad_bucket_size_mb', config=self.config, default=25),
+                        overlap=self.get('grad_sync_overlap', config=self.config, default=False),
+                        verbose=self.main)
+            # Computers enclose their last backward with final_backward(self.grad_sync, last) to overlap the reduction
+            self.computer.grad_sync = grad_sync
+            micro_batch_size = self.get('micro_batch_size', config=self.config, default=0)
             data_length = len(self.dataloader)
             # print("Data length:", data_length)
-            for batch_id, batch_data in enumerate(self.dataloader):
+            # A resumed epoch continues from the saved position
+            start_batch = 0
+            if(getattr(self.dataloader, 'resume_state', None) is not None):
+                start_batch = self.dataloader.resume_state["local_index"]
+            profiler = self.profiler
+            for batch_id, batch_data in enumerate(profiler.iterate(self.dataloader, "data"), start=start_batch):
                 acc_iter += 1
                 # print("Batch id:", batch_id, "Data length:", data_length)
                 # Important: Must reset the model before segment iteration
                 self.model.module.reset()
                 # print("reset model in ", device)
+                micro_batches = split_micro_batches(batch_data, micro_batch_size)
                 if(self.is_training):
                     # print("Training mode")
                     self.model.train()
                     self.optimizer.zero_grad()
-                    with autocast(dtype=torch.bfloat16, enabled=self.config.use_amp, device_type=device_type):
-                        self.computer.compute(
-                                  *batch_data, 
-                                  epoch_id=epoch_id, 
-                                  batch_id=batch_id)
-                    if(manual_sync):
-                        for param in self.model.parameters():
-                            if(param.grad is not None):
-                                param.grad = param.grad.contiguous()
-                                dist.all_reduce(param.grad)
-                                param.grad.div_(self.world_size)
+                    # The gradients are accumulated over the micro-batches with the weights of their sizes:
+                    # the accumulated gradients are rescaled by w_{k-1} / w_k before micro-batch k, and by w_n at last
+                    prev_weight = None
+                    for micro_id, (micro_data, weight) in enumerate(micro_batches):
+                        last = (micro_id == len(micro_batches) - 1)
+                        if(prev_weight is not None):
+                            scale_gradients(self.model, prev_weight / weight)
+                        self.computer.last_micro_batch = last
+                        with autocast(dtype=torch.bfloat16, enabled=self.config.use_amp, device_type=device_type), \
+                                profiler.phase("compute"), self.accumulation_context(grad_sync, last):
+                            self.computer.compute(
+                                      *micro_data, 
+                                      epoch_id=epoch_id, 
+                                      batch_id=batch_id)
+                        prev_weight = weight
+                    if(grad_sync is not None):
+                        with profiler.phase("grad_sync"):
+                            grad_sync.sync()
+                    scale_gradients(self.model, prev_weight)
                     #log_sum_parameters_grad(self.model, self.rank)
-                    apply_gradient_safely(self.model, self.optimizer, scaler=self.scaler)
-                    self.lr_scheduler.step()
+                    with profiler.phase("optimizer"):
+                        apply_gradient_safely(self.model, self.optimizer, scaler=self.scaler)
+                        self.lr_scheduler.step()
                 else:
                     self.model.eval()
-                    with torch.no_grad():
-                        self.computer.compute(
-                                  *batch_data, 
-                                  epoch_id=epoch_id, 
-                                  batch_id=batch_id)
+                    for micro_id, (micro_data, _) in enumerate(micro_batches):
+                        self.computer.last_micro_batch = (micro_id == len(micro_batches) - 1)
+                        with torch.no_grad(), profiler.phase("compute"):
+                            self.computer.compute(
+                                      *micro_data, 
+                                      epoch_id=epoch_id, 
+                                      batch_id=batch_id)
 
                 # Safety Check and Save
                 need_break = False
@@ -181,31 +355,30 @@ def EpochManager(cls):
                                 and acc_iter > self.config.max_save_iterations 
                                 and self.config.max_save_iterations > 0):
                     acc_iter = 0
-                    log_debug("-"*40, "Check current validity and save model for safe...", on=self.main)
-                    if(self.main):
-                        check_model_validity(self.model.module)
-                        save_model_path = model_path(self.config.save_model_path, epoch_id)
-                        torch.save(self.model.state_dict(), save_model_path)
+                    with profiler.phase("checkpoint"):
+                        self.save_checkpoint(epoch_id, finished=False)
                     need_break = True
 
+                profiler.step(epoch=epoch_id, iteration=batch_id)
                 
                 if(not self.is_training):
                     log_progress((batch_id + 1) / data_length, on=self.main)
                 yield need_break
 
+            if(grad_sync is not None):
+                grad_sync.remove()
+
             # Save At Training Epoch End
-            if(self.main and self.is_training):
-                print("-"*40, "Check current validity and save model for safe...")
-                check_model_validity(self.model.module)
-                save_model_path = model_path(self.config.save_model_path, epoch_id)
-                torch.save(self.model.state_dict(), save_model_path)
+            if(self.is_training):
+                self.save_checkpoint(epoch_id, finished=True)
             yield True
     
     return WrapperEpochManager
 
 def dist_process(rank, use_gpu, world_size, config, main_rank,
-                model_type, train_objects, evaluate_objects, extra_info):
+                model_type, train_objects, evaluate_objects, extra_info, resume=None):
     """
+    resume: checkpoint directory (ckpt_XX) holding the training states to continue from
     """
     if use_gpu:
         torch.cuda.set_device(rank)  # Set the current GPU to be used
@@ -237,7 +410,9 @@ def dist_process(rank, use_gpu, world_size, config, main_rank,
         model = DDP(model)
 
     # Load the model if specified in the configuration
-    if(config.has_attr("load_model_path") and 
+    if(resume is not None):
+        log_debug(f"Resume training from {resume}", on=main)
+    elif(config.has_attr("load_model_path") and 
             config.load_model_path is not None and 
             config.load_model_path.lower() != 'none'):
         if(config.has_attr("load_model_parameter_blacklist")):
@@ -285,22 +460,46 @@ def dist_process(rank, use_gpu, world_size, config, main_rank,
                                         is_training=False,
                                         extra_info=extra_info))
 
+    # The model is restored before preprocessing, which may depend on its weights (e.g. the VAE checksum
+    # keying the latent cache); optimizers, schedulers and loaders are restored after it has built them
+    start_epoch = 0
+    resume_states = []
+    if(resume is not None):
+        for train_object in train_list:
+            state_path = training_state_path(resume, train_object.computer.__class__.__name__)
+            if(not os.path.exists(state_path)):
+                continue
+            state = mmap_load(state_path)
+            resume_states.append((train_object, state))
+            start_epoch = max(start_epoch, state["epoch"] - 1)
+        if(len(resume_states) < 1):
+            log_fatal(f"No training state found in {resume}, save it with train_config.save_training_state=True")
+        # The training states point to the model saved with them in the directory
+        model_file = max((state for _, state in resume_states), key=lambda state: state["saved_at"])["model"]
+        model.load_state_dict(mmap_load(os.path.join(resume, model_file)))
+
     for train_object in train_list:
         train_object._preprocess()
     for evaluate_object in evaluate_list:
         evaluate_object._preprocess()
 
+    for train_object, state in resume_states:
+        train_object.load_training_state(state)
+
     def evaluate_epoch(eid):
+        # Evaluation leaves the random state of training untouched, resumed runs then match uninterrupted ones
+        rng_states = get_rng_states()
         for evaluate_object in evaluate_list:
             evaluate_object._epoch_start(eid)
             for _ in evaluate_object.run(eid, device, device_type):
                 pass
             evaluate_object._epoch_end(eid)
+        set_rng_states(rng_states)
 
     if(len(train_list) < 1):
         evaluate_epoch(0) # Doing single epoch evaluation
     else:
-        epoch = 0
+        epoch = start_epoch
         while epoch < config.train_config.max_epochs:
             epoch += 1
             for train_object in train_list:
@@ -323,6 +522,7 @@ class Runner(object):
         parser = argparse.ArgumentParser()
         parser.add_argument('configuration', type=str, help="YAML configuration file")
         parser.add_argument('--configs', nargs='*', help="List of all configurations, overwrite configuration file: eg. train_config.batch_size=16 test_config.xxx=...")
+        parser.add_argument('--resume', nargs='?', const='latest', default=None, help="Resume from a checkpoint directory (ckpt_XX) saved with train_config.save_training_state=True, default: the latest one in train_config.save_model_path")
         args = parser.parse_args()
 
         self.use_gpu = torch.cuda.is_available()
@@ -350,6 +550,14 @@ class Runner(object):
             os.environ['MASTER_ADDR'] = 'localhost' 
 
         os.environ['MASTER_PORT'] = self.config.master_port
+        # The ranks share the dataset manifests refreshed by the first of them
+        mark_run()
+
+        self.resume = args.resume
+        if(self.resume == 'latest'):
+            self.resume = latest_training_checkpoint(self.config.train_config.save_model_path)
+            if(self.resume is None):
+                log_fatal(f"No checkpoint with training state found in {self.config.train_config.save_model_path}")
 
     def start(self, model_type, train_objects, evaluate_objects, extra_info=None):
         mp.spawn(dist_process,
@@ -360,6 +568,7 @@ class Runner(object):
                       model_type,
                       train_objects, 
                       evaluate_objects,
-                      extra_info),
+                      extra_info,
+                      self.resume),
                 nprocs=self.world_size if self.use_gpu else min(self.world_size, 4),  # Limit CPU processes if desired
                 join=True)
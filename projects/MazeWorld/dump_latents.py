@@ -0,0 +1,78 @@
+import os
+import argparse
+import torch
+import numpy
+from torch.nn.parallel import DataParallel as DP
+
+from airsoul.models import E2EObjNavSA
+from airsoul.utils import Configure, img_pro, custom_load_model
+from airsoul.dataloader.mazeworld_dataset import MazeDataSet, latent_file, load_raw_observations
+
+"""
+Encode every trajectory once with the VAE of the loaded model and store the latents next to observations.npy,
+train with `train_config.use_latent_cache=True` to skip the VAE encoder at every step.
+The files are named latents_{vae checksum}.npy, retraining the VAE invalidates them automatically.
+"""
+
+def dump_latents(vae, file_list, device, chunk_size=256, overwrite=False, verbose=True):
+    latent_key = vae.checksum()
+    n_dumped = 0
+    for path in file_list:
+        output = latent_file(path, latent_key)
+        if(os.path.exists(output) and not overwrite):
+            continue
+        try:
+            # Permute (T, H, W, C) to (T, C, H, W)
+            obs = load_raw_observations(path).permute(0, 3, 1, 2).unsqueeze(0)
+        except Exception as e:
+            print(f"[Warning] Skip {path} that can not be loaded: {e}")
+            continue
+        latents = []
+        with torch.no_grad():
+            for b in range(0, obs.shape[1], chunk_size):
+                z_rec, _ = vae(img_pro(obs[:, b:b + chunk_size].float().to(device)))
+                latents.append(z_rec[0].float().cpu())
+        latents = torch.cat(latents, dim=0).numpy()
+        # Write and rename, an interrupted pass never leaves a truncated latent file
+        with open(output + ".tmp", "wb") as f:
+            numpy.save(f, latents)
+        os.replace(output + ".tmp", output)
+        n_dumped += 1
+        if(verbose and n_dumped % 100 == 0):
+            print(f"...dumped latents of {n_dumped} trajectories")
+    if(verbose):
+        print(f"Finished dumping latents_{latent_key}.npy for {n_dumped} trajectories")
+    return latent_key
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('configuration', type=str, help="YAML configuration file")
+    parser.add_argument('--configs', nargs='*', help="List of all configurations, overwrite configuration file: eg. train_config.batch_size=16 test_config.xxx=...")
+    parser.add_argument('--chunk_size', type=int, default=256, help="number of frames encoded at once, default:256")
+    parser.add_argument('--overwrite', action='store_true', help="recompute the latents that already exist")
+    args = parser.parse_args()
+
+    config = Configure()
+    config.from_yaml(args.configuration)
+    if args.configs:
+        for pair in args.configs:
+            key, value = pair.split('=')
+            config.set_value(key, value)
+            print(f"Rewriting configurations from args: {key} to {value}")
+
+    if(torch.cuda.is_available()):
+        device = torch.device('cuda:0')
+    else:
+        device = torch.device('cpu')
+
+    # the checkpoints are saved from the DDP wrapper, keep the "module." prefix
+    model = custom_load_model(DP(E2EObjNavSA(config.model_config)), f'{config.load_model_path}/model.pth', strict_check=True)
+    model = model.module.to(device)
+    model.eval()
+
+    # Use the same trajectories as training and validation
+    file_list = []
+    for sub_config in [config.train_config, config.test_config]:
+        dataset = MazeDataSet(sub_config.data_path, sub_config.seq_len_causal, verbose=True)
+        file_list.extend(dataset.file_list)
+    dump_latents(model.vae, file_list, device, chunk_size=args.chunk_size, overwrite=args.overwrite)
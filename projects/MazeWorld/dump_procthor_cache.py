@@ -0,0 +1,24 @@
+import argparse
+from airsoul.dataloader.mazeworld_dataset import ProcthorDataSet, MazeDataSetShort, dump_procthor_cache
+
+"""
+Run the Procthor trajectory preprocessing (cut_data / expend_data) once and store it next to each trajectory,
+the data set of the same class and time step then reads the stored result instead of preprocessing every epoch.
+MazeDataSet is not offered: it serves Procthor records with __get_procthor_short__, which needs no preprocessing.
+"""
+
+DATASETS = {
+    "ProcthorDataSet": ProcthorDataSet,
+    "MazeDataSetShort": MazeDataSetShort,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str, nargs='+', help="data roots")
+    parser.add_argument("--time_step", type=int, required=True, help="time step of the data set, e.g. seq_len_causal")
+    parser.add_argument("--dataset", type=str, default="MazeDataSetShort", choices=list(DATASETS.keys()))
+    parser.add_argument("--overwrite", action='store_true', help="preprocess again the trajectories that are already stored")
+    args = parser.parse_args()
+
+    dataset = DATASETS[args.dataset](args.data_path, args.time_step, verbose=True)
+    dump_procthor_cache(dataset, overwrite=args.overwrite)
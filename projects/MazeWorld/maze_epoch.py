@@ -3,11 +3,11 @@ import torch
 import torch.optim as optim
 from torch.optim.lr_scheduler import LambdaLR
 import numpy as np
-from airsoul.dataloader import segment_iterator
+from airsoul.dataloader import segment_iterator, mark_last
 from airsoul.utils import Logger, log_progress, log_debug, log_warn, log_fatal
 from airsoul.utils import custom_load_model, noam_scheduler, LinearScheduler
 from airsoul.utils import Configure, DistStatistics, rewards2go
-from airsoul.utils import EpochManager, GeneratorBase
+from airsoul.utils import EpochManager, GeneratorBase, final_backward
 from airsoul.utils import weighted_loss, img_pro, img_post, plotLongDemo
 from airsoul.dataloader import MazeDataSet, PrefetchDataLoader, MazeTaskDataSet, MazeDataSetShort, MazeDataSetRandomActionTest
 
@@ -28,7 +28,8 @@ class MazeEpochVAE:
                         "kl_weight",
                         "reconstruction_error",
                         "kl_divergence"]
-            self.stat = DistStatistics(*self.logger_keys[3:])
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(*self.logger_keys[3:], interval=log_interval)
             self.lr = self.config.lr_vae
             self.lr_decay_interval = self.config.lr_vae_decay_interval
             self.lr_start_step = self.config.lr_vae_start_step
@@ -71,9 +72,9 @@ class MazeEpochVAE:
 
         losses = []
         seq_len = self.config.seq_len_vae
-        for sub_idx, seg_obs in segment_iterator(
+        for last_seg, (sub_idx, seg_obs) in mark_last(segment_iterator(
                             self.config.seq_len_vae, self.config.seg_len_vae,
-                            self.device, obs_arr):
+                            self.device, obs_arr)):
             # Permute (B, T, H, W, C) to (B, T, C, H, W)
             seg_obs = seg_obs.permute(0, 1, 4, 2, 3)
             seg_obs = seg_obs.contiguous()
@@ -82,32 +83,36 @@ class MazeEpochVAE:
                 sigma = self.sigma_scheduler()
             else:
                 sigma = 0
-            loss = self.model.module.vae_loss(
-                    seg_obs,
-                    _sigma=sigma,
-                    seq_len=seq_len)
+            with self.profiler.phase("forward"):
+                loss = self.model.module.vae_loss(
+                        seg_obs,
+                        _sigma=sigma,
+                        seq_len=seq_len)
             losses.append(loss)
             if(self.is_training):
                 syn_loss = (loss["Reconstruction-Error"] + self.lambda_scheduler() * loss["KL-Divergence"]) / loss["count"]
                 # print(syn_loss)
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                     reconstruction_error = loss["Reconstruction-Error"] / loss["count"],
                     kl_divergence = loss["KL-Divergence"] / loss["count"],
                     count = loss["count"])
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                            self.sigma_scheduler(), 
-                            self.lambda_scheduler(), 
-                            stat_res["reconstruction_error"]["mean"], 
-                            stat_res["kl_divergence"]["mean"],
-                            epoch=epoch_id,
-                            iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                    self.sigma_scheduler(), 
+                                    self.lambda_scheduler(), 
+                                    stat_res["reconstruction_error"]["mean"], 
+                                    stat_res["kl_divergence"]["mean"],
+                                    epoch=epoch_id,
+                                    iteration=batch_id)
             # update the scheduler
             self.sigma_scheduler.step()
             self.lambda_scheduler.step()
@@ -145,12 +150,21 @@ class MazeEpochCausal: # the computer
             self.max_maze = self.config.max_maze
         else:
             self.max_maze = None
+        # Train on the latents dumped by dump_latents.py, the VAE encoder is skipped
+        if (self.config.has_attr("use_latent_cache")):
+            self.use_latent_cache = self.config.use_latent_cache
+        else:
+            self.use_latent_cache = False
+        if(self.use_latent_cache and self.is_visualize):
+            log_warn("is_visualize requires raw images, predictions are not decoded with use_latent_cache")
+            self.is_visualize = False
         if(self.is_training):
             self.logger_keys = ["learning_rate", 
                         "loss_worldmodel_raw",
                         "loss_worldmodel_latent",
                         "loss_policymodel"]
-            self.stat = DistStatistics(*self.logger_keys[1:])
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(*self.logger_keys[1:], interval=log_interval)
             self.lr = self.config.lr_causal
             self.lr_decay_interval = self.config.lr_causal_decay_interval
             self.lr_start_step = self.config.lr_causal_start_step
@@ -178,9 +192,15 @@ class MazeEpochCausal: # the computer
         return True
 
     def preprocess(self):
+        latent_key = None
+        if(self.use_latent_cache):
+            # The cache is keyed by the VAE weights, stale latents are never picked up
+            latent_key = self.model.module.vae.checksum()
+            if(self.main):
+                log_debug(f"Training on cached latents latents_{latent_key}.npy")
         # use customized dataloader
         self.dataloader = PrefetchDataLoader(
-            MazeDataSet(self.config.data_path, self.config.seq_len_causal, verbose=self.main, max_maze=self.max_maze), # TODO
+            MazeDataSet(self.config.data_path, self.config.seq_len_causal, verbose=self.main, max_maze=self.max_maze, latent_key=latent_key), # TODO
             batch_size=self.config.batch_size_causal,
             rank=self.rank,
             world_size=self.world_size
@@ -199,27 +219,30 @@ class MazeEpochCausal: # the computer
 
         losses = []
         current_prediction_observations = []
-        for sub_idx, seg_cmd, seg_obs, seg_behavior_act, seg_label_act in segment_iterator(
+        for last_seg, (sub_idx, seg_cmd, seg_obs, seg_behavior_act, seg_label_act) in mark_last(segment_iterator(
                                 self.config.seq_len_causal, self.config.seg_len_causal, self.device, 
-                                cmd_arr, (obs_arr, 1), behavior_actid_arr, label_actid_arr):
+                                cmd_arr, (obs_arr, 1), behavior_actid_arr, label_actid_arr)):
 
-            # Permute (B, T, H, W, C) to (B, T, C, H, W)
-            seg_obs = seg_obs.permute(0, 1, 4, 2, 3)
-            seg_obs = seg_obs.contiguous()
+            if(not self.use_latent_cache):
+                # Permute (B, T, H, W, C) to (B, T, C, H, W)
+                seg_obs = seg_obs.permute(0, 1, 4, 2, 3)
+                seg_obs = seg_obs.contiguous()
             # seg_bev = seg_bev.permute(0, 1, 4, 2, 3)
             # seg_bev = seg_bev.contiguous()
 
-            loss, obs_pred, a_pred, __ = self.model.module.sequential_loss(
-                                    prompts = seg_cmd,
-                                    observations = seg_obs,
-                                    tags = None, 
-                                    behavior_actions = seg_behavior_act,
-                                    rewards = None,
-                                    label_actions = seg_label_act, 
-                                    state_dropout=0.20,
-                                    use_loss_weight=self.is_training,
-                                    is_training=self.is_training,
-                                    reduce_dim=self.reduce_dim,) 
+            with self.profiler.phase("forward"):
+                loss, obs_pred, a_pred, __ = self.model.module.sequential_loss(
+                                        prompts = seg_cmd,
+                                        observations = seg_obs,
+                                        tags = None, 
+                                        behavior_actions = seg_behavior_act,
+                                        rewards = None,
+                                        label_actions = seg_label_act, 
+                                        state_dropout=0.20,
+                                        use_loss_weight=self.is_training,
+                                        is_training=self.is_training,
+                                        reduce_dim=self.reduce_dim,
+                                        raw_images=not self.use_latent_cache) 
                                 
             if self.is_visualize and sub_idx % 20 == 0:
                 current_prediction_observations.append(obs_pred)
@@ -229,10 +252,11 @@ class MazeEpochCausal: # the computer
                         + self.config.lossweight_worldmodel_raw * loss["wm-raw"]
                         + self.config.lossweight_policymodel * loss["pm"]
                         + self.config.lossweight_l2 * loss["causal-l2"])
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                                 loss_worldmodel_raw = loss["wm-raw"] / loss["count_wm"],
                                 loss_worldmodel_latent = loss["wm-latent"] / loss["count_wm"],
@@ -242,14 +266,16 @@ class MazeEpochCausal: # the computer
             current_prediction_observations = torch.cat(current_prediction_observations, dim=1)
         
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                            stat_res["loss_worldmodel_raw"]["mean"], 
-                            stat_res["loss_worldmodel_latent"]["mean"],
-                            stat_res["loss_policymodel"]["mean"],
-                            epoch=epoch_id,
-                            iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                    stat_res["loss_worldmodel_raw"]["mean"], 
+                                    stat_res["loss_worldmodel_latent"]["mean"],
+                                    stat_res["loss_policymodel"]["mean"],
+                                    epoch=epoch_id,
+                                    iteration=batch_id)
         else:
             loss_wm_r = []
             loss_wm_l = []
@@ -323,7 +349,8 @@ class MazeEpochCausalShort: # the computer
                         "loss_worldmodel_raw",
                         "loss_worldmodel_latent",
                         "loss_policymodel"]
-            self.stat = DistStatistics(*self.logger_keys[1:])
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(*self.logger_keys[1:], interval=log_interval)
             self.lr = self.config.lr_causal
             self.lr_decay_interval = self.config.lr_causal_decay_interval
             self.lr_start_step = self.config.lr_causal_start_step
@@ -372,9 +399,9 @@ class MazeEpochCausalShort: # the computer
 
         losses = []
         current_prediction_observations = []
-        for sub_idx, seg_cmd, seg_obs, seg_behavior_act, seg_label_act in segment_iterator(
+        for last_seg, (sub_idx, seg_cmd, seg_obs, seg_behavior_act, seg_label_act) in mark_last(segment_iterator(
                                 self.config.seq_len_causal, self.config.seg_len_causal, self.device, 
-                                cmd_arr, (obs_arr, 1), behavior_actid_arr, label_actid_arr):
+                                cmd_arr, (obs_arr, 1), behavior_actid_arr, label_actid_arr)):
 
             # Permute (B, T, H, W, C) to (B, T, C, H, W)
             seg_obs = seg_obs.permute(0, 1, 4, 2, 3)
@@ -382,17 +409,18 @@ class MazeEpochCausalShort: # the computer
             # seg_bev = seg_bev.permute(0, 1, 4, 2, 3)
             # seg_bev = seg_bev.contiguous()
 
-            loss, obs_pred, __, __ = self.model.module.sequential_loss(
-                                    prompts = seg_cmd,
-                                    observations = seg_obs,
-                                    tags = None, 
-                                    behavior_actions = seg_behavior_act,
-                                    rewards = None,
-                                    label_actions = seg_label_act, 
-                                    state_dropout=0.20,
-                                    use_loss_weight=self.is_training,
-                                    is_training=self.is_training,
-                                    reduce_dim=self.reduce_dim,) 
+            with self.profiler.phase("forward"):
+                loss, obs_pred, __, __ = self.model.module.sequential_loss(
+                                        prompts = seg_cmd,
+                                        observations = seg_obs,
+                                        tags = None, 
+                                        behavior_actions = seg_behavior_act,
+                                        rewards = None,
+                                        label_actions = seg_label_act, 
+                                        state_dropout=0.20,
+                                        use_loss_weight=self.is_training,
+                                        is_training=self.is_training,
+                                        reduce_dim=self.reduce_dim,) 
             
             if self.is_visualize and sub_idx % 20 == 0:
                 current_prediction_observations.append(obs_pred)
@@ -404,10 +432,11 @@ class MazeEpochCausalShort: # the computer
                         + self.config.lossweight_worldmodel_raw * loss["wm-raw"]
                         + self.config.lossweight_policymodel * loss["pm"]
                         + self.config.lossweight_l2 * loss["causal-l2"])
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                                 loss_worldmodel_raw = loss["wm-raw"] / loss["count_wm"],
                                 loss_worldmodel_latent = loss["wm-latent"] / loss["count_wm"],
@@ -417,14 +446,16 @@ class MazeEpochCausalShort: # the computer
             current_prediction_observations = torch.cat(current_prediction_observations, dim=1)
         
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                            stat_res["loss_worldmodel_raw"]["mean"], 
-                            stat_res["loss_worldmodel_latent"]["mean"],
-                            stat_res["loss_policymodel"]["mean"],
-                            epoch=epoch_id,
-                            iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                    stat_res["loss_worldmodel_raw"]["mean"], 
+                                    stat_res["loss_worldmodel_latent"]["mean"],
+                                    stat_res["loss_policymodel"]["mean"],
+                                    epoch=epoch_id,
+                                    iteration=batch_id)
         else:
             loss_wm_r = []
             loss_wm_l = []
@@ -2,11 +2,11 @@ import os
 import torch
 import torch.optim as optim
 
-from airsoul.dataloader import segment_iterator
+from airsoul.dataloader import segment_iterator, mark_last
 from airsoul.utils import Logger, log_progress, log_debug, log_warn, log_fatal
 from airsoul.utils import custom_load_model, noam_scheduler, LinearScheduler
 from airsoul.utils import Configure, DistStatistics, rewards2go
-from airsoul.utils import EpochManager
+from airsoul.utils import EpochManager, final_backward
 from airsoul.dataloader import LMDataSet
 
 def string_mean_var(downsample_length, res):
@@ -24,7 +24,8 @@ class LMEpoch:
         if(self.is_training):
             self.logger_keys = ["learning_rate", 
                         "train_perplexity"]
-            self.stat = DistStatistics(*self.logger_keys[1:])
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(*self.logger_keys[1:], interval=log_interval)
             self.reduce = 1
         else:
             self.logger_keys = ["validate_perplexity"]
@@ -43,30 +44,34 @@ class LMEpoch:
             assert self.optimizer is not None, "optimizer is required for training"
 
         losses = []
-        for sub_idx, fea, lab in segment_iterator(
+        for last_seg, (sub_idx, fea, lab) in mark_last(segment_iterator(
                     self.config.seq_len, self.config.seg_len, self.device, 
-                    feas, labs):
-            loss = self.model.module.perplexity(
-                    fea, lab,
-                    use_loss_weight=self.is_training,
-                    reduce_dim=self.reduce) # Do not use loss weight for evaluation
+                    feas, labs)):
+            with self.profiler.phase("forward"):
+                loss = self.model.module.perplexity(
+                        fea, lab,
+                        use_loss_weight=self.is_training,
+                        reduce_dim=self.reduce) # Do not use loss weight for evaluation
             losses.append(loss)
             if(self.is_training):
                 syn_loss = loss["perplexity"]
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                     train_perplexity=syn_loss / loss["count"],
                     count = loss["count"])
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                        stat_res["train_perplexity"]["mean"],
-                        epoch=epoch_id,
-                        iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                stat_res["train_perplexity"]["mean"],
+                                epoch=epoch_id,
+                                iteration=batch_id)
         else:
             perpl = torch.cat([loss["perplexity"] / loss["count"] for loss in losses], dim=1)
             counts = torch.cat([loss["count"] for loss in losses], dim=1)
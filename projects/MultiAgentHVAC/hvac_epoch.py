@@ -2,10 +2,10 @@ import os
 import torch
 import numpy
 
-from airsoul.dataloader import segment_iterator
+from airsoul.dataloader import segment_iterator, mark_last
 from airsoul.utils import Logger, log_progress, log_debug, log_warn, log_fatal
 from airsoul.utils import DistStatistics, downsample
-from airsoul.utils import EpochManager, GeneratorBase, Logger
+from airsoul.utils import EpochManager, GeneratorBase, Logger, final_backward
 from airsoul.dataloader import MultiAgentDataSetVetorized
 
 def string_mean_var(downsample_length, res):
@@ -30,7 +30,8 @@ class HVACEpoch:
                         "loss_worldmodel_reward", 
                         "loss_policymodel",
                         "entropy"]
-            self.stat = DistStatistics()
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(interval=log_interval)
             self.reduce = 1
         else:
             self.logger_keys = ["validation_state_pred", 
@@ -67,13 +68,14 @@ class HVACEpoch:
             state_dropout = 0.0
 
         losses = []
-        for sub_idx, seq, label in segment_iterator(self.config.seq_len, self.config.seg_len, self.device, seq_arr, label_arr):
-            loss = self.model.module.sequential_loss(
-                    seq, 
-                    label, 
-                    use_loss_weight=self.is_training,
-                    update_memory=True,
-                    reduce_dim=self.reduce)
+        for last_seg, (sub_idx, seq, label) in mark_last(segment_iterator(self.config.seq_len, self.config.seg_len, self.device, seq_arr, label_arr)):
+            with self.profiler.phase("forward"):
+                loss = self.model.module.sequential_loss(
+                        seq, 
+                        label, 
+                        use_loss_weight=self.is_training,
+                        update_memory=True,
+                        reduce_dim=self.reduce)
             losses.append(loss)
             obs_pre_step = loss["count_s"]/loss["count_p"]
             agent_pre_step = loss["count_a"]/loss["count_p"]
@@ -84,10 +86,11 @@ class HVACEpoch:
                         + self.config.lossweight_worldmodel_rewards * loss["reward"]
                         + self.config.lossweight_entropy * loss["ent"]
                         + self.config.lossweight_l2 * loss["causal-l2"])
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                     loss_worldmodel_state = loss["wm_obs"] / loss["count_s"],
                     loss_worldmodel_other_agent = loss["wm_agent"] / loss["count_a"],
@@ -97,16 +100,18 @@ class HVACEpoch:
                     count = loss["count_p"])
                 
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                        stat_res["loss_worldmodel_state"]["mean"], 
-                        stat_res["loss_worldmodel_other_agent"]["mean"],
-                        stat_res["loss_worldmodel_reward"]["mean"], 
-                        stat_res["loss_policymodel"]["mean"], 
-                        stat_res["entropy"]["mean"],
-                        epoch=epoch_id,
-                        iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                stat_res["loss_worldmodel_state"]["mean"], 
+                                stat_res["loss_worldmodel_other_agent"]["mean"],
+                                stat_res["loss_worldmodel_reward"]["mean"], 
+                                stat_res["loss_policymodel"]["mean"], 
+                                stat_res["entropy"]["mean"],
+                                epoch=epoch_id,
+                                iteration=batch_id)
         else:
             loss_wm_s = torch.cat([loss["wm_obs"] / torch.clamp_min(loss["count_s"], 1.0e-3) 
                     for loss in losses], dim=1)
@@ -3,11 +3,11 @@ import torch
 import torch.optim as optim
 from torch.optim.lr_scheduler import LambdaLR
 
-from airsoul.dataloader import segment_iterator
+from airsoul.dataloader import segment_iterator, mark_last
 from airsoul.utils import Logger, log_progress, log_debug, log_warn, log_fatal
 from airsoul.utils import custom_load_model, noam_scheduler, LinearScheduler
 from airsoul.utils import Configure, DistStatistics, rewards2go, downsample
-from airsoul.utils import EpochManager, GeneratorBase, Logger
+from airsoul.utils import EpochManager, GeneratorBase, Logger, final_backward
 from airsoul.utils import tag_vocabulary, tag_mapping_id, tag_mapping_gamma
 from airsoul.dataloader import AnyMDPDataSet, AnyMDPv2DataSet, AnyMDPDataSetContinuousState, AnyMDPDataSetContinuousStateAction
 
@@ -47,7 +47,8 @@ class OmniRLEpoch:
                         "loss_worldmodel_reward", 
                         "loss_policymodel",
                         "entropy"]
-            self.stat = DistStatistics()
+            log_interval = self.config.log_interval if(self.config.has_attr("log_interval")) else 1
+            self.stat = DistStatistics(interval=log_interval)
             self.reduce = 1
         else:
             self.logger_keys = ["validation_state_pred", 
@@ -83,20 +84,21 @@ class OmniRLEpoch:
             state_dropout = 0.0
 
         losses = []
-        for sub_idx, states, prompts, tags, bactions, rewards, lactions in segment_iterator(
+        for last_seg, (sub_idx, states, prompts, tags, bactions, rewards, lactions) in mark_last(segment_iterator(
                     self.config.seq_len, self.config.seg_len, self.device, 
-                    (sarr, 1), parr, tarr, baarr, rarr, laarr):
-            loss = self.model.module.sequential_loss(
-                    states,  # Observations
-                    prompts,  # Prompts
-                    tags,  # Tags
-                    bactions, # Behavior Actions
-                    rewards, # Rewards
-                    lactions, # Reference Actions
-                    state_dropout=state_dropout, 
-                    use_loss_weight=self.is_training,
-                    is_training=self.is_training,
-                    reduce_dim=self.reduce) # Do not use loss weight for evaluation
+                    (sarr, 1), parr, tarr, baarr, rarr, laarr)):
+            with self.profiler.phase("forward"):
+                loss = self.model.module.sequential_loss(
+                        states,  # Observations
+                        prompts,  # Prompts
+                        tags,  # Tags
+                        bactions, # Behavior Actions
+                        rewards, # Rewards
+                        lactions, # Reference Actions
+                        state_dropout=state_dropout, 
+                        use_loss_weight=self.is_training,
+                        is_training=self.is_training,
+                        reduce_dim=self.reduce) # Do not use loss weight for evaluation
             losses.append(loss)
             if(self.is_training):
                 syn_loss = (self.config.lossweight_worldmodel_states * loss["wm-s"]
@@ -104,10 +106,11 @@ class OmniRLEpoch:
                         + self.config.lossweight_entropy * loss["ent"]
                         + self.config.lossweight_policymodel * loss["pm"]
                         + self.config.lossweight_l2 * loss["causal-l2"])
-                if(self.scaler is not None):
-                    self.scaler.scale(syn_loss).backward()
-                else:
-                    syn_loss.backward()
+                with self.profiler.phase("backward"), final_backward(self.grad_sync, last_seg):
+                    if(self.scaler is not None):
+                        self.scaler.scale(syn_loss).backward()
+                    else:
+                        syn_loss.backward()
                 self.stat.gather(self.device,
                     loss_worldmodel_state = loss["wm-s"] / loss["count_s"],
                     loss_worldmodel_reward = loss["wm-r"] / loss["count_s"],
@@ -115,15 +118,17 @@ class OmniRLEpoch:
                     entropy = -loss["ent"] / loss["count_a"],
                     count = loss["count_a"])
         if(self.is_training):
-            stat_res = self.stat()
-            if(self.logger is not None):
-                self.logger(self.optimizer.param_groups[0]['lr'],
-                        stat_res["loss_worldmodel_state"]["mean"], 
-                        stat_res["loss_worldmodel_reward"]["mean"], 
-                        stat_res["loss_policymodel"]["mean"], 
-                        stat_res["entropy"]["mean"],
-                        epoch=epoch_id,
-                        iteration=batch_id)
+            with self.profiler.phase("stat"):
+                if(self.last_micro_batch and self.stat.due()):
+                    stat_res = self.stat()
+                    if(self.logger is not None):
+                        self.logger(self.optimizer.param_groups[0]['lr'],
+                                stat_res["loss_worldmodel_state"]["mean"], 
+                                stat_res["loss_worldmodel_reward"]["mean"], 
+                                stat_res["loss_policymodel"]["mean"], 
+                                stat_res["entropy"]["mean"],
+                                epoch=epoch_id,
+                                iteration=batch_id)
         else:
             loss_wm_s = torch.cat([loss["wm-s"] / torch.clamp_min(loss["count_s"], 1.0e-3) 
                     for loss in losses], dim=1)
@@ -182,6 +187,7 @@ class OmniRLGenerator(GeneratorBase):
             self.task_sampler = self.task_sampler_cliff
         elif(self.config.env.lower().find("anymdp") >= 0):
             self.env = gymnasium.make("anymdp-v0", max_steps=self.max_steps)
+            self.anymdp_envs = [self.env]
             self.task_sampler = self.task_sampler_anymdp
             if self.config.mult_anymdp_task:
                 self.mult_anymdp_task = True
@@ -198,6 +204,16 @@ class OmniRLGenerator(GeneratorBase):
         else:
             log_fatal("Unsupported environment:", self.config.env)
 
+        # Run num_envs environments in lockstep as one batch, see batched_rollout
+        if(self.config.has_attr("num_envs")):
+            self.num_envs = self.config.num_envs
+        else:
+            self.num_envs = 1
+        if(self.num_envs > 1):
+            if(self.config.learn_from_data or self.config.use_dym_tag or self.config.save_gif
+                    or (self.config.has_attr("save_cache") and self.config.save_cache)):
+                log_warn("learn_from_data, use_dym_tag, save_gif and save_cache are ignored with num_envs > 1", on=self.main)
+
         if(self.config.has_attr("task_file")):
             with open(self.config.task_file, 'rb') as fr:
                 self.tasks = pickle.load(fr)
@@ -360,15 +376,31 @@ class OmniRLGenerator(GeneratorBase):
         else:
             return 0
     
-    def reset_env(self):
+    def reset_env(self, env=None):
+        if env is None:
+            env = self.env
         if self.config.env.lower().find("pendulum") >= 0:
-            state, *_ = self.env.reset(seed=123, options={"low": -0.7, "high": 0.5})
+            state, *_ = env.reset(seed=123, options={"low": -0.7, "high": 0.5})
         elif self.config.env.lower().find("mountaincar") >= 0:
-            state, *_ = self.env.reset(seed=123, options={"x_init": numpy.pi/2, "y_init": 0.5})
+            state, *_ = env.reset(seed=123, options={"x_init": numpy.pi/2, "y_init": 0.5})
         else:
-            state, *_ = self.env.reset()
+            state, *_ = env.reset()
         return state
 
+    def sample_envs(self, epoch_id):
+        # Sample num_envs environments with independent tasks, epoch epoch_id covers tasks epoch_id * num_envs + [0, num_envs)
+        envs = []
+        task_ids = []
+        for i in range(self.num_envs):
+            if(self.config.env.lower().find("anymdp") >= 0):
+                # anymdp tasks are set on an existing environment, keep one environment per slot
+                if(len(self.anymdp_envs) <= i):
+                    self.anymdp_envs.append(gymnasium.make("anymdp-v0", max_steps=self.max_steps))
+                self.env = self.anymdp_envs[i]
+            task_ids.append(self.task_sampler(epoch_id=epoch_id * self.num_envs + i))
+            envs.append(self.env)
+        return envs, task_ids
+
     def check_task(self, oracle_reward_file, oracle_prompt_file, random_reward_file, random_prompt_file, threshold = 1.0):
         def get_reward(reward_file_path, prompt_file_path):
             rewards = numpy.load(reward_file_path)
@@ -713,8 +745,186 @@ class OmniRLGenerator(GeneratorBase):
                 single_step=False)
 
         
+    def batched_rollout(self, epoch_id):
+        """
+        In-context learning on num_envs environments in lockstep, fed as one batch through generate / in_context_learn
+        Each environment keeps its own row of the recurrent memory (BlockRecurrentWrapper), while the memory position is shared,
+        so every row advances by exactly one step per call and finished environments are masked instead of removed:
+            an environment that ends a trail feeds the end-of-trail marker at the next step, then resets,
+            as the single-environment path feeds it right after the last step
+            an environment that has run all its trails keeps feeding the marker, its outputs are discarded
+        """
+        envs, task_ids = self.sample_envs(epoch_id)
+        n_envs = len(envs)
+        active = numpy.ones(n_envs, dtype=bool)
+        reward_norm = [(1.0, 0.0, None, None) for _ in range(n_envs)]
+        if self.mult_anymdp_task:
+            for i, task_id in enumerate(task_ids):
+                if not self.nomalize_anymdp_reward(task_id):
+                    print("Skip task: ", task_id)
+                    active[i] = False
+                    continue
+                reward_norm[i] = (self.reward_nomalize_factor, self.reward_nomalize_constant,
+                                  getattr(self, "step_reward_nomalize_factor", None),
+                                  getattr(self, "step_reward_nomalize_constant", None))
+            if not active.any():
+                return
+
+        interactive_prompt = torch.full((n_envs, 1), 3, dtype=torch.int64) # opt3 with gamma 0.994
+        interactive_tag = torch.full((n_envs, 1), 7, dtype=torch.int64) # Unknown, let model deside current policy quality
+
+        states = [self.reset_env(env) for env in envs]
+        trail = numpy.zeros(n_envs, dtype=numpy.int64)
+        total_step = numpy.zeros(n_envs, dtype=numpy.int64)
+        step = numpy.zeros(n_envs, dtype=numpy.int64)
+        trail_reward = numpy.zeros(n_envs)
+        trail_obs_loss = numpy.zeros(n_envs)
+        trail_reward_loss = numpy.zeros(n_envs)
+        success_rate_f = numpy.zeros(n_envs)
+        # The trail ended at the previous step, the end-of-trail marker is fed at this one
+        pending_end = numpy.zeros(n_envs, dtype=bool)
+        finished = ~active
+        # World model prediction of the last real step, scored against the first state of the next trail
+        last_pred_state_dist = [None for _ in range(n_envs)]
+
+        rew_stat = [[] for _ in range(n_envs)]
+        state_error = [[] for _ in range(n_envs)]
+        reward_error = [[] for _ in range(n_envs)]
+        success_rate = [[] for _ in range(n_envs)]
+        step_trail = [[] for _ in range(n_envs)]
+        rew_wo_done_arr = [[] for _ in range(n_envs)]
+
+        while active.any():
+            # The temperature follows the least advanced environment
+            temp = self._scheduler(int(numpy.min(total_step[active])))
+            obs_in = torch.tensor(numpy.array(states), dtype=torch.int64).unsqueeze(1)
+            pred_state_dist, actions, pred_reward = self.model.module.generate(
+                obs_in,
+                interactive_prompt,
+                interactive_tag,
+                temp=temp,
+                need_numpy=True,
+                single_batch=False,
+                future_prediction=True)
+            pred_state_dist = numpy.reshape(pred_state_dist, (n_envs, -1))
+            actions = numpy.reshape(actions, (n_envs,))
+            pred_reward = numpy.broadcast_to(pred_reward, (n_envs,))
+
+            learn_states = list(states)
+            learn_actions = numpy.full(n_envs, self.action_dim, dtype=numpy.int64)
+            learn_rewards = numpy.zeros(n_envs, dtype=numpy.float32)
+            trail_ended = numpy.zeros(n_envs, dtype=bool)
+            for i, env in enumerate(envs):
+                # Masked: the end-of-trail marker is fed with the last state
+                if(pending_end[i] or finished[i]):
+                    continue
+                env_action = actions[i] % self.config.action_clip 
+                new_state, new_reward, terminated, truncated, *_ = env.step(env_action)
+                if self.config.env.lower().find("anymdp") >= 0:
+                    done = terminated
+                else:
+                    done = terminated or truncated
+                shaped_reward = self.reward_shaping(done, terminated, new_reward)
+
+                learn_actions[i] = actions[i]
+                learn_rewards[i] = shaped_reward
+                if total_step[i] + step[i] < self.max_total_steps:
+                    rew_wo_done_arr[i].append(new_reward)
+                states[i] = new_state
+                last_pred_state_dist[i] = pred_state_dist[i]
+
+                trail_obs_loss[i] += -numpy.log(pred_state_dist[i][int(new_state)].item())
+                trail_reward[i] += new_reward
+                trail_reward_loss[i] += (shaped_reward - pred_reward[i]) ** 2
+
+                step[i] += 1 + self.config.skip_frame
+                if(step[i] > self.max_steps):
+                    step[i] = self.max_steps
+                    print("Reach max_steps, break trail.")
+                    done = True
+                if(done):
+                    trail_ended[i] = True
+                    # success rate
+                    succ_fail = self.is_success_fail(new_reward, trail_reward[i], terminated)
+                    if trail[i] + 1 < self.config.downsample_trail:
+                        success_rate_f[i] = (1-1/(trail[i]+1)) * success_rate_f[i] + succ_fail / (trail[i]+1)
+                    else:
+                        success_rate_f[i] = (1-1/self.config.downsample_trail) * success_rate_f[i] + succ_fail / self.config.downsample_trail
+
+                    factor, constant, _, _ = reward_norm[i]
+                    rew_stat[i].append(factor * trail_reward[i] + constant)
+                    state_error[i].append(trail_obs_loss[i] / step[i])
+                    reward_error[i].append(trail_reward_loss[i] / step[i])
+                    success_rate[i].append(success_rate_f[i])
+                    step_trail[i].append(step[i])
+
+                    trail[i] += 1
+                    total_step[i] += step[i]
+                    self.logger(trail[i],
+                                total_step[i],
+                                step_trail[i][-1],
+                                rew_stat[i][-1], 
+                                state_error[i][-1], 
+                                reward_error[i][-1],
+                                success_rate[i][-1])
+
+            # start learning, one step for every environment
+            self.model.module.in_context_learn(
+                torch.tensor(numpy.array(learn_states), dtype=torch.int64),
+                interactive_prompt[:, 0],
+                interactive_tag[:, 0],
+                torch.from_numpy(learn_actions),
+                torch.from_numpy(learn_rewards),
+                single_batch=False,
+                single_step=True)
+
+            # The marker has been fed, start the next trail
+            for i, env in enumerate(envs):
+                if(not pending_end[i]):
+                    continue
+                if(trail[i] >= self.max_trails and total_step[i] >= self.max_total_steps):
+                    finished[i] = True
+                    active[i] = False
+                    continue
+                step[i] = 0
+                trail_reward[i] = 0.0
+                trail_reward_loss[i] = 0.0
+                states[i] = self.reset_env(env)
+                trail_obs_loss[i] = -numpy.log(last_pred_state_dist[i][int(states[i])].item())
+            pending_end = trail_ended
+
+        for i in range(n_envs):
+            if(len(rew_stat[i]) < 1):
+                continue
+            # Save step reward
+            if self.max_total_steps > 1.0:
+                array_to_save = numpy.array(rew_wo_done_arr[i])
+                _, _, step_factor, step_constant = reward_norm[i]
+                if step_factor is not None:
+                    array_to_save = array_to_save * step_factor + step_constant
+                file_path = f'{self.config.output}/step_reward/'
+                if not os.path.exists(file_path):
+                    os.makedirs(file_path)
+                numpy.save(f'{file_path}/step_reward_{task_ids[i]}.npy', array_to_save)
+
+            self.stat.gather(self.device,
+                             step=downsample(step_trail[i], self.config.downsample_trail),
+                             reward=downsample(rew_stat[i], self.config.downsample_trail),
+                             state_prediction=downsample(state_error[i], self.config.downsample_trail),
+                             reward_prediction=downsample(reward_error[i], self.config.downsample_trail),
+                             success_rate=downsample(success_rate[i], self.config.downsample_trail))
+
     def __call__(self, epoch_id):
 
+        if(self.num_envs > 1 and self.config.run_icl):
+            if self.config.run_benchmark.run_opt or self.config.run_benchmark.run_online or self.config.run_benchmark.run_random:
+                print("Run Benchmark & ICL")
+                # The benchmarks run on the single environment of the task
+                task_id = self.task_sampler(epoch_id=epoch_id)
+                if not self.mult_anymdp_task or self.nomalize_anymdp_reward(task_id):
+                    self.benchmark(epoch_id)
+            return self.batched_rollout(epoch_id)
+
         task_id = self.task_sampler(epoch_id=epoch_id)
 
         if self.mult_anymdp_task:
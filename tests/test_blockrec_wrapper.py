@@ -0,0 +1,97 @@
+import copy
+import torch
+import pytest
+from torch.testing import assert_close
+from airsoul.utils import memory_cpy, memory_borrow
+from airsoul.modules.blockrec_wrapper import BlockRecurrentWrapper
+from airsoul.modules.transformers import ARTransformerEncoder
+from airsoul.modules.block_wrapper import MultiBlocks
+from airsoul.modules.recursion import SimpleLSTM, PRNN
+from airsoul.modules.gsa import GLABlock, GSABlock
+from airsoul.modules.rwkv6 import RWKV6Layer
+from airsoul.modules.rwkv7 import RWKV7Layer
+from airsoul.modules.deltanet import GatedDeltaNet
+from airsoul.modules.mamba import MambaBlock
+
+# Read-only calls must leave the states bit-identical
+EXACT = dict(atol=0.0, rtol=0.0)
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# fla / mamba_ssm layers, or their plain PyTorch versions without the kernels
+LAYERS = {
+    "gla": lambda: GLABlock(io_size=32, num_heads=4),
+    "gsa": lambda: GSABlock(io_size=32, num_heads=4, num_slots=4),
+    "rwkv6": lambda: RWKV6Layer(io_size=32, intermediate_size=64, num_heads=2),
+    "rwkv7": lambda: RWKV7Layer(io_size=32, intermediate_size=64, num_heads=2),
+    "deltanet": lambda: GatedDeltaNet(io_size=32, intermediate_size=64, num_heads=2, expend_v=1),
+    "mamba": lambda: MambaBlock(io_size=32, d_state=8),
+}
+
+WRAPPED = {
+    "transformer": (lambda: ARTransformerEncoder(2, 32, 4, 256, dim_feedforward=64, dropout=0.0), "kv"),
+    "lstm": (lambda: MultiBlocks(SimpleLSTM, 2, hidden=32, fc_hidden=64, fc_dropout=0.0, io_size=32, hidden_size=32), "mem"),
+    "prnn": (lambda: MultiBlocks(PRNN, 2, hidden=32, fc_hidden=64, fc_dropout=0.0, io_size=32, hidden_size=16), "mem"),
+    "gla": (lambda: MultiBlocks(GLABlock, 2, hidden=32, fc_hidden=64, fc_dropout=0.0, io_size=32, num_heads=4), "mem"),
+    "rwkv7": (lambda: MultiBlocks(RWKV7Layer, 2, need_block_wrapper=False, io_size=32,
+                                  intermediate_size=64, num_heads=2), "mem"),
+    "deltanet": (lambda: MultiBlocks(GatedDeltaNet, 2, need_block_wrapper=False, io_size=32,
+                                     intermediate_size=64, num_heads=2, expend_v=1), "mem"),
+    "mamba": (lambda: MultiBlocks(MambaBlock, 2, hidden=32, fc_hidden=64, fc_dropout=0.0, io_size=32, d_state=8), "mem"),
+}
+
+def flatten(cache):
+    if(isinstance(cache, torch.Tensor)):
+        return [cache]
+    elif(isinstance(cache, dict)):
+        return [t for k in cache for t in flatten(cache[k])]
+    elif(isinstance(cache, list) or isinstance(cache, tuple)):
+        return [t for c in cache for t in flatten(c)]
+    return []
+
+def test_memory_borrow_shares_only_the_recurrent_state():
+    state = {"recurrent_state": torch.randn(2, 3), "conv_state": (torch.randn(2, 4),), "attn_state": None}
+    borrowed = memory_borrow([state])
+    assert borrowed[0] is not state
+    assert borrowed[0]["recurrent_state"].data_ptr() == state["recurrent_state"].data_ptr()
+    assert borrowed[0]["conv_state"][0].data_ptr() != state["conv_state"][0].data_ptr()
+    assert_close(borrowed[0]["conv_state"][0], state["conv_state"][0], **EXACT)
+    borrowed[0]["conv_state"][0].add_(1.0)
+    borrowed[0]["recurrent_state"] = torch.zeros(2, 3)
+    assert not torch.equal(borrowed[0]["conv_state"][0], state["conv_state"][0])
+    assert state["recurrent_state"].abs().sum() > 0
+
+@pytest.mark.parametrize("name", list(LAYERS.keys()))
+def test_layer_does_not_modify_its_input_state(name):
+    torch.manual_seed(0)
+    layer = LAYERS[name]().to(DEVICE).eval()
+    x = torch.randn(2, 24, 32, device=DEVICE)
+    with torch.no_grad():
+        _, cache = layer(x[:, :16], need_cache=True)
+        snapshot = memory_cpy(cache)
+        first, _ = layer(x[:, 16:], cache=cache, need_cache=True)
+        step, _ = layer(x[:, 16:17], cache=cache, need_cache=True)
+        again, _ = layer(x[:, 16:], cache=cache, need_cache=True)
+    for tensor, reference in zip(flatten(cache), flatten(snapshot)):
+        assert_close(tensor, reference, **EXACT)
+    assert_close(again, first, **EXACT)
+
+@pytest.mark.parametrize("name", list(WRAPPED.keys()))
+def test_read_only_calls_leave_the_memory_unchanged(name):
+    # After update_memory=False calls the wrapper continues exactly like a copy that never made them
+    torch.manual_seed(0)
+    build, memory_type = WRAPPED[name]
+    model = BlockRecurrentWrapper(build().to(DEVICE).eval(), 16, memory_type=memory_type)
+    src = torch.randn(2, 80, 32, device=DEVICE)
+    with torch.no_grad():
+        for t in range(2):
+            model(src[:, t*8:(t+1)*8])
+        reference = copy.deepcopy(model)
+        first, cache = model(src[:, 16:24], need_cache=True, update_memory=False)
+        for t in range(3, 6):
+            _, cache = model(src[:, t*8:(t+1)*8], cache=cache, need_cache=True, update_memory=False)
+        again, _ = model(src[:, 16:24], update_memory=False)
+        assert_close(again, first, **EXACT)
+        for t in range(6, 10):
+            out, _ = model(src[:, t*8:(t+1)*8])
+            ref_out, _ = reference(src[:, t*8:(t+1)*8])
+            assert_close(out, ref_out, **EXACT)
@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+import subprocess
+
+# Importing the packages must not pull in the trainer, the plotting / gym stacks or the optional backends
+HEAVY_MODULES = ["airsoul.utils.trainer", "matplotlib", "gym", "fla", "mamba_ssm"]
+# Seconds, the import of torch itself is not counted
+IMPORT_TIME_BUDGET = 1.0
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def fresh_import(*modules):
+    """
+    Import the modules in a fresh interpreter, returns the import time and the heavy modules that got loaded
+    """
+    code = ("import sys, time, json; import torch; t = time.perf_counter(); "
+            f"import {', '.join(modules)}; t = time.perf_counter() - t; "
+            f"print(json.dumps({{'time': t, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))")
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True, cwd=REPO_ROOT)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_is_light():
+    for modules in [("airsoul",), ("airsoul.utils",), ("airsoul.utils", "airsoul.modules")]:
+        result = fresh_import(*modules)
+        assert result["loaded"] == [], f"import {', '.join(modules)} imported eagerly: {result['loaded']}"
+        assert result["time"] < IMPORT_TIME_BUDGET, \
+            f"import {', '.join(modules)} took {result['time']:.3f} s, budget {IMPORT_TIME_BUDGET} s"
+
+def test_lazy_attributes_resolve():
+    result = subprocess.run([sys.executable, "-c", "import airsoul.utils as u; print(u.Runner.__name__)"],
+                            check=True, capture_output=True, text=True, cwd=REPO_ROOT)
+    assert result.stdout.strip().splitlines()[-1] == "Runner"
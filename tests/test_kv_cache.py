@@ -0,0 +1,108 @@
+import torch
+from torch.testing import assert_close
+from airsoul.modules.transformers import ARTransformerEncoder
+from airsoul.modules.rope_mha import KVCache, RotaryEmbedding
+
+# float32, the cached path only reorders the same additions
+ATOL, RTOL = 1.0e-5, 1.0e-4
+
+def make_encoder(context_window=-1, max_position_encoding=128):
+    torch.manual_seed(0)
+    return ARTransformerEncoder(2, 64, 4, max_position_encoding, dim_feedforward=128, dropout=0.0,
+                                context_window=context_window).eval()
+
+def run_segments(model, src, sizes, cache=None):
+    outputs = []
+    b = 0
+    for n in sizes:
+        out, cache = model(src[:, b:b + n], cache=cache, need_cache=True)
+        outputs.append(out)
+        b += n
+    return torch.cat(outputs, dim=1), cache
+
+def test_incremental_matches_full_sequence():
+    src = torch.randn(2, 32, 64)
+    for context_window in [-1, 5]:
+        model = make_encoder(context_window)
+        with torch.no_grad():
+            full, _ = model(src)
+            for sizes in [[1] * 32, [4] * 8, [7, 1, 13, 11]]:
+                incremental, cache = run_segments(model, src, sizes)
+                assert_close(incremental, full, atol=ATOL, rtol=RTOL)
+                assert len(cache[0]) == 32
+
+def test_append_is_copy_on_write():
+    # Two continuations of the same cache must not see each other's entries
+    src = torch.randn(2, 24, 64)
+    model = make_encoder()
+    with torch.no_grad():
+        full_a, _ = model(src)
+        full_b, _ = model(torch.cat([src[:, :16], src[:, 16:].flip(1)], dim=1))
+        _, cache = model(src[:, :16], need_cache=True)
+        keys = [c.key.clone() for c in cache]
+        values = [c.value.clone() for c in cache]
+
+        out_a, cache_a = model(src[:, 16:], cache=cache, need_cache=True)
+        out_b, cache_b = model(src[:, 16:].flip(1), cache=cache, need_cache=True)
+        again_a, _ = model(src[:, 16:], cache=cache)
+
+    assert_close(out_a, full_a[:, 16:], atol=ATOL, rtol=RTOL)
+    assert_close(out_b, full_b[:, 16:], atol=ATOL, rtol=RTOL)
+    assert_close(again_a, out_a, atol=0.0, rtol=0.0)
+    for c, k, v in zip(cache, keys, values):
+        assert len(c) == 16
+        assert_close(c.key, k, atol=0.0, rtol=0.0)
+        assert_close(c.value, v, atol=0.0, rtol=0.0)
+    assert len(cache_a[0]) == 24 and len(cache_b[0]) == 24
+
+def rotated(raw, rope, start):
+    # raw: [bs, nhead, length, d_head] unrotated keys, rotated from position start
+    return rope.rotate(raw.transpose(1, 2), start).transpose(1, 2)
+
+def shift(key, rope, n):
+    return rope.shift(key, n) if n != 0 else key
+
+def test_compaction_keeps_entries_and_positions():
+    # tail() moves the start of the window, reaching the end of the rotary table moves the window back to the front
+    torch.manual_seed(0)
+    bsz, nhead, d_head, end = 2, 3, 8, 40
+    rope = RotaryEmbedding(d_head, end)
+    raw_k = torch.randn(bsz, nhead, 200, d_head)
+    raw_v = torch.randn(bsz, nhead, 200, d_head)
+
+    cache = KVCache.create(rotated(raw_k[:, :, :10], rope, 0), raw_v[:, :, :10], rope, capacity=end)
+    storage = cache.storage
+    first, last = 0, 10
+    compacted = False
+    while(last < 200):
+        n = 7
+        start = cache.tail(12).start
+        cache = cache.tail(12).reserve(n)
+        compacted = compacted or cache.start < start
+        first = last - len(cache)
+        cache = cache.append(rotated(raw_k[:, :, last:last + n], rope, cache.end), raw_v[:, :, last:last + n])
+        last += n
+        # The key in slot i is rotated at position i, the entries are those of the window
+        assert_close(cache.key, rotated(raw_k[:, :, first:last], rope, cache.start), atol=ATOL, rtol=RTOL)
+        assert_close(cache.value, raw_v[:, :, first:last], atol=0.0, rtol=0.0)
+    assert compacted
+    # The window always fits, the buffers are never reallocated
+    assert cache.storage is storage
+
+def test_branch_is_not_overwritten_by_compaction():
+    # A cache kept aside (e.g. a memory under update_memory=False) survives the appends of another view
+    torch.manual_seed(1)
+    bsz, nhead, d_head, end = 1, 2, 8, 32
+    rope = RotaryEmbedding(d_head, end)
+    raw_k = torch.randn(bsz, nhead, 64, d_head)
+    raw_v = torch.randn(bsz, nhead, 64, d_head)
+    kept = KVCache.create(rotated(raw_k[:, :, :20], rope, 0), raw_v[:, :, :20], rope, capacity=end).tail(8)
+    kept_key, kept_value = kept.key.clone(), kept.value.clone()
+
+    cache = kept
+    for b in range(20, 60, 5):
+        cache = cache.reserve(5)
+        cache = cache.append(rotated(raw_k[:, :, b:b + 5], rope, cache.end), raw_v[:, :, b:b + 5]).tail(10)
+
+    assert_close(shift(kept.key, rope, -kept.start), shift(kept_key, rope, -12), atol=ATOL, rtol=RTOL)
+    assert_close(kept.value, kept_value, atol=0.0, rtol=0.0)
@@ -0,0 +1,140 @@
+import torch
+import pytest
+from torch.nn import functional as F
+from torch.testing import assert_close
+from airsoul.modules import gsa, rwkv6, rwkv7, deltanet
+from airsoul.modules.block_wrapper import MultiBlocks
+from airsoul.modules.linear_attention import (fla_available, chunk_gla, recurrent_gla, chunk_dplr, recurrent_dplr,
+                                              chunk_gated_delta_rule, recurrent_gated_delta_rule)
+
+# float32, the chunked and the step-by-step forms only reorder the same sums
+ATOL, RTOL = 1.0e-5, 1.0e-4
+# fla kernels against the plain PyTorch layers, the kernels may use TF32 in their matmuls
+FLA_ATOL, FLA_RTOL = 2.0e-3, 2.0e-3
+
+B, T, H, K, V = 2, 45, 3, 8, 6
+
+def inputs(seed=0):
+    torch.manual_seed(seed)
+    return (torch.randn(B, T, H, K), torch.randn(B, T, H, K), torch.randn(B, T, H, V), torch.randn(B, H, K, V))
+
+def check_forms(chunk_fn, recurrent_fn, *args, initial_state=None, **kwargs):
+    """
+    The chunked form (uneven last chunk), the step-by-step form and the chunked form in two calls
+    through the final state give the same outputs and final states
+    """
+    o_c, s_c = chunk_fn(*args, initial_state=initial_state, output_final_state=True, chunk_size=16, **kwargs)
+    o_r, s_r = recurrent_fn(*args, initial_state=initial_state, output_final_state=True, **kwargs)
+    assert_close(o_c, o_r, atol=ATOL, rtol=RTOL)
+    assert_close(s_c, s_r, atol=ATOL, rtol=RTOL)
+    s = T // 3
+    o_1, s_1 = chunk_fn(*[x[:, :s] for x in args], initial_state=initial_state, output_final_state=True,
+                        chunk_size=16, **kwargs)
+    o_2, s_2 = chunk_fn(*[x[:, s:] for x in args], initial_state=s_1, output_final_state=True, chunk_size=16, **kwargs)
+    assert_close(torch.cat([o_1, o_2], dim=1), o_r, atol=ATOL, rtol=RTOL)
+    assert_close(s_2, s_r, atol=ATOL, rtol=RTOL)
+
+def test_gla_forms():
+    q, k, v, h0 = inputs()
+    gk = F.logsigmoid(torch.randn(B, T, H, K)) / 4
+    gv = F.logsigmoid(torch.randn(B, T, H, V)) / 4
+    check_forms(chunk_gla, recurrent_gla, q, k, v, gk, initial_state=h0)
+    check_forms(chunk_gla, recurrent_gla, q, k, v, gk, gv, initial_state=h0)
+    check_forms(chunk_gla, recurrent_gla, q, k, v, gk, initial_state=None)
+
+def test_rwkv6_bonus_forms():
+    q, k, v, h0 = inputs(1)
+    gk = F.logsigmoid(torch.randn(B, T, H, K)) / 4
+    check_forms(chunk_gla, recurrent_gla, q, k, v, gk, u=torch.randn(H, K), scale=1.0, initial_state=h0)
+
+def test_dplr_forms():
+    q, k, v, h0 = inputs(2)
+    kk = F.normalize(torch.randn(B, T, H, K), dim=-1)
+    lr = torch.sigmoid(torch.randn(B, T, H, K))
+    w = -0.6065306597126334 * torch.sigmoid(torch.randn(B, T, H, K))
+    check_forms(chunk_dplr, recurrent_dplr, q, k, v, -kk, kk * lr, w, scale=1.0, initial_state=h0)
+
+def test_gated_delta_rule_forms():
+    q, k, v, h0 = inputs(3)
+    g = F.logsigmoid(torch.randn(B, T, H)) / 4
+    beta = torch.sigmoid(torch.randn(B, T, H))
+    check_forms(chunk_gated_delta_rule, recurrent_gated_delta_rule, q, k, v, g, beta, initial_state=h0)
+
+def test_gated_delta_rule_is_dplr():
+    # exp(g) (I - beta k k^T) S + beta k v^T is the diagonal plus low-rank recurrence with a = k, b = -exp(g) beta k
+    q, k, v, h0 = inputs(4)
+    g = F.logsigmoid(torch.randn(B, T, H)) / 4
+    beta = torch.sigmoid(torch.randn(B, T, H))
+    qn, kn = F.normalize(q, dim=-1), F.normalize(k, dim=-1)
+    gb = g.unsqueeze(-1).expand(B, T, H, K)
+    o_d, s_d = chunk_dplr(qn, kn * beta.unsqueeze(-1), v, kn, -(g.exp() * beta).unsqueeze(-1) * kn, gb,
+                          initial_state=h0, output_final_state=True)
+    o_g, s_g = chunk_gated_delta_rule(q, k, v, g, beta, initial_state=h0, output_final_state=True)
+    assert_close(o_d, o_g, atol=ATOL, rtol=RTOL)
+    assert_close(s_d, s_g, atol=ATOL, rtol=RTOL)
+
+# The CausalBlock layers with the arguments used by the models
+LAYERS = {
+    "gla": (gsa, lambda: gsa.GLABlock(io_size=64, num_heads=4)),
+    "gsa": (gsa, lambda: gsa.GSABlock(io_size=64, num_heads=4, num_slots=4)),
+    "rwkv6": (rwkv6, lambda: rwkv6.RWKV6Layer(io_size=64, intermediate_size=128, num_heads=2)),
+    "rwkv7": (rwkv7, lambda: rwkv7.RWKV7Layer(io_size=64, intermediate_size=128, num_heads=2)),
+    "deltanet": (deltanet, lambda: deltanet.GatedDeltaNet(io_size=64, intermediate_size=128, num_heads=2, expend_v=1)),
+}
+
+@pytest.mark.parametrize("name", list(LAYERS.keys()))
+def test_layer_segments(name):
+    # The whole sequence, token by token and in uneven segments through the cache
+    torch.manual_seed(0)
+    _, build = LAYERS[name]
+    layer = build().eval()
+    x = torch.randn(2, 40, 64)
+    with torch.no_grad():
+        full, _ = layer(x)
+        for sizes in [[1] * 40, [13, 1, 26]]:
+            cache, outputs, b = None, [], 0
+            for n in sizes:
+                out, cache = layer(x[:, b:b + n], cache=cache, need_cache=True)
+                outputs.append(out)
+                b += n
+            assert_close(torch.cat(outputs, dim=1), full, atol=ATOL, rtol=RTOL)
+
+@pytest.mark.skipif(not fla_available(), reason="fla, triton and a CUDA device are required")
+@pytest.mark.parametrize("name", list(LAYERS.keys()))
+def test_fla_weights_and_outputs(name, monkeypatch):
+    """
+    The plain PyTorch layer loads the weights of the fla layer as they are and gives the same outputs
+    """
+    module, build = LAYERS[name]
+    torch.manual_seed(0)
+    fla_layer = build().cuda().eval()
+    assert fla_layer.use_fla
+    monkeypatch.setattr(module, "fla_available", lambda: False)
+    torch_layer = build().cuda().eval()
+    assert not torch_layer.use_fla
+    torch_layer.load_state_dict(fla_layer.state_dict(), strict=True)
+
+    # The fla layers are always called with need_cache=True, as MultiBlocks does
+    x = torch.randn(2, 64, 64, device='cuda')
+    with torch.no_grad():
+        fla_out, _ = fla_layer(x, need_cache=True)
+        torch_out, _ = torch_layer(x, need_cache=True)
+        fla_first, fla_cache = fla_layer(x[:, :40], need_cache=True)
+        fla_second, _ = fla_layer(x[:, 40:], cache=fla_cache, need_cache=True)
+    assert_close(torch_out, fla_out, atol=FLA_ATOL, rtol=FLA_RTOL)
+    # The fla cache continues the sequence as the plain PyTorch layer does on the whole of it
+    assert_close(torch.cat([fla_first, fla_second], dim=1), torch_out, atol=FLA_ATOL, rtol=FLA_RTOL)
+
+@pytest.mark.skipif(not fla_available(), reason="fla, triton and a CUDA device are required")
+def test_fla_trained_model_loads_without_fla(monkeypatch):
+    # A stack trained with the fla layers is served by the plain PyTorch ones
+    torch.manual_seed(0)
+    fla_model = MultiBlocks(gsa.GLABlock, 2, hidden=64, fc_hidden=128, fc_dropout=0.0, io_size=64, num_heads=4).cuda().eval()
+    monkeypatch.setattr(gsa, "fla_available", lambda: False)
+    torch_model = MultiBlocks(gsa.GLABlock, 2, hidden=64, fc_hidden=128, fc_dropout=0.0, io_size=64, num_heads=4).eval()
+    torch_model.load_state_dict({k: v.cpu() for k, v in fla_model.state_dict().items()}, strict=True)
+    x = torch.randn(2, 48, 64)
+    with torch.no_grad():
+        fla_out, _ = fla_model(x.cuda())
+        torch_out, _ = torch_model(x)
+    assert_close(torch_out, fla_out.cpu(), atol=FLA_ATOL, rtol=FLA_RTOL)
@@ -0,0 +1,66 @@
+import torch
+from torch.testing import assert_close
+from airsoul.modules.rope_mha import RotaryEmbedding, precompute_freqs_cis, rotate_emb, shift_rotary_emb, apply_rotary_emb
+
+# float32 against the float64 reference, the float32 angles p * freq of the tables are off by up to p * 2^-24;
+# bf16 rotations round the tables and the products to 8 bits of mantissa
+ATOL, RTOL = 1.0e-4, 1.0e-4
+BF16_ATOL, BF16_RTOL = 3.0e-2, 1.6e-2
+
+def reference_rotation(x, x0_pos, theta=10000.0):
+    """
+    (x[2i], x[2i+1]) rotated by the angle p * theta^(-2i / d) of their position p, in float64
+    x: [bs, seq, nhead, d_head]
+    """
+    d = x.shape[-1]
+    pos = torch.arange(x0_pos, x0_pos + x.shape[1], dtype=torch.float64)
+    angles = torch.outer(pos, theta ** (-torch.arange(0, d, 2, dtype=torch.float64) / d))[None, :, None, :]
+    x1, x2 = x.double()[..., 0::2], x.double()[..., 1::2]
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    return torch.stack((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1).flatten(-2)
+
+def tables():
+    return [("complex", precompute_freqs_cis(16, 1024)),
+            ("rotary complex", RotaryEmbedding(16, 1024, real=False)),
+            ("rotary real", RotaryEmbedding(16, 1024, real=True))]
+
+def test_rotation_matches_reference():
+    torch.manual_seed(0)
+    x = torch.randn(3, 200, 4, 16)
+    for name, table in tables():
+        for x0_pos in [0, 1, 513, 824]:
+            assert_close(rotate_emb(x, table, x0_pos).double(), reference_rotation(x, x0_pos),
+                         atol=ATOL, rtol=RTOL, msg=lambda msg: f"{name} at {x0_pos}: {msg}")
+
+def test_apply_rotary_emb():
+    torch.manual_seed(0)
+    xq, xk = torch.randn(2, 10, 4, 16), torch.randn(2, 30, 4, 16)
+    for name, table in tables():
+        q, k = apply_rotary_emb(xq, xk, table, q0_pos=20, k0_pos=0)
+        assert_close(q.double(), reference_rotation(xq, 20), atol=ATOL, rtol=RTOL)
+        assert_close(k.double(), reference_rotation(xk, 0), atol=ATOL, rtol=RTOL)
+
+def test_shift_composes_with_rotation():
+    torch.manual_seed(0)
+    x = torch.randn(2, 50, 4, 16)
+    for name, table in tables():
+        for x0_pos, shift in [(100, 37), (100, -37), (300, -300), (0, 0)]:
+            shifted = shift_rotary_emb(rotate_emb(x, table, x0_pos), table, shift)
+            assert_close(shifted.double(), reference_rotation(x, x0_pos + shift), atol=ATOL, rtol=RTOL)
+
+def test_real_rotation_in_bf16():
+    torch.manual_seed(0)
+    x = torch.randn(2, 100, 4, 16).bfloat16()
+    rope = RotaryEmbedding(16, 1024, real=True)
+    out = rotate_emb(x, rope, 300)
+    assert out.dtype == torch.bfloat16
+    assert_close(out.double(), reference_rotation(x, 300), atol=BF16_ATOL, rtol=BF16_RTOL)
+    assert_close(rope.shift(out, -300).double(), reference_rotation(x, 0), atol=BF16_ATOL, rtol=BF16_RTOL)
+
+def test_tables_are_kept_per_device():
+    rope = RotaryEmbedding(16, 1024)
+    device = torch.device('cpu')
+    assert rope.table(device) is rope.table(device)
+    x = torch.randn(1, 4, 2, 16)
+    rope.rotate(x, 10)
+    assert len(rope.tables) == 1
@@ -0,0 +1,92 @@
+import math
+import torch
+from torch.testing import assert_close
+from airsoul.modules.transformers import ARTransformerEncoder
+from airsoul.modules.rope_mha import precompute_freqs_cis, rotate_emb
+
+# float32, the fused kernel and the matmul-softmax-matmul reference differ in the order of the additions
+ATOL, RTOL = 1.0e-5, 1.0e-4
+
+def make_encoder(context_window=-1, num_layers=2):
+    torch.manual_seed(0)
+    return ARTransformerEncoder(num_layers, 64, 4, 128, dim_feedforward=128, dropout=0.0,
+                                context_window=context_window).eval()
+
+def dense_mask(length, context_window):
+    # The additive mask the encoder used to keep as a [max_position_encoding, max_position_encoding] buffer
+    mask = (torch.triu(torch.ones(length, length)) == 1).transpose(1, 0)
+    if(context_window > -1):
+        mask = mask & (torch.triu(torch.ones(length, length), diagonal=-context_window) == 1)
+    return torch.zeros(length, length).masked_fill(~mask, float('-inf'))
+
+def reference_forward(model, src):
+    """
+    Matmul-softmax-matmul attention with the dense mask and the complex rotary table
+    """
+    bsz, length, _ = src.shape
+    mask = dense_mask(length, model.context_window)
+    freqs_cis = precompute_freqs_cis(model.d_head, model.max_position_encoding)
+    output = src
+    for layer in model.layers:
+        attn = layer.self_attn
+        x = layer.norm1(output)
+        q = attn.qlayer(x).view(bsz, length, attn.n_heads, attn.d_head)
+        k = attn.klayer(x).view(bsz, length, attn.n_heads, attn.d_head)
+        v = attn.vlayer(x).view(bsz, length, attn.n_heads, attn.d_head).transpose(1, 2)
+        q = rotate_emb(q, freqs_cis).transpose(1, 2)
+        k = rotate_emb(k, freqs_cis).transpose(1, 2)
+        scores = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(attn.d_head) + mask, dim=-1)
+        att = (scores @ v).transpose(1, 2).reshape(bsz, length, -1)
+        output = output + attn.att_proj_linear(att)
+        output = output + layer.linear2(layer.activation(layer.linear1(layer.norm2(output))))
+    return output
+
+def test_fused_attention_matches_reference():
+    src = torch.randn(2, 40, 64)
+    for context_window in [-1, 0, 1, 5, 64]:
+        model = make_encoder(context_window)
+        with torch.no_grad():
+            out, _ = model(src)
+            assert_close(out, reference_forward(model, src), atol=ATOL, rtol=RTOL)
+
+def test_context_window_incremental():
+    # Queries after a cache see the same window as in the full sequence
+    src = torch.randn(2, 40, 64)
+    for context_window in [0, 3, 5]:
+        model = make_encoder(context_window)
+        with torch.no_grad():
+            reference = reference_forward(model, src)
+            cache, outputs = None, []
+            for b, e in [(0, 9), (9, 10), (10, 27), (27, 40)]:
+                out, cache = model(src[:, b:e], cache=cache, need_cache=True)
+                outputs.append(out)
+        assert_close(torch.cat(outputs, dim=1), reference, atol=ATOL, rtol=RTOL)
+
+def test_checkpointed_layers():
+    src = torch.randn(2, 24, 64)
+    for context_window in [-1, 5]:
+        model = make_encoder(context_window, num_layers=3)
+        results = []
+        for density in [-1, 1, 2]:
+            x = src.clone().requires_grad_(True)
+            model.zero_grad()
+            out, _ = model(x, checkpoints_density=density)
+            out.pow(2).sum().backward()
+            results.append((out.detach(), x.grad, [p.grad.clone() for p in model.parameters()]))
+        out_ref, x_grad_ref, grads_ref = results[0]
+        for out, x_grad, grads in results[1:]:
+            assert_close(out, out_ref, atol=ATOL, rtol=RTOL)
+            assert_close(x_grad, x_grad_ref, atol=ATOL, rtol=RTOL)
+            for grad, grad_ref in zip(grads, grads_ref):
+                assert_close(grad, grad_ref, atol=ATOL, rtol=RTOL)
+
+def test_checkpointed_layers_extend_the_cache():
+    # With checkpoints the cache is built by extend_cache, the next segment must continue it correctly
+    src = torch.randn(2, 24, 64)
+    model = make_encoder(num_layers=3)
+    with torch.no_grad():
+        full, _ = model(src)
+    _, cache = model(src[:, :16], need_cache=True, checkpoints_density=1)
+    with torch.no_grad():
+        out, _ = model(src[:, 16:], cache=cache)
+    assert_close(out, full[:, 16:], atol=ATOL, rtol=RTOL)